@@ -0,0 +1,113 @@
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+INDICATORS = (
+    "rsi_7",
+    "rsi_14",
+    "cci_7",
+    "cci_14",
+    "sma_50",
+    "ema_50",
+    "sma_100",
+    "ema_100",
+    "macd",
+    "bollinger",
+    "TrueRange",
+    "atr_7",
+    "atr_14",
+    "next_day_close",
+)
+
+
+def ewm_mean(values: np.ndarray, alpha: float, min_periods: int = 1) -> np.ndarray:
+    # Same as pandas ewm(alpha=alpha, min_periods=min_periods).mean(): every
+    # value weighs q ** age and the mean is normalized by the sum of the weights.
+    q = 1 - alpha
+    # Weights grow as q ** -i inside a block, keep them within float range.
+    block = max(1, int(300 / -math.log(q)))
+    result = np.empty(len(values))
+    numerator = denominator = 0.0
+    for start in range(0, len(values), block):
+        chunk = values[start:start + block]
+        steps = np.arange(len(chunk))
+        decay = q ** steps
+        growth = q ** -steps
+        numerator = decay * (np.cumsum(growth * chunk) + q * numerator)
+        denominator = decay * (np.cumsum(growth) + q * denominator)
+        result[start:start + block] = numerator / denominator
+        numerator, denominator = numerator[-1], denominator[-1]
+    result[:min_periods - 1] = np.nan
+    return result
+
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    result = np.full(len(values), np.nan)
+    if len(values) >= window:
+        sums = np.cumsum(np.insert(values, 0, 0.0))
+        result[window - 1:] = (sums[window:] - sums[:-window]) / window
+    return result
+
+
+def rolling_mean_deviation(values: np.ndarray, window: int, means: np.ndarray) -> np.ndarray:
+    result = np.full(len(values), np.nan)
+    if len(values) >= window:
+        windows = sliding_window_view(values, window)
+        result[window - 1:] = np.abs(windows - means[window - 1:, None]).mean(axis=1)
+    return result
+
+
+def true_range(high: np.ndarray, low: np.ndarray, close: np.ndarray) -> np.ndarray:
+    previous_close = np.roll(close, 1)
+    result = np.maximum.reduce(
+        [high - low, np.abs(high - previous_close), np.abs(low - previous_close)]
+    )
+    result[:1] = high[:1] - low[:1]
+    return result
+
+
+def rsi(close: np.ndarray, window: int) -> np.ndarray:
+    changes = np.diff(close)
+    gains = ewm_mean(np.clip(changes, 0, None), 1 / window, window)
+    losses = ewm_mean(np.clip(-changes, 0, None), 1 / window, window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = 100 - 100 / (1 + gains / losses)
+    return np.insert(result, 0, np.nan)
+
+
+def cci(high: np.ndarray, low: np.ndarray, close: np.ndarray, window: int) -> np.ndarray:
+    typical_price = (high + low + close) / 3
+    means = rolling_mean(typical_price, window)
+    deviations = rolling_mean_deviation(typical_price, window, means)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (typical_price - means) / (0.015 * deviations)
+
+
+def ema(values: np.ndarray, span: int) -> np.ndarray:
+    return ewm_mean(values, 2 / (span + 1), span)
+
+
+def compute_indicators(
+    high: np.ndarray, low: np.ndarray, close: np.ndarray
+) -> dict[str, np.ndarray]:
+    # Rows must be in date order, values that need more history than the
+    # series has are NaN. The exponential averages need as many values as
+    # their window before they are given.
+    ranges = true_range(high, low, close)
+    return {
+        "rsi_7": rsi(close, 7),
+        "rsi_14": rsi(close, 14),
+        "cci_7": cci(high, low, close, 7),
+        "cci_14": cci(high, low, close, 14),
+        "sma_50": rolling_mean(close, 50),
+        "ema_50": ema(close, 50),
+        "sma_100": rolling_mean(close, 100),
+        "ema_100": ema(close, 100),
+        "macd": ema(close, 12) - ema(close, 26),
+        "bollinger": rolling_mean(close, 20),
+        "TrueRange": ranges,
+        "atr_7": ewm_mean(ranges, 1 / 7, 7),
+        "atr_14": ewm_mean(ranges, 1 / 14, 14),
+        "next_day_close": np.append(close[1:], np.nan),
+    }
@@ -0,0 +1,80 @@
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+from core import services
+from core.models import Job
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "core_job"
+
+
+def submit_job(question: str, model: str, columnar: bool = False) -> Job:
+    job = Job.objects.create(question=question, model=model, columnar=columnar)
+    # Idle workers wake up right away instead of at their next poll.
+    with connection.cursor() as cursor:
+        cursor.execute(f"NOTIFY {CHANNEL}")
+    return job
+
+
+class JobWorker:
+    def __init__(self, stopped: threading.Event | None = None) -> None:
+        self.stopped = threading.Event() if stopped is None else stopped
+        self._cleaned_at: float | None = None
+
+    def _delete_expired(self) -> None:
+        now = time.monotonic()
+        if self._cleaned_at is not None and now - self._cleaned_at < settings.JOB_CLEANUP_INTERVAL:
+            return
+        deleted, _ = Job.objects.filter(expires_at__lt=timezone.now()).delete()
+        if deleted:
+            logger.info("Deleted %d expired jobs.", deleted)
+        self._cleaned_at = now
+
+    def run_job(self, job: Job) -> None:
+        try:
+            resolver = services.QueryResolver(model=job.model)
+            result = resolver.resolve(job.question, columnar=job.columnar)
+        except Exception as e:
+            logger.warning("Job %s failed: %s", job.id, e)
+            finished = job.finish(error=str(e), ttl=settings.JOB_RESULT_TTL)
+        else:
+            finished = job.finish(result=result, ttl=settings.JOB_RESULT_TTL)
+        if not finished:
+            logger.warning("Job %s was taken over by another worker.", job.id)
+
+    def run_once(self) -> bool:
+        self._delete_expired()
+        job = Job.claim(settings.JOB_TIMEOUT)
+        if job is None:
+            return False
+        self.run_job(job)
+        return True
+
+    def _wait(self) -> None:
+        # LISTEN is repeated in case the connection was reopened.
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        pg_connection = connection.connection
+        if select.select([pg_connection], [], [], settings.JOB_POLL_INTERVAL)[0]:
+            pg_connection.poll()
+            pg_connection.notifies.clear()
+
+    def run(self, burst: bool = False) -> None:
+        while not self.stopped.is_set():
+            try:
+                if not self.run_once():
+                    if burst:
+                        return
+                    self._wait()
+            except DatabaseError as e:
+                logger.warning("Job worker database error: %s", e)
+                connection.close()
+                self.stopped.wait(settings.JOB_POLL_INTERVAL)
+
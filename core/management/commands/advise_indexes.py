@@ -0,0 +1,289 @@
+import collections
+import os
+import re
+import typing
+from typing import Iterator
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, migrations, transaction
+from django.db.backends.utils import truncate_name
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+
+from core.models import TeslaStockData
+from core.services import is_read_query, normalize_sql
+
+MAX_INCLUDE_COLUMNS = 4
+
+
+class IndexCandidate(typing.NamedTuple):
+    method: str
+    columns: tuple[str, ...]
+    include: tuple[str, ...] = ()
+
+
+class Command(BaseCommand):
+    help = "Propose indexes for the SQL logged by the query resolver"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "log_file",
+            nargs="?",
+            default=settings.SQL_LOG_FILE,
+            help="SQL log file, one statement per line (default: SQL_LOG_FILE)",
+        )
+        parser.add_argument(
+            "--write-migration",
+            action="store_true",
+            help="Write the proposed indexes as a new core migration",
+        )
+        parser.add_argument(
+            "--name",
+            default="advised_indexes",
+            help="Name of the generated migration",
+        )
+
+    def _read_log(self, log_file: str) -> collections.Counter:
+        if not log_file:
+            raise CommandError("No SQL log file, set SQL_LOG_FILE or pass a path.")
+        if not os.path.exists(log_file):
+            raise CommandError(f"File {log_file} does not exist.")
+        statements = collections.Counter()
+        with open(log_file, "r") as file:
+            for line in file:
+                sql = normalize_sql(line)
+                if sql and is_read_query(sql):
+                    statements[sql] += 1
+        return statements
+
+    def _explain(self, cursor, sql: str) -> dict | None:
+        try:
+            # Each statement gets its own savepoint, a broken one must not
+            # abort the transaction the candidates are measured in.
+            with transaction.atomic():
+                cursor.execute(f"EXPLAIN (FORMAT JSON, VERBOSE) {sql}")
+                return cursor.fetchone()[0][0]["Plan"]
+        except DatabaseError:
+            return None
+
+    def _explain_all(self, cursor, statements: typing.Iterable[str]) -> dict:
+        plans = {}
+        for sql in statements:
+            plan = self._explain(cursor, sql)
+            if plan is not None:
+                plans[sql] = plan
+        return plans
+
+    def _walk(self, node: dict) -> Iterator[dict]:
+        yield node
+        for child in node.get("Plans", []):
+            yield from self._walk(child)
+
+    def _get_cost(self, plans: dict, statements: collections.Counter) -> float:
+        return sum(plan["Total Cost"] * statements[sql] for sql, plan in plans.items())
+
+    def _get_used_indexes(self, plans: dict) -> set[str]:
+        return {
+            node["Index Name"]
+            for plan in plans.values()
+            for node in self._walk(plan)
+            if "Index Name" in node
+        }
+
+    def _get_column_regex(self, aliases: set[str]) -> re.Pattern:
+        aliases = "|".join(re.escape(alias) for alias in sorted(aliases))
+        return re.compile(rf'\b(?:{aliases})\.("(?:[^"]|"")+"|\w+)')
+
+    def _get_columns(self, regex: re.Pattern, expressions: list[str]) -> list[str]:
+        columns = []
+        for expression in expressions:
+            for column in regex.findall(expression):
+                column = column.strip('"').replace('""', '"')
+                if column in self.columns and column not in columns:
+                    columns.append(column)
+        return columns
+
+    def _get_sort_columns(self, regex: re.Pattern, sort_keys: list[str]) -> list[str]:
+        # Only plain columns, sorting by an expression can not use the index.
+        columns = []
+        for sort_key in sort_keys:
+            sort_key = re.sub(r"( DESC)?( NULLS (FIRST|LAST))?$", "", sort_key)
+            match = regex.fullmatch(sort_key)
+            if match is None:
+                break
+            columns.extend(self._get_columns(regex, [sort_key]))
+        return columns
+
+    def _get_candidates(self, plan: dict) -> list[IndexCandidate]:
+        nodes = list(self._walk(plan))
+        scans = [
+            node
+            for node in nodes
+            if node["Node Type"] == "Seq Scan" and node.get("Relation Name") == self.table
+        ]
+        if not scans:
+            return []
+
+        regex = self._get_column_regex({scan["Alias"] for scan in scans})
+        filter_columns = self._get_columns(
+            regex, [scan["Filter"] for scan in scans if "Filter" in scan]
+        )
+        sort_columns = []
+        for node in nodes:
+            if node["Node Type"] in ("Sort", "Incremental Sort"):
+                sort_columns = self._get_sort_columns(regex, node["Sort Key"])
+                break
+        output_columns = self._get_columns(
+            regex, [column for scan in scans for column in scan.get("Output", [])]
+        )
+
+        columns = tuple(dict.fromkeys(sort_columns + filter_columns))[:2]
+        if not columns:
+            return []
+
+        candidates = [IndexCandidate("btree", columns)]
+        if columns[0] == "date":
+            # Dates are loaded in order, a BRIN index is tiny and good enough
+            # for range filters.
+            candidates.append(IndexCandidate("brin", ("date",)))
+        include = tuple(column for column in output_columns if column not in columns)
+        if 0 < len(include) <= MAX_INCLUDE_COLUMNS:
+            candidates.append(IndexCandidate("btree", columns, include))
+        return candidates
+
+    def _get_indexes(self, cursor) -> list[IndexCandidate]:
+        cursor.execute(
+            """
+            SELECT am.amname, x.indnkeyatts, array_agg(a.attname ORDER BY k.n)
+            FROM pg_index x
+            JOIN pg_class i ON i.oid = x.indexrelid
+            JOIN pg_am am ON am.oid = i.relam
+            CROSS JOIN LATERAL unnest(x.indkey::int2[]) WITH ORDINALITY k(attnum, n)
+            JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = k.attnum
+            WHERE x.indrelid = %s::regclass
+            GROUP BY x.indexrelid, am.amname, x.indnkeyatts
+            """,
+            [self.table],
+        )
+        return [
+            IndexCandidate(method, tuple(columns[:keys]), tuple(columns[keys:]))
+            for method, keys, columns in cursor.fetchall()
+        ]
+
+    def _is_covered(self, candidate: IndexCandidate, indexes: list[IndexCandidate]) -> bool:
+        return any(
+            index.method == candidate.method
+            and index.columns[: len(candidate.columns)] == candidate.columns
+            and set(candidate.include) <= set(index.columns + index.include)
+            for index in indexes
+        )
+
+    def _get_index_name(self, candidate: IndexCandidate) -> str:
+        parts = [self.table, *candidate.columns, candidate.method]
+        if candidate.include:
+            parts.append("covering")
+        name = "_".join(parts).lower()
+        return truncate_name(name, connection.ops.max_name_length())
+
+    def _get_create_sql(self, candidate: IndexCandidate, concurrently: bool = False) -> str:
+        quote_name = connection.ops.quote_name
+        sql = (
+            f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS "
+            f"{quote_name(self._get_index_name(candidate))} ON {quote_name(self.table)} "
+            f"USING {candidate.method} "
+            f"({', '.join(quote_name(column) for column in candidate.columns)})"
+        )
+        if candidate.include:
+            sql += f" INCLUDE ({', '.join(quote_name(column) for column in candidate.include)})"
+        return sql
+
+    def _get_drop_sql(self, candidate: IndexCandidate, concurrently: bool = False) -> str:
+        return (
+            f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS "
+            f"{connection.ops.quote_name(self._get_index_name(candidate))}"
+        )
+
+    def _write_migration(self, candidates: list[IndexCandidate], name: str) -> str:
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        leaf_nodes = loader.graph.leaf_nodes("core")
+        number = max(
+            (MigrationAutodetector.parse_number(leaf) or 0 for _, leaf in leaf_nodes),
+            default=0,
+        )
+        migration = migrations.Migration(f"{number + 1:04d}_{name}", "core")
+        migration.dependencies = leaf_nodes
+        migration.operations = [
+            migrations.RunSQL(
+                sql=self._get_create_sql(candidate, concurrently=True),
+                reverse_sql=self._get_drop_sql(candidate, concurrently=True),
+            )
+            for candidate in candidates
+        ]
+        writer = MigrationWriter(migration)
+        # CREATE INDEX CONCURRENTLY does not block reads and writes but can not
+        # run inside a transaction.
+        content = writer.as_string().replace(
+            "class Migration(migrations.Migration):\n",
+            "class Migration(migrations.Migration):\n\n    atomic = False\n",
+            1,
+        )
+        with open(writer.path, "w") as file:
+            file.write(content)
+        return writer.path
+
+    def handle(self, *args, **options):
+        self.table = TeslaStockData._meta.db_table
+        self.columns = {field.column for field in TeslaStockData._meta.concrete_fields}
+        statements = self._read_log(options["log_file"])
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            plans = self._explain_all(cursor, statements)
+            before = self._get_cost(plans, statements)
+
+            candidates = collections.Counter()
+            for sql, plan in plans.items():
+                for candidate in set(self._get_candidates(plan)):
+                    candidates[candidate] += statements[sql]
+            indexes = self._get_indexes(cursor)
+            candidates = {
+                candidate: count
+                for candidate, count in candidates.items()
+                if not self._is_covered(candidate, indexes)
+            }
+
+            # The candidates only exist inside this transaction, it is rolled
+            # back once the plans are measured.
+            for candidate in candidates:
+                cursor.execute(self._get_create_sql(candidate))
+            used = self._get_used_indexes(self._explain_all(cursor, plans))
+            proposed = [
+                candidate
+                for candidate in candidates
+                if self._get_index_name(candidate) in used
+            ]
+            for candidate in candidates:
+                if candidate not in proposed:
+                    cursor.execute(self._get_drop_sql(candidate))
+            after = self._get_cost(self._explain_all(cursor, plans), statements)
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f"{statements.total()} statements read, {len(statements)} distinct, "
+            f"{len(statements) - len(plans)} could not be explained."
+        )
+        if not proposed:
+            self.stdout.write("No indexes to propose.")
+            return
+
+        for candidate in sorted(proposed, key=candidates.get, reverse=True):
+            self.stdout.write(
+                f"{self._get_create_sql(candidate)}; -- used by {candidates[candidate]} statements"
+            )
+        change = (after - before) / before * 100 if before else 0
+        self.stdout.write(f"Workload cost: {before:.2f} -> {after:.2f} ({change:+.1f}%).")
+
+        if options["write_migration"]:
+            path = self._write_migration(proposed, options["name"])
+            self.stdout.write(f"Migration written to {path}.")
@@ -0,0 +1,326 @@
+import contextlib
+import csv
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+from io import StringIO
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.http import JsonResponse
+from django.test import override_settings
+
+from core import services
+from core.models import TeslaStockData
+from core.views import COLUMNAR_FORMATS, _render_columnar
+
+QUESTIONS = [
+    "What was the latest RSI 14?",
+    "max volume per year",
+    "average monthly closing price",
+    "true range and atr on 2020-01-02",
+    "give me all the records of 2021",
+]
+
+GENERATED_SQL = (
+    'SELECT DATE(MAX("date")) AS most_recent_date\n'
+    "FROM core_teslastockdata;"
+)
+
+
+class StubOllamaClient:
+    def chat(self, **kwargs) -> dict:
+        return {"message": {"content": GENERATED_SQL}}
+
+
+class Command(BaseCommand):
+    help = "Benchmark the resolve pipeline and the loader offline"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="1000,100000,10000000",
+            help="Comma separated row counts of the synthetic tables queried.",
+        )
+        parser.add_argument(
+            "--load-rows",
+            type=int,
+            default=100000,
+            help="Rows of the synthetic file loaded with load_data.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=20,
+            help="Timed runs of every benchmark.",
+        )
+        parser.add_argument(
+            "--output",
+            default="benchmark.json",
+            help="File the JSON results are written to.",
+        )
+        parser.add_argument(
+            "--compare",
+            help="Baseline JSON results to compare with.",
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=0.2,
+            help="Relative slowdown of the median reported as a regression.",
+        )
+
+    @contextlib.contextmanager
+    def _test_database(self):
+        # Benchmarks truncate and fill the tables, never touch the real data.
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _measure(self, func, repeat: int, **extra) -> dict:
+        func()
+        timings = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started_at) * 1000)
+        timings.sort()
+        return {
+            "runs": repeat,
+            "min_ms": timings[0],
+            "median_ms": statistics.median(timings),
+            "mean_ms": statistics.fmean(timings),
+            "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            **extra,
+        }
+
+    def _fill_table(self, rows: int) -> None:
+        columns = [
+            field.column
+            for field in TeslaStockData._meta.concrete_fields
+            if field.column not in ("id", "date", "volume")
+        ]
+        quote_name = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {quote_name(TeslaStockData._meta.db_table)}")
+            cursor.execute("SELECT setseed(0.5)")
+            cursor.execute(
+                f"""
+                INSERT INTO {quote_name(TeslaStockData._meta.db_table)}
+                    (date, volume, {", ".join(quote_name(column) for column in columns)})
+                SELECT
+                    DATE '1900-01-01' + n,
+                    (random() * 100000000)::bigint,
+                    {", ".join("random() * 500" for _ in columns)}
+                FROM generate_series(1, %s) AS n
+                """,
+                [rows],
+            )
+            cursor.execute(f"ANALYZE {quote_name(TeslaStockData._meta.db_table)}")
+
+    def _write_csv(self, path: str, rows: int, ohlcv_only: bool) -> None:
+        fields = [
+            field.name
+            for field in TeslaStockData._meta.concrete_fields
+            if not field.primary_key
+        ]
+        if ohlcv_only:
+            fields = fields[:6]
+        start = datetime.date(1900, 1, 1)
+        with open(path, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(fields)
+            for n in range(rows):
+                price = 100 + n % 500
+                writer.writerow(
+                    [(start + datetime.timedelta(days=n)).isoformat(), *[price] * 4, n]
+                    + [price / 2] * (len(fields) - 6)
+                )
+
+    def _benchmark_generation(self, repeat: int) -> dict:
+        builder = services.PromptBuilder()
+        generator = services.OllamaSqlGenerator(
+            settings.AVAILABLE_MODELS[0], client=StubOllamaClient(), prompt_builder=builder
+        )
+
+        def build_prompts():
+            for question in QUESTIONS:
+                builder.build(question)
+
+        def clean_sql():
+            services.normalize_sql(generator._clean_sql(GENERATED_SQL))
+
+        def generate_sql():
+            for question in QUESTIONS:
+                generator.generate_sql(question)
+
+        template_generator = services.TemplateSqlGenerator(
+            generator, model=settings.AVAILABLE_MODELS[0]
+        )
+
+        def match_templates():
+            for question in QUESTIONS:
+                template_generator.match(question)
+
+        return {
+            "prompt.build": self._measure(build_prompts, repeat, questions=len(QUESTIONS)),
+            "sql.clean": self._measure(clean_sql, repeat),
+            "sql.generate_stubbed": self._measure(
+                generate_sql, repeat, questions=len(QUESTIONS)
+            ),
+            "sql.template": self._measure(
+                match_templates,
+                repeat,
+                questions=len(QUESTIONS),
+                hits=sum(template_generator.match(question) is not None for question in QUESTIONS),
+            ),
+        }
+
+    def _benchmark_execution(self, size: int, repeat: int) -> dict:
+        self._fill_table(size)
+        executor = services.DjangoQueryExecutor()
+        queries = {
+            "aggregate": (
+                "SELECT avg(close) AS close, max(volume) AS volume "
+                "FROM core_teslastockdata"
+            ),
+            "range": (
+                "SELECT date, close FROM core_teslastockdata "
+                "WHERE date BETWEEN '1900-06-01' AND '1901-06-01' ORDER BY date"
+            ),
+            "rows": "SELECT * FROM core_teslastockdata",
+        }
+        results = {}
+        for name, sql in queries.items():
+            rows = len(executor.execute(sql))
+            results[f"execute.{size}.{name}"] = self._measure(
+                lambda: executor.execute(sql), repeat, rows=rows
+            )
+            with override_settings(PREPARED_STATEMENTS_ENABLED=True):
+                results[f"execute.{size}.{name}_prepared"] = self._measure(
+                    lambda: executor.execute(sql), repeat, rows=rows
+                )
+
+        resolver = services.QueryResolver(
+            sql_generator=services.DummySqlGenerator(), query_executor=executor
+        )
+        results[f"resolve.{size}.dummy"] = self._measure(
+            lambda: resolver.resolve("latest close"), repeat
+        )
+
+        response = resolver._get_response(
+            "all rows", queries["rows"], executor.execute(queries["rows"]), None
+        )
+        results[f"serialize.{size}.json"] = self._measure(
+            lambda: JsonResponse(response),
+            repeat,
+            rows=len(response["response"]),
+            bytes=len(JsonResponse(response).content),
+        )
+        response = resolver._get_response(
+            "all rows", queries["rows"], executor.execute_rows(queries["rows"]), None
+        )
+        for format in COLUMNAR_FORMATS:
+            results[f"serialize.{size}.{format}"] = self._measure(
+                lambda: _render_columnar(response, format, "rows"),
+                repeat,
+                rows=len(response["rows"]),
+                bytes=len(_render_columnar(response, format, "rows").content),
+            )
+        return results
+
+    def _benchmark_loading(self, rows: int, repeat: int) -> dict:
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for name, ohlcv_only in (("csv", False), ("ohlcv", True)):
+                path = os.path.join(directory, f"{name}.csv")
+                self._write_csv(path, rows, ohlcv_only)
+                result = self._measure(
+                    lambda: call_command("load_data", path, stdout=StringIO()),
+                    repeat,
+                    rows=rows,
+                )
+                result["rows_per_s"] = rows / result["median_ms"] * 1000
+                results[f"load_data.{name}"] = result
+        return results
+
+    def _compare(self, results: dict, baseline_path: str, threshold: float) -> list[str]:
+        with open(baseline_path) as file:
+            baseline = json.load(file)["results"]
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            before, after = baseline[name]["median_ms"], result["median_ms"]
+            change = (after - before) / before if before else 0
+            regressed = change > threshold
+            if regressed:
+                regressions.append(name)
+            self.stdout.write(
+                f"{name}: {before:.3f} -> {after:.3f} ms ({change:+.1%})"
+                + (" REGRESSION" if regressed else "")
+            )
+        return regressions
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",") if size]
+        repeat = options["repeat"]
+
+        results = {}
+        # Per question logging would be measured and flood the output.
+        logging.disable(logging.INFO)
+        try:
+            with self._test_database():
+                results.update(self._benchmark_generation(repeat))
+                for size in sizes:
+                    self.stdout.write(f"Benchmarking queries on {size} rows.")
+                    results.update(self._benchmark_execution(size, repeat))
+                # Loading is slow, a few runs are enough.
+                results.update(self._benchmark_loading(options["load_rows"], min(repeat, 3)))
+                with connection.cursor() as cursor:
+                    cursor.execute("SHOW server_version")
+                    postgres = cursor.fetchone()[0]
+        finally:
+            logging.disable(logging.NOTSET)
+
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name}: median {result['median_ms']:.3f} ms, "
+                f"p95 {result['p95_ms']:.3f} ms"
+            )
+
+        with open(options["output"], "w") as file:
+            json.dump(
+                {
+                    "environment": {
+                        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                        "python": platform.python_version(),
+                        "django": django.get_version(),
+                        "postgres": postgres,
+                        "machine": platform.machine(),
+                    },
+                    "results": results,
+                },
+                file,
+                indent=2,
+            )
+        self.stdout.write(f"Results written to {options['output']}.")
+
+        if options["compare"]:
+            regressions = self._compare(results, options["compare"], options["threshold"])
+            if regressions:
+                raise CommandError(
+                    f"{len(regressions)} benchmarks regressed by more than "
+                    f"{options['threshold']:.0%}: {', '.join(regressions)}."
+                )
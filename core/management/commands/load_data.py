@@ -1,12 +1,17 @@
 import csv
+import io
 import os
-from datetime import datetime
+import time
+from collections.abc import Iterator
+from datetime import date
 
+import numpy as np
 from django.core.management.base import BaseCommand, CommandError
 
-from core.models import TeslaStockData
+from core.indicators import INDICATORS, compute_indicators
+from core.models import ROLLUP_MODELS, DataVersion, TeslaStockData
 
-from django.db import transaction
+from django.db import connection, models, transaction
 
 
 class Command(BaseCommand):
@@ -14,27 +19,269 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("file_path", type=str)
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="Rows validated and copied into the database at once.",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Insert new dates and update changed ones instead of reloading the table.",
+        )
 
-    def _read_data(self, file_path) -> list[dict]:
-        data = []
-        with open(file_path, "r") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                data.append(row)
-        return data
+    def _get_fields(self) -> list[models.Field]:
+        return [
+            field
+            for field in TeslaStockData._meta.concrete_fields
+            if not field.primary_key
+        ]
+
+    @staticmethod
+    def _to_date(value: str) -> str:
+        return date.fromisoformat(value).isoformat()
+
+    @staticmethod
+    def _to_float(value: str) -> str:
+        return repr(float(value))
+
+    @staticmethod
+    def _to_int(value: str) -> str:
+        try:
+            return str(int(value))
+        except ValueError:
+            number = float(value)
+            if not number.is_integer():
+                raise ValueError(f"invalid integer: {value!r}")
+            return str(int(number))
+
+    def _get_converter(self, field: models.Field):
+        converter = {
+            "DateField": self._to_date,
+            "FloatField": self._to_float,
+            "BigIntegerField": self._to_int,
+        }[field.get_internal_type()]
+        if field.null:
+            # An empty unquoted field is NULL for COPY.
+            return lambda value: converter(value) if value != "" else ""
+        return converter
+
+    def _convert_rows(
+        self, fields: list[models.Field], header: list[str], reader
+    ) -> Iterator[list[str]]:
+        converters = [self._get_converter(field) for field in fields]
+        positions = [header.index(field.name) for field in fields]
+        for line_number, row in enumerate(reader, start=2):
+            try:
+                yield [
+                    converter(row[position])
+                    for converter, position in zip(converters, positions)
+                ]
+            except (IndexError, ValueError) as e:
+                raise CommandError(f"Invalid row in line {line_number}: {e}.")
+
+    def _format_stored(self, stock_data: TeslaStockData, fields: list[models.Field]) -> list[str]:
+        row = []
+        for field in fields:
+            value = getattr(stock_data, field.attname)
+            if value is None:
+                row.append("")
+            elif isinstance(value, float):
+                row.append(repr(value))
+            else:
+                row.append(str(value))
+        return row
+
+    def _compute_rows(
+        self, fields: list[models.Field], header: list[str], reader, incremental: bool
+    ) -> Iterator[list[str]]:
+        raw_fields = [field for field in fields if field.name not in INDICATORS]
+        # Indicators need the rows in date order.
+        date_position = raw_fields.index(TeslaStockData._meta.get_field("date"))
+        rows = sorted(
+            self._convert_rows(raw_fields, header, reader),
+            key=lambda row: row[date_position],
+        )
+        if not rows:
+            return
+        positions = {field.name: position for position, field in enumerate(raw_fields)}
+        history = []
+        if incremental:
+            # The indicators continue from the stored rows before the file,
+            # otherwise they would start their warm-up over.
+            history = list(
+                TeslaStockData.objects.filter(date__lt=rows[0][date_position])
+                .order_by("date")
+                .values_list("high", "low", "close")
+            )
+        self.stdout.write(
+            f"Computing indicators of {len(rows)} rows"
+            + (f" after {len(history)} stored rows." if history else ".")
+        )
+        high, low, close = np.array(
+            history
+            + [[row[positions[name]] for name in ("high", "low", "close")] for row in rows],
+            dtype=float,
+        ).T
+        indicators = compute_indicators(high, low, close)
+        if history:
+            # Only the next day close of the last stored row changes. The row
+            # is not part of the file, it is left out of the reported counts.
+            previous = TeslaStockData.objects.filter(date__lt=rows[0][date_position]).latest("date")
+            previous.next_day_close = close[len(history)]
+            self.seed_dates.append(previous.date)
+            yield self._format_stored(previous, fields)
+        for index, row in enumerate(rows, start=len(history)):
+            yield [
+                row[positions[field.name]]
+                if field.name in positions
+                else self._format_float(indicators[field.name][index])
+                for field in fields
+            ]
+
+    @staticmethod
+    def _format_float(value: float) -> str:
+        return "" if np.isnan(value) else repr(float(value))
+
+    def _read_data(
+        self, file_path, chunk_size: int, incremental: bool = False
+    ) -> Iterator[list[list[str]]]:
+        fields = self._get_fields()
+        with open(file_path, "r", newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader, [])
+            missing = [field.name for field in fields if field.name not in header]
+            # Plain OHLCV files get their indicators computed.
+            if missing and set(missing) <= set(INDICATORS):
+                rows = self._compute_rows(fields, header, reader, incremental)
+            elif missing:
+                raise CommandError(f"Missing columns: {', '.join(missing)}.")
+            else:
+                rows = self._convert_rows(fields, header, reader)
+
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
 
     def _ensure_file_exists(self, file_path) -> None:
         if not os.path.exists(file_path):
             raise CommandError(f'File "{file_path}" does not exist.')
 
-    def _save_data(self, data: list[dict]) -> None:
-        stock_data = [TeslaStockData(**row) for row in data]
+    def _copy_data(self, cursor, table: str, chunk: list[list[str]]) -> None:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(chunk)
+        buffer.seek(0)
+        columns = ", ".join(
+            connection.ops.quote_name(field.column) for field in self._get_fields()
+        )
+        cursor.copy_expert(
+            f"COPY {connection.ops.quote_name(table)} ({columns}) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+
+    def _report_progress(self, rows: int, started_at: float) -> None:
+        elapsed = time.monotonic() - started_at
+        rate = rows / elapsed if elapsed else 0
+        self.stdout.write(f"{rows} rows loaded ({rate:.0f} rows/s).")
+
+    def _refresh_rollups(self, cursor) -> None:
+        # CONCURRENTLY keeps the rollups readable while they are rebuilt.
+        for model in ROLLUP_MODELS:
+            cursor.execute(
+                "REFRESH MATERIALIZED VIEW CONCURRENTLY "
+                f"{connection.ops.quote_name(model._meta.db_table)}"
+            )
+
+    def _upsert_data(self, chunks: Iterator[list[list[str]]]) -> tuple[int, int, int]:
+        table = TeslaStockData._meta.db_table
+        staging_table = f"{table}_staging"
+        quote_name = connection.ops.quote_name
+        columns = [quote_name(field.column) for field in self._get_fields()]
+        seeded = '"date" = ANY(%s::date[])'
+        rows = 0
+        started_at = time.monotonic()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TEMPORARY TABLE {quote_name(staging_table)} ON COMMIT DROP "
+                    f"AS SELECT {', '.join(columns)} FROM {quote_name(table)} WITH NO DATA"
+                )
+                for chunk in chunks:
+                    self._copy_data(cursor, staging_table, chunk)
+                    rows += len(chunk)
+                    self._report_progress(rows, started_at)
+
+                # The last row of a repeated date wins, the staging table keeps
+                # the file order.
+                cursor.execute(
+                    f"""
+                    WITH upserted AS (
+                        INSERT INTO {quote_name(table)} AS stock ({", ".join(columns)})
+                        SELECT DISTINCT ON ("date") {", ".join(columns)}
+                        FROM {quote_name(staging_table)}
+                        ORDER BY "date", ctid DESC
+                        ON CONFLICT ("date") DO UPDATE SET {", ".join(
+                            f"{column} = EXCLUDED.{column}" for column in columns
+                        )}
+                        WHERE ({", ".join(f"stock.{column}" for column in columns)})
+                            IS DISTINCT FROM
+                            ({", ".join(f"EXCLUDED.{column}" for column in columns)})
+                        RETURNING xmax = 0 AS inserted, {seeded} AS seeded
+                    )
+                    SELECT
+                        count(*) FILTER (WHERE inserted AND NOT seeded),
+                        count(*) FILTER (WHERE NOT inserted AND NOT seeded),
+                        count(*),
+                        (
+                            SELECT count(DISTINCT "date") FROM {quote_name(staging_table)}
+                            WHERE NOT {seeded}
+                        )
+                    FROM upserted
+                    """,
+                    [self.seed_dates, self.seed_dates],
+                )
+                inserted, updated, changed, staged = cursor.fetchone()
+                # ON COMMIT DROP does not fire when an outer transaction is
+                # still open.
+                cursor.execute(f"DROP TABLE {quote_name(staging_table)}")
+                if changed:
+                    self._refresh_rollups(cursor)
+            if changed:
+                DataVersion.bump(table)
+        return inserted, updated, staged - inserted - updated
+
+    def _save_data(self, chunks: Iterator[list[list[str]]]) -> int:
+        table = TeslaStockData._meta.db_table
+        rows = 0
+        started_at = time.monotonic()
         with transaction.atomic():
             TeslaStockData.objects.all().delete()
-            TeslaStockData.objects.bulk_create(stock_data)
+            with connection.cursor() as cursor:
+                for chunk in chunks:
+                    self._copy_data(cursor, table, chunk)
+                    rows += len(chunk)
+                    self._report_progress(rows, started_at)
+                self._refresh_rollups(cursor)
+            DataVersion.bump(table)
+        return rows
 
     def handle(self, file_path, *args, **options):
         self._ensure_file_exists(file_path)
-        data = self._read_data(file_path)
-        self._save_data(data)
+        self.seed_dates: list[date] = []
+        chunks = self._read_data(file_path, options["chunk_size"], options["incremental"])
+        if options["incremental"]:
+            inserted, updated, unchanged = self._upsert_data(chunks)
+            self.stdout.write(
+                f"{inserted} rows inserted, {updated} rows updated, "
+                f"{unchanged} rows unchanged."
+            )
+        else:
+            self._save_data(chunks)
         self.stdout.write(self.style.SUCCESS("Data loaded successfully."))
@@ -0,0 +1,57 @@
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+def run_worker(stopped, burst: bool) -> None:
+    # Worker processes are spawned, Django is set up before the models are
+    # imported. The parent handles Ctrl+C and asks them to stop once their
+    # current job is done.
+    import django
+
+    django.setup()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from core.jobs import JobWorker
+
+    JobWorker(stopped).run(burst=burst)
+
+
+class Command(BaseCommand):
+    help = "Resolve the questions submitted as jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=settings.JOB_WORKERS,
+            help="Worker processes pulling jobs from the queue.",
+        )
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="Exit once the queue is empty.",
+        )
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context("spawn")
+        stopped = context.Event()
+
+        def stop(signum, frame):
+            self.stdout.write("Stopping the workers after their current job.")
+            stopped.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        workers = [
+            context.Process(target=run_worker, args=(stopped, options["burst"]))
+            for _ in range(options["processes"])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Started {len(workers)} job workers.")
+        for worker in workers:
+            worker.join()
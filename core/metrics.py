@@ -0,0 +1,236 @@
+import abc
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels.items()
+    )
+    return f"{{{values}}}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...]) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _get_key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def _render_samples(self) -> list[str]:
+        pass
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            lines.extend(self._render_samples())
+        return "\n".join(lines)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._get_key(labels), 0)
+
+    def _render_samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} "
+            f"{_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...],
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._get_key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts, _, _ = sample = self._values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def get(self, **labels) -> tuple[float, int]:
+        _, total, count = self._values.get(self._get_key(labels), (None, 0.0, 0))
+        return total, count
+
+    def _render_samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                lines.append(
+                    f"{self.name}_bucket{_format_labels({**labels, 'le': le})} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+stage_duration = Histogram(
+    "nl2sql_stage_duration_seconds",
+    "Time spent in each stage of resolving a question.",
+    ("model", "stage"),
+)
+ollama_tokens = Counter(
+    "nl2sql_ollama_tokens_total",
+    "Tokens evaluated by Ollama, prompt or completion.",
+    ("model", "kind"),
+)
+ollama_tokens_per_second = Histogram(
+    "nl2sql_ollama_tokens_per_second",
+    "Completion tokens generated per second.",
+    ("model",),
+    TOKENS_PER_SECOND_BUCKETS,
+)
+hedged_questions = Counter(
+    "nl2sql_hedged_questions_total",
+    "Questions also sent to the hedge model, by the model that answered.",
+    ("model", "winner"),
+)
+coalesced_requests = Counter(
+    "nl2sql_coalesced_requests_total",
+    "Requests that shared the answer of an identical request in flight.",
+    ("model",),
+)
+rejected_requests = Counter(
+    "nl2sql_rejected_requests_total",
+    "Generations rejected because the model queue was too long.",
+    ("model", "priority"),
+)
+template_sql_questions = Counter(
+    "nl2sql_template_sql_questions_total",
+    "Questions answered by a SQL template (hit) or sent to the model (miss).",
+    ("model", "result"),
+)
+prepared_statements = Counter(
+    "nl2sql_prepared_statements_total",
+    "Read queries by prepared statement lookup: hit, miss or unsupported shape.",
+    ("result",),
+)
+registry = [
+    stage_duration,
+    ollama_tokens,
+    ollama_tokens_per_second,
+    hedged_questions,
+    coalesced_requests,
+    rejected_requests,
+    template_sql_questions,
+    prepared_statements,
+]
+
+# Stage durations of the request being handled, in seconds.
+request_timings: contextvars.ContextVar[dict[str, float] | None] = (
+    contextvars.ContextVar("request_timings", default=None)
+)
+
+
+@contextlib.contextmanager
+def collect_timings():
+    timings: dict[str, float] = {}
+    token = request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        request_timings.reset(token)
+
+
+def record(stage: str, seconds: float, model: str) -> None:
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+    stage_duration.observe(seconds, model=model, stage=stage)
+
+
+@contextlib.contextmanager
+def timed(stage: str, model: str):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started_at, model)
+
+
+def record_ollama(model: str, response: dict) -> None:
+    # Ollama reports its durations in nanoseconds, older versions and
+    # unfinished stream chunks leave them out.
+    def get_count(key: str) -> int:
+        value = response.get(key)
+        return value if isinstance(value, int) else 0
+
+    for stage, key in (
+        ("ollama_load", "load_duration"),
+        ("ollama_prompt_eval", "prompt_eval_duration"),
+        ("ollama_eval", "eval_duration"),
+    ):
+        if get_count(key):
+            record(stage, get_count(key) / 1e9, model)
+
+    completion_tokens = get_count("eval_count")
+    ollama_tokens.inc(get_count("prompt_eval_count"), model=model, kind="prompt")
+    ollama_tokens.inc(completion_tokens, model=model, kind="completion")
+    if completion_tokens and get_count("eval_duration"):
+        ollama_tokens_per_second.observe(
+            completion_tokens / (get_count("eval_duration") / 1e9), model=model
+        )
+
+
+def format_server_timing(timings: dict[str, float], total: float) -> str:
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
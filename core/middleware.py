@@ -0,0 +1,130 @@
+import re
+import time
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+from core import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+re_accepts_brotli = re.compile(r"\bbr\b")
+re_accepts_gzip = re.compile(r"\bgzip\b")
+
+
+class ServerTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _add_header(self, response, timings: dict[str, float], started_at: float) -> None:
+        response["Server-Timing"] = metrics.format_server_timing(
+            timings, time.perf_counter() - started_at
+        )
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started_at = time.perf_counter()
+        with metrics.collect_timings() as timings:
+            response = self.get_response(request)
+        self._add_header(response, timings, started_at)
+        return response
+
+    async def __acall__(self, request):
+        started_at = time.perf_counter()
+        with metrics.collect_timings() as timings:
+            response = await self.get_response(request)
+        self._add_header(response, timings, started_at)
+        return response
+
+
+class StreamCompressor:
+    # Every chunk is flushed, streamed events must not wait for the next ones.
+
+    def __init__(self, encoding: str) -> None:
+        if encoding == "br":
+            self._compressor = brotli.Compressor()
+        else:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.encoding = encoding
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class CompressionMiddleware(GZipMiddleware):
+    # Brotli when the client accepts it and the package is installed, gzip
+    # otherwise.
+
+    def _get_encoding(self, request) -> str | None:
+        accept_encoding = request.META.get("HTTP_ACCEPT_ENCODING", "")
+        if brotli is not None and re_accepts_brotli.search(accept_encoding):
+            return "br"
+        if re_accepts_gzip.search(accept_encoding):
+            return "gzip"
+        return None
+
+    def _compress_stream(self, chunks, encoding: str):
+        compressor = StreamCompressor(encoding)
+        for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.finish()
+
+    async def _acompress_stream(self, chunks, encoding: str):
+        compressor = StreamCompressor(encoding)
+        async for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.finish()
+
+    def process_response(self, request, response):
+        if response.has_header("Content-Encoding") or (
+            not response.streaming and len(response.content) < 200
+        ):
+            return super().process_response(request, response)
+
+        encoding = self._get_encoding(request)
+        if not response.streaming and encoding != "br":
+            return super().process_response(request, response)
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if encoding is None:
+            return response
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = self._acompress_stream(
+                    response.streaming_content, encoding
+                )
+            else:
+                response.streaming_content = self._compress_stream(
+                    response.streaming_content, encoding
+                )
+            del response.headers["Content-Length"]
+        else:
+            compressed_content = brotli.compress(response.content)
+            if len(compressed_content) >= len(response.content):
+                return response
+            response.content = compressed_content
+            response.headers["Content-Length"] = str(len(response.content))
+
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = encoding
+        return response
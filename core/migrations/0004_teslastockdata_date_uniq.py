@@ -0,0 +1,17 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_dataversion'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='teslastockdata',
+            constraint=models.UniqueConstraint(fields=('date',), name='core_teslastockdata_date_uniq'),
+        ),
+    ]
@@ -0,0 +1,205 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_teslastockdata_date_uniq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeslaStockMonthly',
+            fields=[
+                ('period', models.DateField(primary_key=True, serialize=False)),
+                ('trading_days', models.IntegerField()),
+                ('first_open', models.FloatField()),
+                ('max_high', models.FloatField()),
+                ('min_low', models.FloatField()),
+                ('last_close', models.FloatField()),
+                ('total_volume', models.BigIntegerField()),
+                ('avg_close', models.FloatField()),
+                ('avg_rsi_7', models.FloatField()),
+                ('avg_rsi_14', models.FloatField()),
+                ('avg_cci_7', models.FloatField()),
+                ('avg_cci_14', models.FloatField()),
+                ('avg_sma_50', models.FloatField()),
+                ('avg_ema_50', models.FloatField()),
+                ('avg_sma_100', models.FloatField()),
+                ('avg_ema_100', models.FloatField()),
+                ('avg_macd', models.FloatField()),
+                ('avg_bollinger', models.FloatField()),
+                ('avg_truerange', models.FloatField()),
+                ('avg_atr_7', models.FloatField()),
+                ('avg_atr_14', models.FloatField()),
+            ],
+            options={
+                'db_table': 'core_teslastockdata_monthly',
+                'abstract': False,
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='TeslaStockWeekly',
+            fields=[
+                ('period', models.DateField(primary_key=True, serialize=False)),
+                ('trading_days', models.IntegerField()),
+                ('first_open', models.FloatField()),
+                ('max_high', models.FloatField()),
+                ('min_low', models.FloatField()),
+                ('last_close', models.FloatField()),
+                ('total_volume', models.BigIntegerField()),
+                ('avg_close', models.FloatField()),
+                ('avg_rsi_7', models.FloatField()),
+                ('avg_rsi_14', models.FloatField()),
+                ('avg_cci_7', models.FloatField()),
+                ('avg_cci_14', models.FloatField()),
+                ('avg_sma_50', models.FloatField()),
+                ('avg_ema_50', models.FloatField()),
+                ('avg_sma_100', models.FloatField()),
+                ('avg_ema_100', models.FloatField()),
+                ('avg_macd', models.FloatField()),
+                ('avg_bollinger', models.FloatField()),
+                ('avg_truerange', models.FloatField()),
+                ('avg_atr_7', models.FloatField()),
+                ('avg_atr_14', models.FloatField()),
+            ],
+            options={
+                'db_table': 'core_teslastockdata_weekly',
+                'abstract': False,
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='TeslaStockYearly',
+            fields=[
+                ('period', models.DateField(primary_key=True, serialize=False)),
+                ('trading_days', models.IntegerField()),
+                ('first_open', models.FloatField()),
+                ('max_high', models.FloatField()),
+                ('min_low', models.FloatField()),
+                ('last_close', models.FloatField()),
+                ('total_volume', models.BigIntegerField()),
+                ('avg_close', models.FloatField()),
+                ('avg_rsi_7', models.FloatField()),
+                ('avg_rsi_14', models.FloatField()),
+                ('avg_cci_7', models.FloatField()),
+                ('avg_cci_14', models.FloatField()),
+                ('avg_sma_50', models.FloatField()),
+                ('avg_ema_50', models.FloatField()),
+                ('avg_sma_100', models.FloatField()),
+                ('avg_ema_100', models.FloatField()),
+                ('avg_macd', models.FloatField()),
+                ('avg_bollinger', models.FloatField()),
+                ('avg_truerange', models.FloatField()),
+                ('avg_atr_7', models.FloatField()),
+                ('avg_atr_14', models.FloatField()),
+            ],
+            options={
+                'db_table': 'core_teslastockdata_yearly',
+                'abstract': False,
+                'managed': False,
+            },
+        ),
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE MATERIALIZED VIEW core_teslastockdata_weekly AS
+                SELECT
+                    date_trunc('week', date)::date AS period,
+                    count(*)::integer AS trading_days,
+                    (array_agg(open ORDER BY date))[1] AS first_open,
+                    max(high) AS max_high,
+                    min(low) AS min_low,
+                    (array_agg(close ORDER BY date DESC))[1] AS last_close,
+                    sum(volume)::bigint AS total_volume,
+                    avg(close) AS avg_close,
+                    avg(rsi_7) AS avg_rsi_7,
+                    avg(rsi_14) AS avg_rsi_14,
+                    avg(cci_7) AS avg_cci_7,
+                    avg(cci_14) AS avg_cci_14,
+                    avg(sma_50) AS avg_sma_50,
+                    avg(ema_50) AS avg_ema_50,
+                    avg(sma_100) AS avg_sma_100,
+                    avg(ema_100) AS avg_ema_100,
+                    avg(macd) AS avg_macd,
+                    avg(bollinger) AS avg_bollinger,
+                    avg("TrueRange") AS avg_truerange,
+                    avg(atr_7) AS avg_atr_7,
+                    avg(atr_14) AS avg_atr_14
+                FROM core_teslastockdata
+                GROUP BY 1
+                """,
+                "CREATE UNIQUE INDEX core_teslastockdata_weekly_period ON core_teslastockdata_weekly (period)",
+            ],
+            reverse_sql="DROP MATERIALIZED VIEW core_teslastockdata_weekly",
+        ),
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE MATERIALIZED VIEW core_teslastockdata_monthly AS
+                SELECT
+                    date_trunc('month', date)::date AS period,
+                    count(*)::integer AS trading_days,
+                    (array_agg(open ORDER BY date))[1] AS first_open,
+                    max(high) AS max_high,
+                    min(low) AS min_low,
+                    (array_agg(close ORDER BY date DESC))[1] AS last_close,
+                    sum(volume)::bigint AS total_volume,
+                    avg(close) AS avg_close,
+                    avg(rsi_7) AS avg_rsi_7,
+                    avg(rsi_14) AS avg_rsi_14,
+                    avg(cci_7) AS avg_cci_7,
+                    avg(cci_14) AS avg_cci_14,
+                    avg(sma_50) AS avg_sma_50,
+                    avg(ema_50) AS avg_ema_50,
+                    avg(sma_100) AS avg_sma_100,
+                    avg(ema_100) AS avg_ema_100,
+                    avg(macd) AS avg_macd,
+                    avg(bollinger) AS avg_bollinger,
+                    avg("TrueRange") AS avg_truerange,
+                    avg(atr_7) AS avg_atr_7,
+                    avg(atr_14) AS avg_atr_14
+                FROM core_teslastockdata
+                GROUP BY 1
+                """,
+                "CREATE UNIQUE INDEX core_teslastockdata_monthly_period ON core_teslastockdata_monthly (period)",
+            ],
+            reverse_sql="DROP MATERIALIZED VIEW core_teslastockdata_monthly",
+        ),
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE MATERIALIZED VIEW core_teslastockdata_yearly AS
+                SELECT
+                    date_trunc('year', date)::date AS period,
+                    count(*)::integer AS trading_days,
+                    (array_agg(open ORDER BY date))[1] AS first_open,
+                    max(high) AS max_high,
+                    min(low) AS min_low,
+                    (array_agg(close ORDER BY date DESC))[1] AS last_close,
+                    sum(volume)::bigint AS total_volume,
+                    avg(close) AS avg_close,
+                    avg(rsi_7) AS avg_rsi_7,
+                    avg(rsi_14) AS avg_rsi_14,
+                    avg(cci_7) AS avg_cci_7,
+                    avg(cci_14) AS avg_cci_14,
+                    avg(sma_50) AS avg_sma_50,
+                    avg(ema_50) AS avg_ema_50,
+                    avg(sma_100) AS avg_sma_100,
+                    avg(ema_100) AS avg_ema_100,
+                    avg(macd) AS avg_macd,
+                    avg(bollinger) AS avg_bollinger,
+                    avg("TrueRange") AS avg_truerange,
+                    avg(atr_7) AS avg_atr_7,
+                    avg(atr_14) AS avg_atr_14
+                FROM core_teslastockdata
+                GROUP BY 1
+                """,
+                "CREATE UNIQUE INDEX core_teslastockdata_yearly_period ON core_teslastockdata_yearly (period)",
+            ],
+            reverse_sql="DROP MATERIALIZED VIEW core_teslastockdata_yearly",
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_stock_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='TrueRange',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='atr_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='atr_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='bollinger',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='cci_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='cci_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='ema_100',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='ema_50',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='macd',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='next_day_close',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='rsi_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='rsi_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='sma_100',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockdata',
+            name='sma_50',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -0,0 +1,208 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_atr_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_atr_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_bollinger',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_cci_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_cci_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_ema_100',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_ema_50',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_macd',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_rsi_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_rsi_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_sma_100',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_sma_50',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockmonthly',
+            name='avg_truerange',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_atr_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_atr_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_bollinger',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_cci_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_cci_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_ema_100',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_ema_50',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_macd',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_rsi_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_rsi_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_sma_100',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_sma_50',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockweekly',
+            name='avg_truerange',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_atr_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_atr_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_bollinger',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_cci_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_cci_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_ema_100',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_ema_50',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_macd',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_rsi_14',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_rsi_7',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_sma_100',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_sma_50',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='teslastockyearly',
+            name='avg_truerange',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_stock_rollups_nullable_indicators'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
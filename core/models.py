@@ -1,4 +1,9 @@
-from django.db import models
+import uuid
+from datetime import timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.utils import timezone
 
 
 class TeslaStockData(models.Model):
@@ -8,20 +13,192 @@ class TeslaStockData(models.Model):
     low = models.FloatField()
     close = models.FloatField()
     volume = models.BigIntegerField()
-    rsi_7 = models.FloatField()
-    rsi_14 = models.FloatField()
-    cci_7 = models.FloatField()
-    cci_14 = models.FloatField()
-    sma_50 = models.FloatField()
-    ema_50 = models.FloatField()
-    sma_100 = models.FloatField()
-    ema_100 = models.FloatField()
-    macd = models.FloatField()
-    bollinger = models.FloatField()
-    TrueRange = models.FloatField()
-    atr_7 = models.FloatField()
-    atr_14 = models.FloatField()
-    next_day_close = models.FloatField()
+    rsi_7 = models.FloatField(null=True)
+    rsi_14 = models.FloatField(null=True)
+    cci_7 = models.FloatField(null=True)
+    cci_14 = models.FloatField(null=True)
+    sma_50 = models.FloatField(null=True)
+    ema_50 = models.FloatField(null=True)
+    sma_100 = models.FloatField(null=True)
+    ema_100 = models.FloatField(null=True)
+    macd = models.FloatField(null=True)
+    bollinger = models.FloatField(null=True)
+    TrueRange = models.FloatField(null=True)
+    atr_7 = models.FloatField(null=True)
+    atr_14 = models.FloatField(null=True)
+    next_day_close = models.FloatField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["date"], name="core_teslastockdata_date_uniq"),
+        ]
 
     def __str__(self):
         return f"{self.date} - {self.close}"
+
+
+class GeneratedSql(models.Model):
+    key = models.CharField(max_length=64, unique=True)
+    model = models.CharField(max_length=255)
+    question = models.TextField()
+    sql = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.model} - {self.question}"
+
+
+class DataVersion(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} - {self.version}"
+
+    @classmethod
+    def get_version(cls, name: str) -> int:
+        version = cls.objects.filter(name=name).values_list("version", flat=True).first()
+        return version or 0
+
+    @classmethod
+    def bump(cls, name: str) -> None:
+        cls.objects.get_or_create(name=name)
+        cls.objects.filter(name=name).update(version=models.F("version") + 1)
+
+
+class Job(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    question = models.TextField()
+    model = models.CharField(max_length=255)
+    columnar = models.BooleanField(default=False)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+    result = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    # Set when the job finishes, pending and running jobs never expire.
+    expires_at = models.DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["created_at"],
+                condition=models.Q(status="pending"),
+                name="core_job_pending",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.id} - {self.status}"
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.DONE, self.FAILED)
+
+    @classmethod
+    def claim(cls, timeout: float) -> "Job | None":
+        # Workers skip the jobs other workers are claiming, jobs running for
+        # longer than the timeout belong to a worker that died.
+        now = timezone.now()
+        with transaction.atomic():
+            job = (
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(
+                    models.Q(status=cls.PENDING)
+                    | models.Q(status=cls.RUNNING, started_at__lt=now - timedelta(seconds=timeout))
+                )
+                .order_by("created_at")
+                .first()
+            )
+            if job is not None:
+                job.status = cls.RUNNING
+                job.started_at = now
+                job.save(update_fields=["status", "started_at"])
+        return job
+
+    def finish(self, *, result: dict | None = None, error: str = "", ttl: float) -> bool:
+        # A job taken over by another worker is not overwritten.
+        now = timezone.now()
+        self.status = self.FAILED if error else self.DONE
+        self.result = result
+        self.error = error
+        self.finished_at = now
+        self.expires_at = now + timedelta(seconds=ttl)
+        return bool(
+            Job.objects.filter(id=self.id, started_at=self.started_at).update(
+                status=self.status,
+                result=result,
+                error=error,
+                finished_at=now,
+                expires_at=self.expires_at,
+            )
+        )
+
+
+class StockRollup(models.Model):
+    period = models.DateField(primary_key=True)
+    trading_days = models.IntegerField()
+    first_open = models.FloatField()
+    max_high = models.FloatField()
+    min_low = models.FloatField()
+    last_close = models.FloatField()
+    total_volume = models.BigIntegerField()
+    avg_close = models.FloatField()
+    avg_rsi_7 = models.FloatField(null=True)
+    avg_rsi_14 = models.FloatField(null=True)
+    avg_cci_7 = models.FloatField(null=True)
+    avg_cci_14 = models.FloatField(null=True)
+    avg_sma_50 = models.FloatField(null=True)
+    avg_ema_50 = models.FloatField(null=True)
+    avg_sma_100 = models.FloatField(null=True)
+    avg_ema_100 = models.FloatField(null=True)
+    avg_macd = models.FloatField(null=True)
+    avg_bollinger = models.FloatField(null=True)
+    avg_truerange = models.FloatField(null=True)
+    avg_atr_7 = models.FloatField(null=True)
+    avg_atr_14 = models.FloatField(null=True)
+
+    # Materialized views over TeslaStockData, created by the migrations and
+    # refreshed by load_data. A period with only warm-up rows averages to NULL.
+    class Meta:
+        abstract = True
+        managed = False
+
+    def __str__(self):
+        return f"{self.period} - {self.last_close}"
+
+
+class TeslaStockWeekly(StockRollup):
+    unit = "week"
+
+    class Meta(StockRollup.Meta):
+        db_table = "core_teslastockdata_weekly"
+
+
+class TeslaStockMonthly(StockRollup):
+    unit = "month"
+
+    class Meta(StockRollup.Meta):
+        db_table = "core_teslastockdata_monthly"
+
+
+class TeslaStockYearly(StockRollup):
+    unit = "year"
+
+    class Meta(StockRollup.Meta):
+        db_table = "core_teslastockdata_yearly"
+
+
+ROLLUP_MODELS = [TeslaStockWeekly, TeslaStockMonthly, TeslaStockYearly]
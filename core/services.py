@@ -1,27 +1,393 @@
 import abc
+import asyncio
+import contextlib
+import contextvars
+import functools
+import hashlib
+import heapq
+import itertools
+import logging
+import math
+import re
+import sqlite3
+import sys
+import threading
+import time
+import typing
+import weakref
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date
 
+import httpx
+import numpy as np
 import ollama
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db import connection, transaction
+from django.db import DatabaseError, close_old_connections, connection, models, transaction
 
+from core import metrics
+from core.models import ROLLUP_MODELS, DataVersion, GeneratedSql, TeslaStockData
 
-TABLE_SCHEMA = """
---
--- Create model TeslaStockData
---
-CREATE TABLE "core_teslastockdata" ("id" bigint NOT NULL PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY, "date" date NOT NULL, "open" double precision NOT NULL, "high" double precision NOT NULL, "low" double precision NOT NULL, "close" double precision NOT NULL, "volume" bigint NOT NULL, "rsi_7" double precision NOT NULL, "rsi_14" double precision NOT NULL, "cci_7" double precision NOT NULL, "cci_14" double precision NOT NULL, "sma_50" double precision NOT NULL, "ema_50" double precision NOT NULL, "sma_100" double precision NOT NULL, "ema_100" double precision NOT NULL, "macd" double precision NOT NULL, "bollinger" double precision NOT NULL, "TrueRange" double precision NOT NULL, "atr_7" double precision NOT NULL, "atr_14" double precision NOT NULL, "next_day_close" double precision NOT NULL);
-"""
+logger = logging.getLogger(__name__)
+sql_logger = logging.getLogger("core.sql")
 
 
 class CodeExecuted(Exception):
     pass
 
 
+database_executor = ThreadPoolExecutor(
+    max_workers=settings.ASYNC_DATABASE_THREADS, thread_name_prefix="database"
+)
+
+
+def _close_connections_after(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return wrapper
+
+
+async def run_in_database_executor(func, *args, **kwargs):
+    return await sync_to_async(
+        _close_connections_after(func),
+        thread_sensitive=False,
+        executor=database_executor,
+    )(*args, **kwargs)
+
+
+def normalize_question(query: str) -> str:
+    return " ".join(query.lower().split()).rstrip("?!. ")
+
+
+QUOTED_REGEX = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+READ_QUERY_REGEX = re.compile(r"^\s*\(?\s*(select|with|values|table)\b", re.IGNORECASE)
+
+VOLATILE_QUERY_REGEX = re.compile(
+    r"\b(now|random|nextval|clock_timestamp|current_date|current_time|"
+    r"current_timestamp|localtime|localtimestamp|timeofday)\b",
+    re.IGNORECASE,
+)
+
+
+def normalize_sql(sql: str) -> str:
+    parts = QUOTED_REGEX.split(sql)
+    # Odd parts are quoted literals or identifiers, keep them untouched.
+    parts[::2] = [re.sub(r"\s+", " ", part) for part in parts[::2]]
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def is_read_query(sql: str) -> bool:
+    return READ_QUERY_REGEX.match(sql) is not None
+
+
+def is_deterministic_read_query(sql: str) -> bool:
+    return is_read_query(sql) and not VOLATILE_QUERY_REGEX.search(
+        QUOTED_REGEX.sub("", sql)
+    )
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    # Concurrent calls with the same key wait for the first one and share
+    # its result or its exception.
+
+    class _Call:
+        def __init__(self) -> None:
+            self.done = threading.Event()
+            self.result = None
+            self.error: BaseException | None = None
+
+    def __init__(self) -> None:
+        self._calls: dict = {}
+        self._tasks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def do(self, key, func) -> tuple[typing.Any, bool]:
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if not shared:
+                call = self._calls[key] = self._Call()
+        if shared:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key, func) -> tuple[typing.Any, bool]:
+        # Tasks are bound to the event loop that created them. The work runs
+        # in its own task, a caller going away does not cancel it for the
+        # others.
+        loop = asyncio.get_running_loop()
+        tasks = self._tasks.setdefault(loop, {})
+        task = tasks.get(key)
+        shared = task is not None
+        if not shared:
+            task = tasks[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: tasks.pop(key, None))
+        return await asyncio.shield(task), shared
+
+    def __len__(self) -> int:
+        return len(self._calls) + sum(len(tasks) for tasks in self._tasks.values())
+
+
+resolve_flights = SingleFlight()
+
+
+def _get_ollama_client_options() -> dict:
+    return {
+        "host": settings.MODEL_SERVER_ENDPOINT,
+        "timeout": httpx.Timeout(
+            settings.OLLAMA_TIMEOUT, connect=settings.OLLAMA_CONNECT_TIMEOUT
+        ),
+        "limits": httpx.Limits(
+            max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+    }
+
+
+@functools.cache
+def get_ollama_client() -> ollama.Client:
+    return ollama.Client(**_get_ollama_client_options())
+
+
+async_ollama_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_async_ollama_client() -> ollama.AsyncClient:
+    # Async connection pools are bound to the event loop that opened them.
+    loop = asyncio.get_running_loop()
+    if loop not in async_ollama_clients:
+        async_ollama_clients[loop] = ollama.AsyncClient(**_get_ollama_client_options())
+    return async_ollama_clients[loop]
+
+
+class Prompt(typing.NamedTuple):
+    text: str
+    columns: list[str]
+    token_count: int
+
+
+class PromptBuilder:
+    model = TeslaStockData
+    template = (
+        "Given the following SQL table, "
+        "your job is to write queries given a user's request.\n"
+        "\n"
+        "{schema}\n"
+        "\n"
+        "Write a SQL query that returns - {query}\n"
+        "Response only with the SQL query with no other text."
+    )
+    column_types = {
+        "BigAutoField": "bigint",
+        "BigIntegerField": "bigint",
+        "DateField": "date",
+        "FloatField": "float",
+        "IntegerField": "integer",
+    }
+    required_columns = ["date"]
+    synonyms = {
+        "price": ["open", "high", "low", "close"],
+        "prices": ["open", "high", "low", "close"],
+        "ohlc": ["open", "high", "low", "close"],
+        "ohlcv": ["open", "high", "low", "close", "volume"],
+        "opening": ["open"],
+        "opened": ["open"],
+        "closing": ["close"],
+        "closed": ["close"],
+        "shares": ["volume"],
+        "traded": ["volume"],
+        "trading": ["volume"],
+        "rsi": ["rsi_7", "rsi_14"],
+        "relative strength": ["rsi_7", "rsi_14"],
+        "cci": ["cci_7", "cci_14"],
+        "commodity channel": ["cci_7", "cci_14"],
+        "sma": ["sma_50", "sma_100"],
+        "simple moving average": ["sma_50", "sma_100"],
+        "ema": ["ema_50", "ema_100"],
+        "exponential moving average": ["ema_50", "ema_100"],
+        "moving average": ["sma_50", "sma_100", "ema_50", "ema_100"],
+        "moving averages": ["sma_50", "sma_100", "ema_50", "ema_100"],
+        "band": ["bollinger"],
+        "bands": ["bollinger"],
+        "true range": ["TrueRange"],
+        "tr": ["TrueRange"],
+        "atr": ["atr_7", "atr_14"],
+        "average true range": ["atr_7", "atr_14"],
+        "volatility": ["TrueRange", "atr_7", "atr_14", "bollinger"],
+        "next day": ["close", "next_day_close"],
+        "tomorrow": ["close", "next_day_close"],
+        "indicator": [
+            "rsi_7", "rsi_14", "cci_7", "cci_14", "sma_50", "ema_50", "sma_100",
+            "ema_100", "macd", "bollinger", "TrueRange", "atr_7", "atr_14",
+        ],
+    }
+    synonyms["indicators"] = synonyms["indicator"]
+    rollup_units = {
+        "week": "week", "weeks": "week", "weekly": "week",
+        "month": "month", "months": "month", "monthly": "month",
+        "year": "year", "years": "year", "yearly": "year",
+        "annual": "year", "annually": "year",
+    }
+    rollup_comment = "-- Rollups with one row per week, month or year starting at period."
+    # Questions about whole records need every column.
+    all_columns_words = {"all", "every", "everything", "record", "records", "row", "rows"}
+    words_regex = re.compile(r"[a-z0-9_]+")
+    tokens_regex = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self) -> None:
+        self.fields = [
+            field
+            for field in self.model._meta.concrete_fields
+            if not field.primary_key
+        ]
+        self.index: dict[str, list[str]] = {}
+        for field in self.fields:
+            for name in {field.column, field.name}:
+                self.index[name.lower()] = [field.column]
+                self.index[name.lower().replace("_", " ")] = [field.column]
+        for words, columns in self.synonyms.items():
+            self.index.setdefault(words, [])
+            self.index[words] = [*self.index[words], *columns]
+
+    @staticmethod
+    def _quote(column: str) -> str:
+        return f'"{column}"' if column != column.lower() else column
+
+    def get_relevant_columns(self, query: str) -> list[str]:
+        words = self.words_regex.findall(query.lower())
+        if self.all_columns_words.intersection(words):
+            return [field.column for field in self.fields]
+
+        matched = set()
+        for size in range(1, 4):
+            for start in range(len(words) - size + 1):
+                matched.update(self.index.get(" ".join(words[start:start + size]), []))
+        if not matched:
+            return [field.column for field in self.fields]
+
+        matched.update(self.required_columns)
+        return [field.column for field in self.fields if field.column in matched]
+
+    def get_relevant_rollups(self, query: str) -> list[type[models.Model]]:
+        words = self.words_regex.findall(query.lower())
+        units = {self.rollup_units[word] for word in words if word in self.rollup_units}
+        return [rollup for rollup in ROLLUP_MODELS if rollup.unit in units]
+
+    def get_rollup_columns(self, rollup: type[models.Model], columns: list[str]) -> list[str]:
+        # Rollup columns are named after the aggregate and the daily column,
+        # such as last_close or avg_rsi_14.
+        matched = {column.lower() for column in columns}
+        return [
+            field.column
+            for field in rollup._meta.concrete_fields
+            if field.column in ("period", "trading_days")
+            or field.column.split("_", 1)[1] in matched
+        ]
+
+    def get_schema(
+        self, columns: list[str], model: type[models.Model] | None = None
+    ) -> str:
+        model = model or self.model
+        types = {
+            field.column: self.column_types.get(field.get_internal_type(), "text")
+            for field in model._meta.concrete_fields
+        }
+        definitions = ", ".join(
+            f"{self._quote(column)} {types[column]}" for column in columns
+        )
+        return f"CREATE TABLE {model._meta.db_table} ({definitions});"
+
+    def count_tokens(self, text: str) -> int:
+        # Close enough to the model tokenizers to compare prompt sizes.
+        return len(self.tokens_regex.findall(text))
+
+    @functools.cached_property
+    def version(self) -> str:
+        # The template and the schema of every column, what the model sees
+        # besides the question.
+        return hashlib.sha256(self.build("").text.encode()).hexdigest()[:16]
+
+    def build(self, query: str) -> Prompt:
+        columns = self.get_relevant_columns(query)
+        schema = [self.get_schema(columns)]
+        rollups = self.get_relevant_rollups(query)
+        if rollups:
+            schema.append(self.rollup_comment)
+            schema.extend(
+                self.get_schema(self.get_rollup_columns(rollup, columns), rollup)
+                for rollup in rollups
+            )
+        text = self.template.format(schema="\n".join(schema), query=query)
+        return Prompt(text=text, columns=columns, token_count=self.count_tokens(text))
+
+
 class AbstractSqlGenerator(abc.ABC):
     @abc.abstractmethod
     def generate_sql(self, query: str) -> str:
         pass
 
+    def stream_sql(self, query: str) -> Iterator[str]:
+        yield self.generate_sql(query)
+
+    async def agenerate_sql(self, query: str) -> str:
+        return await sync_to_async(self.generate_sql, thread_sensitive=False)(query)
+
 
 class DummySqlGenerator(AbstractSqlGenerator):
     def generate_sql(self, query: str) -> str:
@@ -35,63 +401,1659 @@ class DummySqlGenerator(AbstractSqlGenerator):
 
 class OllamaSqlGenerator(AbstractSqlGenerator):
 
-    def __init__(self, model) -> None:
+    def __init__(
+        self,
+        model,
+        client: ollama.Client | None = None,
+        prompt_builder: PromptBuilder | None = None,
+    ) -> None:
         super().__init__()
         self.model = model
-        self.ollama = ollama.Client(host=settings.MODEL_SERVER_ENDPOINT)
+        self.ollama = get_ollama_client() if client is None else client
+        self.prompt_builder = PromptBuilder() if prompt_builder is None else prompt_builder
 
-    def _chat(self, message: str) -> str:
-        response = self.ollama.chat(
-            model=self.model,
-            options={
+    def _get_chat_arguments(self, message: str) -> dict:
+        return {
+            "model": self.model,
+            "options": {
                 "seed": 123,
                 "temperature": 0
             },
-            messages=[
+            "messages": [
                 {
                     "role": "user",
                     "content": message,
                 },
             ],
-        )
+            "keep_alive": settings.OLLAMA_KEEP_ALIVE,
+        }
+
+    def _get_slot(self):
+        if not settings.SCHEDULER_ENABLED or self.model in held_slots.get():
+            return contextlib.nullcontext()
+        return get_model_scheduler(self.model).slot()
+
+    def _chat(self, message: str) -> str:
+        with self._get_slot():
+            response = self.ollama.chat(**self._get_chat_arguments(message))
+        metrics.record_ollama(self.model, response)
         return response["message"]["content"]
 
-    def _get_message(self, query: str) -> str:
-        return f"""Given the following SQL table,
-            your job is to write queries given a user's request.
+    def _chat_stream(self, message: str) -> Iterator[str]:
+        with self._get_slot():
+            for chunk in self.ollama.chat(**self._get_chat_arguments(message), stream=True):
+                if chunk.get("done"):
+                    metrics.record_ollama(self.model, chunk)
+                yield chunk["message"]["content"]
+
+    @staticmethod
+    def _clean_sql(sql: str) -> str:
+        return sql.replace("\n", " ").replace("\\", "")
 
-            {TABLE_SCHEMA}
+    def _get_message(self, query: str) -> str:
+        prompt = self.prompt_builder.build(query)
+        logger.info(
+            "Prompt with %d tokens and %d of %d columns.",
+            prompt.token_count,
+            len(prompt.columns),
+            len(self.prompt_builder.fields),
+        )
+        return prompt.text
 
-            Write a SQL query that returns - {query}
-            response only with the SQL query with no other text.
-            """
+    @property
+    def prompt_version(self) -> str:
+        return self.prompt_builder.version
 
     def generate_sql(self, query: str) -> str:
         message = self._get_message(query)
-        sql = self._chat(message).replace("\n", " ").replace("\\", "")
-        print(sql)
+        sql = self._clean_sql(self._chat(message))
+        logger.debug("Generated SQL: %s", sql)
+        return sql
+
+    def stream_sql(self, query: str) -> Iterator[str]:
+        message = self._get_message(query)
+        for token in self._chat_stream(message):
+            yield self._clean_sql(token)
+
+
+class AsyncOllamaSqlGenerator(OllamaSqlGenerator):
+
+    async def _achat(self, message: str) -> str:
+        async_ollama = get_async_ollama_client()
+        if settings.SCHEDULER_ENABLED and self.model not in held_slots.get():
+            async with get_model_scheduler(self.model).aslot():
+                response = await async_ollama.chat(**self._get_chat_arguments(message))
+        else:
+            response = await async_ollama.chat(**self._get_chat_arguments(message))
+        metrics.record_ollama(self.model, response)
+        return response["message"]["content"]
+
+    async def agenerate_sql(self, query: str) -> str:
+        message = self._get_message(query)
+        sql = self._clean_sql(await self._achat(message))
+        logger.debug("Generated SQL: %s", sql)
+        return sql
+
+
+sql_cache = LRUCache(maxsize=settings.SQL_CACHE_SIZE, ttl=settings.SQL_CACHE_TTL)
+
+
+class CachedSqlGenerator(AbstractSqlGenerator):
+    def __init__(
+        self,
+        sql_generator: AbstractSqlGenerator,
+        *,
+        model: str,
+        cache: LRUCache | None = None,
+        persistent: bool | None = None,
+    ) -> None:
+        super().__init__()
+        self.sql_generator = sql_generator
+        self.model = model
+        self.cache = sql_cache if cache is None else cache
+        if persistent is None:
+            persistent = settings.SQL_CACHE_PERSISTENT
+        self.persistent = persistent
+
+    def _get_key(self, query: str) -> str:
+        prompt_version = getattr(self.sql_generator, "prompt_version", "")
+        raw = "\x1f".join([self.model, prompt_version, normalize_question(query)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _get(self, key: str) -> str | None:
+        sql = self.cache.get(key)
+        if sql is None and self.persistent:
+            sql = (
+                GeneratedSql.objects.filter(key=key)
+                .values_list("sql", flat=True)
+                .first()
+            )
+            if sql is not None:
+                self.cache.set(key, sql)
+        return sql
+
+    def _set(self, key: str, query: str, sql: str) -> None:
+        if self.persistent:
+            GeneratedSql.objects.update_or_create(
+                key=key,
+                defaults={"model": self.model, "question": query, "sql": sql},
+            )
+        self.cache.set(key, sql)
+
+    def generate_sql(self, query: str) -> str:
+        key = self._get_key(query)
+        sql = self._get(key)
+        if sql is None:
+            sql = self.sql_generator.generate_sql(query)
+            self._set(key, query, sql)
         return sql
 
+    async def agenerate_sql(self, query: str) -> str:
+        key = self._get_key(query)
+        sql = self.cache.get(key)
+        if sql is None and self.persistent:
+            sql = await run_in_database_executor(self._get, key)
+        if sql is None:
+            sql = await self.sql_generator.agenerate_sql(query)
+            if self.persistent:
+                await run_in_database_executor(self._set, key, query, sql)
+            else:
+                self.cache.set(key, sql)
+        return sql
+
+    def stream_sql(self, query: str) -> Iterator[str]:
+        key = self._get_key(query)
+        sql = self._get(key)
+        if sql is not None:
+            yield sql
+            return
+
+        tokens = []
+        for token in self.sql_generator.stream_sql(query):
+            tokens.append(token)
+            yield token
+        self._set(key, query, "".join(tokens))
+
+
+class AbstractEmbedder(abc.ABC):
+    @abc.abstractmethod
+    def embed(self, text: str) -> np.ndarray:
+        pass
+
+
+class OllamaEmbedder(AbstractEmbedder):
+
+    def __init__(self, model: str, client: ollama.Client | None = None) -> None:
+        super().__init__()
+        self.model = model
+        self.ollama = get_ollama_client() if client is None else client
+
+    def embed(self, text: str) -> np.ndarray:
+        response = self.ollama.embeddings(
+            model=self.model, prompt=text, keep_alive=settings.OLLAMA_KEEP_ALIVE
+        )
+        return np.asarray(response["embedding"], dtype=np.float32)
+
+
+class VectorIndex:
+    def __init__(self, capacity: int, initial_capacity: int = 64) -> None:
+        self.capacity = capacity
+        self.initial_capacity = min(initial_capacity, capacity)
+        self._vectors: np.ndarray | None = None
+        self._values: list = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def add(self, vector, value) -> None:
+        vector = self._normalize(vector)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros(
+                    (self.initial_capacity, vector.shape[0]), dtype=np.float32
+                )
+            if len(self._values) < self.capacity:
+                if len(self._values) == self._vectors.shape[0]:
+                    grown = np.zeros(
+                        (min(self.capacity, 2 * len(self._values)), vector.shape[0]),
+                        dtype=np.float32,
+                    )
+                    grown[: len(self._values)] = self._vectors
+                    self._vectors = grown
+                self._values.append(None)
+            self._vectors[self._next] = vector
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+
+    def search(self, vector, k: int = 1) -> list[tuple[float, object]]:
+        vector = self._normalize(vector)
+        with self._lock:
+            size = len(self._values)
+            if not size:
+                return []
+            scores = self._vectors[:size] @ vector
+            k = min(k, size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(float(scores[i]), self._values[i]) for i in top]
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+
+semantic_indexes: dict[tuple[str, str], VectorIndex] = {}
+
+
+class SemanticCachedSqlGenerator(AbstractSqlGenerator):
+    literals_regex = re.compile(r"\d+(?:[.:/-]\d+)*")
+
+    def __init__(
+        self,
+        sql_generator: AbstractSqlGenerator,
+        *,
+        model: str,
+        embedder: AbstractEmbedder | None = None,
+        index: VectorIndex | None = None,
+        threshold: float | None = None,
+        top_k: int = 3,
+    ) -> None:
+        super().__init__()
+        self.sql_generator = sql_generator
+        self.model = model
+        if embedder is None:
+            embedder = OllamaEmbedder(
+                model=settings.SEMANTIC_CACHE_EMBEDDING_MODEL or model
+            )
+        self.embedder = embedder
+        if index is None:
+            index = semantic_indexes.setdefault(
+                (model, self.prompt_version),
+                VectorIndex(capacity=settings.SEMANTIC_CACHE_SIZE),
+            )
+        self.index = index
+        if threshold is None:
+            threshold = settings.SEMANTIC_CACHE_THRESHOLD
+        self.threshold = threshold
+        self.top_k = top_k
+
+    @property
+    def prompt_version(self) -> str:
+        return getattr(self.sql_generator, "prompt_version", "")
+
+    def _get_literals(self, query: str) -> list[str]:
+        return sorted(self.literals_regex.findall(query))
+
+    def _search(self, query: str) -> tuple[np.ndarray | None, list[str], str | None]:
+        normalized_query = normalize_question(query)
+        literals = self._get_literals(normalized_query)
+        # The cache is optional, the question still goes to the model when
+        # the embedder is down.
+        try:
+            vector = self.embedder.embed(normalized_query)
+        except Exception as e:
+            logger.warning("Semantic cache lookup failed: %s", e)
+            return None, literals, None
+        for score, (cached_literals, sql) in self.index.search(vector, k=self.top_k):
+            if score < self.threshold:
+                break
+            # Paraphrases asking about other dates or limits embed almost
+            # identically, so their literals must match too.
+            if cached_literals == literals:
+                return vector, literals, sql
+        return vector, literals, None
+
+    def generate_sql(self, query: str) -> str:
+        vector, literals, sql = self._search(query)
+        if sql is None:
+            sql = self.sql_generator.generate_sql(query)
+            if vector is not None:
+                self.index.add(vector, (literals, sql))
+        return sql
+
+    async def agenerate_sql(self, query: str) -> str:
+        search = sync_to_async(self._search, thread_sensitive=False)
+        vector, literals, sql = await search(query)
+        if sql is None:
+            sql = await self.sql_generator.agenerate_sql(query)
+            if vector is not None:
+                self.index.add(vector, (literals, sql))
+        return sql
+
+    def stream_sql(self, query: str) -> Iterator[str]:
+        vector, literals, sql = self._search(query)
+        if sql is not None:
+            yield sql
+            return
+
+        tokens = []
+        for token in self.sql_generator.stream_sql(query):
+            tokens.append(token)
+            yield token
+        if vector is not None:
+            self.index.add(vector, (literals, "".join(tokens)))
+
+
+class TemplateSqlGenerator(AbstractSqlGenerator):
+    # Common question shapes are answered without the model. A question must
+    # match a whole pattern, with known columns and valid dates, anything else
+    # goes to the wrapped generator.
+    synonyms = {
+        "opening": "open",
+        "closing": "close",
+        "shares traded": "volume",
+        "traded volume": "volume",
+        "trading volume": "volume",
+        "true range": "TrueRange",
+        "tr": "TrueRange",
+        "bollinger band": "bollinger",
+        "bollinger bands": "bollinger",
+        "next day close": "next_day_close",
+    }
+    aggregates = {
+        "highest": "max", "max": "max", "maximum": "max", "top": "max",
+        "lowest": "min", "min": "min", "minimum": "min",
+        "average": "avg", "avg": "avg", "mean": "avg",
+        "total": "sum", "sum of": "sum",
+    }
+    # Rollup columns are named total_volume rather than sum_volume.
+    rollup_prefixes = {"max": "max", "min": "min", "avg": "avg", "sum": "total"}
+    units = {
+        "week": "week", "weekly": "week",
+        "month": "month", "monthly": "month",
+        "year": "year", "yearly": "year",
+    }
+    # Indicator names that read like an aggregate of a column.
+    ambiguous_regex = re.compile(r"\baverage true range\b")
+    prefix = r"^(?:(?:what|which) (?:was|is|were|are) |show(?: me)? |give me |get )?(?:the )?"
+
+    def __init__(self, sql_generator: AbstractSqlGenerator, *, model: str) -> None:
+        super().__init__()
+        self.sql_generator = sql_generator
+        self.model = model
+        self.table = TeslaStockData._meta.db_table
+        self.columns: dict[str, str] = {}
+        for field in TeslaStockData._meta.concrete_fields:
+            if field.primary_key or field.column == "date":
+                continue
+            name = field.column.lower()
+            for alias in {name, name.replace("_", " "), name.replace("_", "")}:
+                self.columns[alias] = field.column
+        self.columns.update(self.synonyms)
+
+        column = r"(?P<column>{})(?: price| value)?".format(
+            "|".join(re.escape(alias) for alias in sorted(self.columns, key=len, reverse=True))
+        )
+        aggregate = r"(?P<aggregate>{})".format(
+            "|".join(re.escape(word) for word in sorted(self.aggregates, key=len, reverse=True))
+        )
+        day = r"\d{4}[-/]\d{2}[-/]\d{2}"
+        unit = r"(?P<unit>{})".format("|".join(self.units))
+        self.intents = [
+            (
+                "value_on_date",
+                re.compile(rf"{self.prefix}{column} (?:on|for|at) (?P<day>{day})$"),
+                self._value_on_date,
+            ),
+            (
+                "date_range",
+                re.compile(
+                    rf"{self.prefix}{column} (?:from|between) (?P<start>{day}) "
+                    rf"(?:to|and|until) (?P<end>{day})$"
+                ),
+                self._date_range,
+            ),
+            (
+                "latest",
+                re.compile(
+                    rf"{self.prefix}(?P<position>latest|last|most recent|current|first|earliest|oldest) "
+                    rf"{column}$"
+                ),
+                self._latest,
+            ),
+            (
+                "aggregate",
+                re.compile(
+                    rf"{self.prefix}{aggregate} {column}"
+                    rf"(?: (?:in|during|for|of) (?P<year>(?:19|20)\d{{2}}))?$"
+                ),
+                self._aggregate,
+            ),
+            (
+                "aggregate_per_period",
+                re.compile(rf"{self.prefix}{aggregate} {column} (?:per|by|each|every) {unit}$"),
+                self._aggregate_per_period,
+            ),
+        ]
+
+    @property
+    def prompt_version(self) -> str:
+        return getattr(self.sql_generator, "prompt_version", "")
+
+    @staticmethod
+    def _parse_date(value: str) -> date:
+        return date.fromisoformat(value.replace("/", "-"))
+
+    def _column(self, match: re.Match) -> str:
+        return PromptBuilder._quote(self.columns[match["column"]])
+
+    def _value_on_date(self, match: re.Match) -> str:
+        day = self._parse_date(match["day"])
+        return f"SELECT date, {self._column(match)} FROM {self.table} WHERE date = '{day}'"
+
+    def _date_range(self, match: re.Match) -> str:
+        start, end = self._parse_date(match["start"]), self._parse_date(match["end"])
+        return (
+            f"SELECT date, {self._column(match)} FROM {self.table} "
+            f"WHERE date BETWEEN '{min(start, end)}' AND '{max(start, end)}' ORDER BY date"
+        )
+
+    def _latest(self, match: re.Match) -> str:
+        column = self._column(match)
+        order = "ASC" if match["position"] in ("first", "earliest", "oldest") else "DESC"
+        return (
+            f"SELECT date, {column} FROM {self.table} "
+            f"WHERE {column} IS NOT NULL ORDER BY date {order} LIMIT 1"
+        )
+
+    def _aggregate(self, match: re.Match) -> str:
+        function = self.aggregates[match["aggregate"]]
+        column = self.columns[match["column"]]
+        sql = (
+            f"SELECT {function.upper()}({PromptBuilder._quote(column)}) "
+            f"AS {function}_{column.lower()} FROM {self.table}"
+        )
+        if match["year"]:
+            year = int(match["year"])
+            sql += f" WHERE date BETWEEN '{year}-01-01' AND '{year}-12-31'"
+        return sql
+
+    def _aggregate_per_period(self, match: re.Match) -> str:
+        function = self.aggregates[match["aggregate"]]
+        column = self.columns[match["column"]]
+        unit = self.units[match["unit"]]
+        rollup_column = f"{self.rollup_prefixes[function]}_{column.lower()}"
+        for rollup in ROLLUP_MODELS:
+            if rollup.unit == unit and any(
+                field.column == rollup_column for field in rollup._meta.concrete_fields
+            ):
+                return (
+                    f"SELECT period AS {unit}, {rollup_column} "
+                    f"FROM {rollup._meta.db_table} ORDER BY period"
+                )
+        return (
+            f"SELECT date_trunc('{unit}', date)::date AS {unit}, "
+            f"{function.upper()}({PromptBuilder._quote(column)}) AS {function}_{column.lower()} "
+            f"FROM {self.table} GROUP BY 1 ORDER BY 1"
+        )
+
+    def match(self, query: str) -> str | None:
+        query = normalize_question(query)
+        sql = None
+        if not self.ambiguous_regex.search(query):
+            for intent, regex, build in self.intents:
+                match = regex.match(query)
+                if match is None:
+                    continue
+                try:
+                    sql = build(match)
+                except ValueError:
+                    # Dates such as 2021-02-30.
+                    continue
+                logger.debug("Question answered by the %s template.", intent)
+                break
+        metrics.template_sql_questions.inc(
+            model=self.model, result="hit" if sql is not None else "miss"
+        )
+        return sql
+
+    def generate_sql(self, query: str) -> str:
+        sql = self.match(query)
+        if sql is None:
+            sql = self.sql_generator.generate_sql(query)
+        return sql
+
+    async def agenerate_sql(self, query: str) -> str:
+        sql = self.match(query)
+        if sql is None:
+            sql = await self.sql_generator.agenerate_sql(query)
+        return sql
+
+    def stream_sql(self, query: str) -> Iterator[str]:
+        sql = self.match(query)
+        if sql is not None:
+            yield sql
+            return
+        yield from self.sql_generator.stream_sql(query)
+
+
+def build_sql_generator(model: str, asynchronous: bool = False) -> AbstractSqlGenerator:
+    ollama_generator = AsyncOllamaSqlGenerator if asynchronous else OllamaSqlGenerator
+    sql_generator: AbstractSqlGenerator = ollama_generator(model=model)
+    # Only the model calls are hedged, the answers of the hedge model are
+    # cached as answers of this one.
+    hedge_model = get_hedge_model(model) if settings.HEDGE_ENABLED else None
+    if hedge_model is not None:
+        sql_generator = HedgedSqlGenerator(
+            sql_generator,
+            ollama_generator(model=hedge_model),
+            model=model,
+            hedge_model=hedge_model,
+        )
+    if settings.SEMANTIC_CACHE_ENABLED:
+        sql_generator = SemanticCachedSqlGenerator(sql_generator, model=model)
+    if settings.SQL_CACHE_ENABLED:
+        sql_generator = CachedSqlGenerator(sql_generator, model=model)
+    if settings.TEMPLATE_SQL_ENABLED:
+        sql_generator = TemplateSqlGenerator(sql_generator, model=model)
+    return sql_generator
+
+
+sql_generators: dict[tuple[str, bool], AbstractSqlGenerator] = {}
+
+sql_generators_lock = threading.Lock()
+
+
+def get_sql_generator(model: str, asynchronous: bool = False) -> AbstractSqlGenerator:
+    key = (model, asynchronous)
+    with sql_generators_lock:
+        if key not in sql_generators:
+            sql_generators[key] = build_sql_generator(model, asynchronous=asynchronous)
+        return sql_generators[key]
+
+
+def is_valid_sql(sql: str) -> bool:
+    # EXPLAIN parses and plans the statement without running it, several
+    # statements would run all but the first one.
+    sql = normalize_sql(sql).rstrip(";")
+    if not sql or ";" in sql:
+        return False
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('statement_timeout', %s, true)",
+                [str(settings.QUERY_STATEMENT_TIMEOUT)],
+            )
+            cursor.execute(f"EXPLAIN {sql}")
+    except DatabaseError:
+        return False
+    return True
+
+
+class LatencyTracker:
+    def __init__(self, size: int = 100, min_samples: int = 10) -> None:
+        self.min_samples = min_samples
+        self._latencies: deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+
+
+model_latencies: dict[str, LatencyTracker] = {}
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_API = 1
+PRIORITY_BATCH = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_API: "api", PRIORITY_BATCH: "batch"}
+
+request_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "request_priority", default=PRIORITY_API
+)
+
+
+# Models whose slot is held by the caller, e.g. for the life of a stream.
+held_slots: contextvars.ContextVar[frozenset[str]] = contextvars.ContextVar(
+    "held_slots", default=frozenset()
+)
+
+
+@contextlib.contextmanager
+def priority(value: int):
+    token = request_priority.set(value)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class ModelOverloaded(Exception):
+    def __init__(self, model: str, retry_after: float) -> None:
+        super().__init__(f"Model {model} is overloaded, retry in {retry_after:.0f}s.")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, loop: asyncio.AbstractEventLoop | None = None) -> None:
+        self.granted = False
+        self.event = threading.Event()
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+    def grant(self) -> None:
+        self.granted = True
+        self.event.set()
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(self._resolve_future)
+
+    def _resolve_future(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class ModelScheduler:
+    # At most `concurrency` generations run at once, the others wait by
+    # priority then arrival. Requests whose estimated wait exceeds `max_wait`
+    # are rejected right away instead of timing out in the queue.
+
+    def __init__(
+        self,
+        model: str,
+        *,
+        concurrency: int,
+        max_queue: int,
+        max_wait: float,
+        durations: LatencyTracker | None = None,
+    ) -> None:
+        self.model = model
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.durations = LatencyTracker() if durations is None else durations
+        self.active = 0
+        self._queue: list[tuple[int, int, _Waiter]] = []
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _get_duration(self) -> float:
+        duration = self.durations.percentile(0.5)
+        return settings.SCHEDULER_INITIAL_DURATION if duration is None else duration
+
+    def estimate_wait(self, priority: int) -> float:
+        with self._lock:
+            return self._estimate_wait(priority)
+
+    def _estimate_wait(self, priority: int) -> float:
+        if self.active < self.concurrency and not self._queue:
+            return 0.0
+        ahead = sum(1 for entry in self._queue if entry[0] <= priority)
+        return (ahead // self.concurrency + 1) * self._get_duration()
+
+    def _reject(self, priority: int, wait: float) -> ModelOverloaded:
+        metrics.rejected_requests.inc(model=self.model, priority=PRIORITY_NAMES[priority])
+        return ModelOverloaded(self.model, max(1.0, math.ceil(wait)))
+
+    def check(self, priority: int) -> None:
+        with self._lock:
+            wait = self._estimate_wait(priority)
+            if len(self._queue) >= self.max_queue or wait > self.max_wait:
+                raise self._reject(priority, wait)
+
+    def _enqueue(self, priority: int, loop: asyncio.AbstractEventLoop | None = None) -> _Waiter:
+        waiter = _Waiter(loop)
+        with self._lock:
+            if self.active < self.concurrency and not self._queue:
+                self.active += 1
+                waiter.granted = True
+                return waiter
+            wait = self._estimate_wait(priority)
+            if len(self._queue) >= self.max_queue or wait > self.max_wait:
+                raise self._reject(priority, wait)
+            self._counter += 1
+            heapq.heappush(self._queue, (priority, self._counter, waiter))
+        return waiter
+
+    def _cancel(self, waiter: _Waiter) -> bool:
+        with self._lock:
+            if waiter.granted:
+                return False
+            self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+            heapq.heapify(self._queue)
+            return True
+
+    def _release(self) -> None:
+        with self._lock:
+            if self._queue:
+                # The slot goes straight to the next waiter.
+                heapq.heappop(self._queue)[2].grant()
+            else:
+                self.active -= 1
+
+    def _record(self, queued_at: float, started_at: float) -> None:
+        metrics.record("queue", started_at - queued_at, self.model)
+        self.durations.add(time.monotonic() - started_at)
+
+    @contextlib.contextmanager
+    def slot(self):
+        priority = request_priority.get()
+        queued_at = time.monotonic()
+        waiter = self._enqueue(priority)
+        if not waiter.granted and not waiter.event.wait(self.max_wait):
+            if self._cancel(waiter):
+                raise self._reject(priority, time.monotonic() - queued_at)
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self._record(queued_at, started_at)
+            self._release()
+
+    @contextlib.contextmanager
+    def hold(self):
+        # Generations of the model within are run in this slot.
+        with self.slot():
+            token = held_slots.set(held_slots.get() | {self.model})
+            try:
+                yield
+            finally:
+                held_slots.reset(token)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self):
+        priority = request_priority.get()
+        queued_at = time.monotonic()
+        waiter = self._enqueue(priority, asyncio.get_running_loop())
+        if not waiter.granted:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+            except asyncio.TimeoutError:
+                if self._cancel(waiter):
+                    raise self._reject(priority, time.monotonic() - queued_at)
+            except asyncio.CancelledError:
+                # Granted while being cancelled, the slot must be passed on.
+                if not self._cancel(waiter):
+                    self._release()
+                raise
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self._record(queued_at, started_at)
+            self._release()
+
+
+model_schedulers: dict[str, ModelScheduler] = {}
+
+model_schedulers_lock = threading.Lock()
+
+
+def get_model_scheduler(model: str) -> ModelScheduler:
+    with model_schedulers_lock:
+        if model not in model_schedulers:
+            model_schedulers[model] = ModelScheduler(
+                model,
+                concurrency=settings.SCHEDULER_CONCURRENCY,
+                max_queue=settings.SCHEDULER_MAX_QUEUE,
+                max_wait=settings.SCHEDULER_MAX_WAIT,
+            )
+        return model_schedulers[model]
+
+
+def get_hedge_model(model: str) -> str | None:
+    hedge_model = settings.HEDGE_MODEL
+    if not hedge_model:
+        models = settings.AVAILABLE_MODELS
+        hedge_model = models[(models.index(model) + 1) % len(models)]
+    return None if hedge_model == model else hedge_model
+
+
+class HedgedSqlGenerator(AbstractSqlGenerator):
+    def __init__(
+        self,
+        sql_generator: AbstractSqlGenerator,
+        hedge_generator: AbstractSqlGenerator,
+        *,
+        model: str,
+        hedge_model: str,
+        latencies: LatencyTracker | None = None,
+    ) -> None:
+        super().__init__()
+        self.sql_generator = sql_generator
+        self.hedge_generator = hedge_generator
+        self.model = model
+        self.hedge_model = hedge_model
+        if latencies is None:
+            latencies = model_latencies.setdefault(model, LatencyTracker())
+        self.latencies = latencies
+
+    @property
+    def prompt_version(self) -> str:
+        return getattr(self.sql_generator, "prompt_version", "")
+
+    def get_delay(self) -> float:
+        if settings.HEDGE_DELAY is not None:
+            return settings.HEDGE_DELAY
+        delay = self.latencies.percentile(settings.HEDGE_PERCENTILE)
+        return settings.HEDGE_INITIAL_DELAY if delay is None else delay
+
+    def _generate(self, sql_generator: AbstractSqlGenerator, query: str) -> tuple[str, bool]:
+        started_at = time.monotonic()
+        sql = sql_generator.generate_sql(query)
+        if sql_generator is self.sql_generator:
+            self.latencies.add(time.monotonic() - started_at)
+        return sql, is_valid_sql(sql)
+
+    async def _agenerate(
+        self, sql_generator: AbstractSqlGenerator, query: str
+    ) -> tuple[str, bool]:
+        started_at = time.monotonic()
+        try:
+            sql = await sql_generator.agenerate_sql(query)
+        except asyncio.CancelledError:
+            # A cancelled primary would have taken at least this long.
+            if sql_generator is self.sql_generator:
+                self.latencies.add(time.monotonic() - started_at)
+            raise
+        if sql_generator is self.sql_generator:
+            self.latencies.add(time.monotonic() - started_at)
+        return sql, await run_in_database_executor(is_valid_sql, sql)
+
+    def _get_result(self, results: list[tuple[str, str | None, Exception | None]]) -> str:
+        # Nothing valid, the primary SQL fails the same way it would have
+        # without hedging. The hedge only answers when the primary failed.
+        results = sorted(results, key=lambda result: result[0] != self.model)
+        for _, sql, error in results:
+            if error is None:
+                return sql
+        raise results[0][2]
+
+    def _record_winner(self, winner: str, hedged: bool) -> None:
+        if hedged:
+            logger.info("Hedged question of %s answered by %s.", self.model, winner)
+            metrics.hedged_questions.inc(model=self.model, winner=winner)
+
+    def generate_sql(self, query: str) -> str:
+        # The thread of the losing model can not be interrupted, it finishes
+        # in the background and its answer is dropped.
+        pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hedge")
+        generate = _close_connections_after(self._generate)
+        # Each thread runs in a copy of the context, with the request priority
+        # and timings.
+        futures = {
+            pool.submit(contextvars.copy_context().run, generate, self.sql_generator, query): (
+                self.model
+            )
+        }
+        results = []
+        timeout = self.get_delay()
+        try:
+            while futures:
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    model = futures.pop(future)
+                    try:
+                        sql, valid = future.result()
+                    except Exception as e:
+                        results.append((model, None, e))
+                        continue
+                    if valid:
+                        self._record_winner(model, timeout is None)
+                        return sql
+                    results.append((model, sql, None))
+                # Hedge once the delay is over or as soon as the primary
+                # model failed.
+                if timeout is not None and (not done or not futures):
+                    future = pool.submit(
+                        contextvars.copy_context().run, generate, self.hedge_generator, query
+                    )
+                    futures[future] = self.hedge_model
+                    timeout = None
+            return self._get_result(results)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    async def agenerate_sql(self, query: str) -> str:
+        tasks = {
+            asyncio.ensure_future(self._agenerate(self.sql_generator, query)): self.model
+        }
+        results = []
+        timeout = self.get_delay()
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    model = tasks.pop(task)
+                    try:
+                        sql, valid = task.result()
+                    except Exception as e:
+                        results.append((model, None, e))
+                        continue
+                    if valid:
+                        self._record_winner(model, timeout is None)
+                        return sql
+                    results.append((model, sql, None))
+                if timeout is not None and (not done or not tasks):
+                    task = asyncio.ensure_future(self._agenerate(self.hedge_generator, query))
+                    tasks[task] = self.hedge_model
+                    timeout = None
+            return self._get_result(results)
+        finally:
+            # Cancelling closes the request, Ollama stops generating.
+            for task in tasks:
+                task.cancel()
+
+    def stream_sql(self, query: str) -> Iterator[str]:
+        # Tokens can not be taken back once streamed, there is nothing to hedge.
+        return self.sql_generator.stream_sql(query)
+
+
+class QueryResult(list):
+    truncated = False
+
+
+class QueryRows(list):
+    truncated = False
+
+    def __init__(self, columns: typing.Iterable[str] = (), rows: typing.Iterable = ()) -> None:
+        super().__init__(rows)
+        self.columns = list(columns)
+
+    def as_dicts(self) -> QueryResult:
+        data = QueryResult(dict(zip(self.columns, row)) for row in self)
+        data.truncated = self.truncated
+        return data
+
 
 class AbstractQueryExecutor(abc.ABC):
     @abc.abstractmethod
     def execute(self, sql: str) -> list[dict]:
         pass
 
+    def execute_rows(self, sql: str) -> QueryRows:
+        data = self.execute(sql)
+        rows = QueryRows(data[0] if data else (), (tuple(row.values()) for row in data))
+        rows.truncated = getattr(data, "truncated", False)
+        return rows
+
+    def execute_iter(self, sql: str, batch_size: int) -> Iterator[list[dict]]:
+        data = self.execute(sql)
+        for start in range(0, len(data), batch_size):
+            yield data[start:start + batch_size]
+
+
+# Numbers and strings compared or computed with, the only literals replaced by
+# parameters. ORDER BY 1, numeric(10, 2) or DATE '2021-01-01' need constants.
+NUMBER_REGEX = re.compile(
+    r"(?<![\w.$])(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?(?![\w.])", re.IGNORECASE
+)
+
+NUMBER_CONTEXT_REGEX = re.compile(
+    r"(?:[=<>*/+-]|\b(?:limit|offset|between|and))\s*$", re.IGNORECASE
+)
+
+STRING_CONTEXT_REGEX = re.compile(
+    r"(?:[=<>,(]|\b(?:like|ilike|between|and|in|then|else))\s*$", re.IGNORECASE
+)
+
+
+def _get_number_type(literal: str) -> str:
+    # The type Postgres gives the literal itself.
+    if not literal.isdigit():
+        return "numeric"
+    if int(literal) < 2**31:
+        return "integer"
+    return "bigint" if int(literal) < 2**63 else "numeric"
+
+
+def parameterize_sql(sql: str) -> tuple[str, list[str], list[str]] | None:
+    # Returns the shape of the query with $n parameters, the literals and the
+    # parameter types. Strings are left unknown so that Postgres infers their
+    # type from where they are used, as it does for the literals.
+    parts = QUOTED_REGEX.split(normalize_sql(sql))
+    if any("$" in part or ";" in part for part in parts[::2]):
+        return None
+
+    values: list[str] = []
+    types: list[str] = []
+    placeholders: dict[tuple[str, str], str] = {}
+
+    def add(literal: str, type: str) -> str:
+        # Repeated literals share their parameter, GROUP BY date_trunc('month',
+        # date) must be the same expression as the one selected.
+        if (literal, type) not in placeholders:
+            values.append(literal)
+            types.append(type)
+            placeholders[literal, type] = f"${len(values)}"
+        return placeholders[literal, type]
+
+    shape = []
+    for i, part in enumerate(parts):
+        if i % 2:
+            if part.startswith("'") and STRING_CONTEXT_REGEX.search(parts[i - 1]):
+                part = add(part, "unknown")
+        else:
+            part = NUMBER_REGEX.sub(
+                lambda match, part=part: (
+                    add(match[0], _get_number_type(match[0]))
+                    if NUMBER_CONTEXT_REGEX.search(part[: match.start()])
+                    else match[0]
+                ),
+                part,
+            )
+        shape.append(part)
+    return "".join(shape), values, types
+
+
+class PreparedStatements:
+    # Server-side prepared statements of each thread's connection, by query
+    # shape. Statements live as long as the connection, the cache starts over
+    # with a new one. Shapes Postgres can not prepare are remembered as None.
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._names = itertools.count(1)
+
+    def _get_statements(self) -> OrderedDict:
+        if getattr(self._local, "connection", None) is not connection.connection:
+            self._local.connection = connection.connection
+            self._local.statements = OrderedDict()
+        return self._local.statements
+
+    def prepare(self, cursor, shape: str, types: list[str]) -> str | None:
+        statements = self._get_statements()
+        if shape in statements:
+            statements.move_to_end(shape)
+            name = statements[shape]
+            metrics.prepared_statements.inc(result="hit" if name else "unsupported")
+            return name
+
+        name = f"nl2sql_{next(self._names)}"
+        try:
+            with transaction.atomic():
+                cursor.execute(f"PREPARE {name}({', '.join(types)}) AS {shape}")
+        except DatabaseError as e:
+            logger.debug("Query shape not prepared: %s", e)
+            name = None
+        statements[shape] = name
+        while len(statements) > self.maxsize:
+            _, evicted = statements.popitem(last=False)
+            if evicted is not None:
+                cursor.execute(f"DEALLOCATE {evicted}")
+        metrics.prepared_statements.inc(result="miss" if name else "unsupported")
+        return name
+
+    def discard(self, shape: str) -> None:
+        name = self._get_statements().pop(shape, None)
+        if name is not None:
+            with connection.cursor() as cursor:
+                cursor.execute(f"DEALLOCATE {name}")
+
+    def clear(self) -> None:
+        # Forgotten statements stay on the server until the connection closes.
+        self._local = threading.local()
+
+    def __len__(self) -> int:
+        return len(self._get_statements())
+
+
+prepared_statements = PreparedStatements(maxsize=settings.PREPARED_STATEMENTS_SIZE)
+
 
 class DjangoQueryExecutor(AbstractQueryExecutor):
-    def execute(self, sql: str) -> list[dict]:
-        data = []
+    def _configure(self, cursor) -> None:
+        cursor.execute(
+            "SELECT set_config('statement_timeout', %s, true),"
+            " set_config('work_mem', %s, true)",
+            [str(settings.QUERY_STATEMENT_TIMEOUT), settings.QUERY_WORK_MEM],
+        )
+
+    def _iter_batches(
+        self, sql: str, batch_size: int, max_rows: int | None = None
+    ) -> Iterator[tuple[list[str], list[tuple]]]:
         with transaction.atomic():
             try:
                 with connection.cursor() as cursor:
+                    self._configure(cursor)
+
+                # Server-side cursors only accept SELECT or VALUES statements.
+                read_query = is_read_query(sql)
+                if read_query:
+                    cursor = connection.chunked_cursor()
+                else:
+                    cursor = connection.cursor()
+                with cursor:
                     cursor.execute(sql)
-                    if cursor.description is not None:
-                        columns = [col[0] for col in cursor.description]
-                        data = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                    if read_query or cursor.description is not None:
+                        columns = None
+                        fetched = 0
+                        while max_rows is None or fetched < max_rows:
+                            if max_rows is not None:
+                                batch_size = min(batch_size, max_rows - fetched)
+                            rows = cursor.fetchmany(batch_size)
+                            # Server-side cursors describe their columns only
+                            # after the first fetch.
+                            first = columns is None
+                            if first:
+                                columns = [col[0] for col in cursor.description]
+                            if not rows:
+                                # An empty result still tells its columns.
+                                if first:
+                                    yield columns, rows
+                                break
+                            fetched += len(rows)
+                            yield columns, rows
                     raise CodeExecuted()
             except CodeExecuted:
-                return data
+                return
+
+    def _execute_prepared(self, sql: str, max_rows: int) -> QueryRows | None:
+        parameterized = parameterize_sql(sql)
+        if parameterized is None:
+            return None
+        shape, values, types = parameterized
+        # The limit is a parameter too, the shape stays the same whatever
+        # QUERY_MAX_ROWS is.
+        shape = f"SELECT * FROM ({shape}) AS query LIMIT ${len(values) + 1}"
+        values, types = [*values, str(max_rows)], [*types, "bigint"]
+
+        data = None
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                self._configure(cursor)
+                name = prepared_statements.prepare(cursor, shape, types)
+                if name is not None:
+                    cursor.execute(f"EXECUTE {name}({', '.join(values)})")
+                    rows = cursor.fetchall()
+                    data = QueryRows([col[0] for col in cursor.description], rows)
+                raise CodeExecuted()
+        except CodeExecuted:
+            return data
+        except DatabaseError as e:
+            # Postgres refuses to run a statement whose columns changed with
+            # the tables, it is prepared again next time.
+            if getattr(e.__cause__, "pgcode", None) != "0A000":
+                raise
+            prepared_statements.discard(shape)
+            return None
+
+    def execute_rows(self, sql: str) -> QueryRows:
+        max_rows = settings.QUERY_MAX_ROWS
+        data = None
+        # One extra row tells whether the result was truncated.
+        if settings.PREPARED_STATEMENTS_ENABLED and is_read_query(sql):
+            data = self._execute_prepared(sql, max_rows + 1)
+        if data is None:
+            data = QueryRows()
+            for columns, rows in self._iter_batches(
+                sql, settings.QUERY_FETCH_SIZE, max_rows + 1
+            ):
+                data.columns = columns
+                data.extend(rows)
+        if len(data) > max_rows:
+            del data[max_rows:]
+            data.truncated = True
+        return data
+
+    def execute(self, sql: str) -> list[dict]:
+        return self.execute_rows(sql).as_dicts()
+
+    def execute_iter(self, sql: str, batch_size: int) -> Iterator[list[dict]]:
+        for columns, rows in self._iter_batches(sql, batch_size):
+            if rows:
+                yield [dict(zip(columns, row)) for row in rows]
+
+
+class DataVersionChecker:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._version = 0
+        self._checked_at: float | None = None
+        self._lock = threading.Lock()
+
+    def get_version(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            if (
+                self._checked_at is None
+                or now - self._checked_at >= settings.DATA_VERSION_CHECK_INTERVAL
+            ):
+                self._version = DataVersion.get_version(self.name)
+                self._checked_at = now
+            return self._version
+
+
+stock_data_version = DataVersionChecker(TeslaStockData._meta.db_table)
+
+
+class ResultCache:
+    def __init__(
+        self, *, max_bytes: int, max_entry_bytes: int, max_entry_rows: int
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_entry_rows = max_entry_rows
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+        self.version: int | None = None
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _estimate_size(rows: list) -> int:
+        size = sys.getsizeof(rows)
+        for row in rows:
+            values = row.values() if isinstance(row, dict) else row
+            size += sys.getsizeof(row) + sum(map(sys.getsizeof, values))
+        return size
+
+    def get(self, key) -> list | None:
+        with self._lock:
+            try:
+                size, rows = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return rows
+
+    def set(self, key, rows: list) -> bool:
+        if len(rows) > self.max_entry_rows:
+            self.rejections += 1
+            return False
+        size = self._estimate_size(rows)
+        if size > min(self.max_entry_bytes, self.max_bytes):
+            self.rejections += 1
+            return False
+
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[0]
+            self._data[key] = (size, rows)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self._data.popitem(last=False)[1][0]
+                self.evictions += 1
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def set_version(self, version: int) -> None:
+        # Entries of older data versions can never be hit again.
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "rejections": self.rejections,
+        }
+
+
+result_cache = ResultCache(
+    max_bytes=settings.RESULT_CACHE_MAX_BYTES,
+    max_entry_bytes=settings.RESULT_CACHE_MAX_ENTRY_BYTES,
+    max_entry_rows=settings.RESULT_CACHE_MAX_ENTRY_ROWS,
+)
+
+
+class CachedQueryExecutor(AbstractQueryExecutor):
+    def __init__(
+        self,
+        query_executor: AbstractQueryExecutor,
+        *,
+        cache: ResultCache | None = None,
+        data_version: DataVersionChecker | None = None,
+    ) -> None:
+        super().__init__()
+        self.query_executor = query_executor
+        self.cache = result_cache if cache is None else cache
+        self.data_version = stock_data_version if data_version is None else data_version
+
+    def _execute_cached(self, sql: str, execute, key_suffix: tuple = ()) -> list:
+        if not is_deterministic_read_query(sql):
+            return execute(sql)
+
+        version = self.data_version.get_version()
+        self.cache.set_version(version)
+        # Rows as tuples are cached apart from the same rows as dicts.
+        key = (version, normalize_sql(sql), *key_suffix)
+        rows = self.cache.get(key)
+        if rows is None:
+            rows = execute(sql)
+            self.cache.set(key, rows)
+        return rows
+
+    def execute(self, sql: str) -> list[dict]:
+        return self._execute_cached(sql, self.query_executor.execute)
+
+    def execute_rows(self, sql: str) -> QueryRows:
+        return self._execute_cached(sql, self.query_executor.execute_rows, ("rows",))
+
+    def execute_iter(self, sql: str, batch_size: int) -> Iterator[list[dict]]:
+        if not is_deterministic_read_query(sql):
+            yield from self.query_executor.execute_iter(sql, batch_size)
+            return
+
+        version = self.data_version.get_version()
+        self.cache.set_version(version)
+        # Streamed rows are not capped at QUERY_MAX_ROWS, execute() must not
+        # get them.
+        key = (version, normalize_sql(sql), "stream")
+        rows = self.cache.get(key)
+        if rows is not None:
+            for start in range(0, len(rows), batch_size):
+                yield rows[start:start + batch_size]
+            return
+
+        rows = []
+        for batch in self.query_executor.execute_iter(sql, batch_size):
+            if rows is not None:
+                rows.extend(batch)
+                if len(rows) > self.cache.max_entry_rows:
+                    rows = None
+            yield batch
+        if rows is not None:
+            self.cache.set(key, rows)
+
+
+class SqliteSnapshot:
+    column_types = {
+        "BigAutoField": "INTEGER",
+        "BigIntegerField": "INTEGER",
+        "IntegerField": "INTEGER",
+        "DateField": "DATE",
+        "FloatField": "REAL",
+    }
+    order_by_regex = re.compile(
+        r"\bORDER\s+BY\b(.*?)(?=\bLIMIT\b|\bOFFSET\b|\bFETCH\b|\)|;|$)",
+        re.IGNORECASE | re.DOTALL,
+    )
+    order_term_regex = re.compile(
+        r'\s*(?:(?P<column>\w+)|"(?P<quoted>\w+)")(?:\s+(?:ASC|DESC))?'
+        r"(?P<nulls>\s+NULLS\s+(?:FIRST|LAST))?\s*",
+        re.IGNORECASE,
+    )
+    date_literal_regex = re.compile(r"'\d{4}-\d{2}-\d{2}'")
+    # SQLite stores dates as ISO text, these would compute on the text.
+    date_function_regex = re.compile(
+        r"\b(?:cast|date|time|datetime|julianday|strftime|unixepoch|extract|"
+        r"date_part|date_trunc|to_char|to_date|age|interval)\s*\(|::",
+        re.IGNORECASE,
+    )
+    aggregate_regex = re.compile(r"\b(?:sum|avg)\s*\(", re.IGNORECASE)
+    builds = itertools.count()
+
+    def __init__(
+        self,
+        snapshot_models: list[type[models.Model]],
+        *,
+        data_version: DataVersionChecker | None = None,
+    ) -> None:
+        self.models = snapshot_models
+        self.data_version = stock_data_version if data_version is None else data_version
+        self.version: int | None = None
+        self.not_null_columns = {
+            field.column
+            for model in snapshot_models
+            for field in model._meta.concrete_fields
+            if not field.null
+        }
+        fields = [field for model in snapshot_models for field in model._meta.concrete_fields]
+        self.date_columns = {
+            field.column for field in fields if field.get_internal_type() == "DateField"
+        }
+        # Postgres sums and averages integers as numeric, returned as Decimal.
+        self.integer_columns = {
+            field.column
+            for field in fields
+            if field.get_internal_type() in ("BigAutoField", "BigIntegerField", "IntegerField")
+        }
+        columns_regex = "|".join(sorted(self.date_columns))
+        self.date_arithmetic_regex = re.compile(
+            rf'(?:\b(?:{columns_regex})"?\s*[-+])|(?:[-+]\s*"?(?:{columns_regex})\b)',
+            re.IGNORECASE,
+        )
+        # The snapshot is a shared in-memory database kept alive by this
+        # connection, every thread reads it through its own connection.
+        self._connection: sqlite3.Connection | None = None
+        self._uri: str | None = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _copy_model(self, cursor, snapshot: sqlite3.Connection, model) -> None:
+        quote_name = connection.ops.quote_name
+        fields = model._meta.concrete_fields
+        columns = ", ".join(quote_name(field.column) for field in fields)
+        definitions = ", ".join(
+            f"{quote_name(field.column)} {self.column_types[field.get_internal_type()]}"
+            for field in fields
+        )
+        table = quote_name(model._meta.db_table)
+        snapshot.execute(f"CREATE TABLE {table} ({definitions})")
+        cursor.execute(f"SELECT {columns} FROM {table}")
+        insert = f"INSERT INTO {table} VALUES ({', '.join('?' * len(fields))})"
+        while rows := cursor.fetchmany(settings.QUERY_FETCH_SIZE):
+            snapshot.executemany(
+                insert,
+                [
+                    [value.isoformat() if isinstance(value, date) else value for value in row]
+                    for row in rows
+                ],
+            )
+
+    def _build(self, uri: str) -> sqlite3.Connection:
+        snapshot = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        in_transaction = connection.in_atomic_block
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not in_transaction:
+                # Every table is read from the same committed load.
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            for model in self.models:
+                self._copy_model(cursor, snapshot, model)
+        snapshot.commit()
+        return snapshot
+
+    @staticmethod
+    def _has_postgres_names(sql: str, columns: list[str]) -> bool:
+        # SQLite names unaliased expressions after their text and keeps the
+        # case of unquoted identifiers, Postgres does neither.
+        return all(
+            re.fullmatch(r"\w+", column)
+            and (column == column.lower() or f'"{column}"' in sql)
+            for column in columns
+        )
+
+    def _has_postgres_order(self, sql: str) -> bool:
+        # SQLite sorts NULLs first, Postgres last. Only columns without NULLs
+        # or terms with an explicit NULLS FIRST/LAST sort the same way.
+        for clause in self.order_by_regex.findall(sql):
+            for term in clause.split(","):
+                match = self.order_term_regex.fullmatch(term)
+                if match is None:
+                    return False
+                column = match["quoted"] or (match["column"] or "").lower()
+                if not match["nulls"] and column not in self.not_null_columns:
+                    return False
+        return True
+
+    def _has_postgres_dates(self, sql: str) -> bool:
+        # Only ISO dates compare the same as text and as dates.
+        parts = QUOTED_REGEX.split(sql)
+        for literal in parts[1::2]:
+            if not literal.startswith("'"):
+                continue
+            if not self.date_literal_regex.fullmatch(literal):
+                return False
+            try:
+                date.fromisoformat(literal[1:-1])
+            except ValueError:
+                return False
+        unquoted = " ".join(parts[::2])
+        return not (
+            self.date_function_regex.search(unquoted)
+            or self.date_arithmetic_regex.search(unquoted)
+        )
+
+    def _has_postgres_types(self, sql: str) -> bool:
+        for match in self.aggregate_regex.finditer(sql):
+            depth, end = 1, match.end()
+            while depth and end < len(sql):
+                depth += {"(": 1, ")": -1}.get(sql[end], 0)
+                end += 1
+            words = re.findall(r"\w+", sql[match.end():end])
+            if any(word.lower() in self.integer_columns for word in words):
+                return False
+        return True
+
+    def _get_uri(self) -> str:
+        version = self.data_version.get_version()
+        with self._lock:
+            if self._connection is None or self.version != version:
+                started_at = time.monotonic()
+                if self._connection is not None:
+                    self._connection.close()
+                self._uri = f"file:snapshot{next(self.builds)}?mode=memory&cache=shared"
+                self._connection = self._build(self._uri)
+                self.version = version
+                logger.info(
+                    "Snapshot of data version %s built in %.3fs.",
+                    version,
+                    time.monotonic() - started_at,
+                )
+            return self._uri
+
+    def _get_connection(self) -> sqlite3.Connection:
+        uri = self._get_uri()
+        if getattr(self._local, "uri", None) != uri:
+            if getattr(self._local, "connection", None) is not None:
+                self._local.connection.close()
+            snapshot = sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES)
+            snapshot.execute("PRAGMA query_only = ON")
+            self._local.connection, self._local.uri = snapshot, uri
+        return self._local.connection
+
+    def execute_rows(self, sql: str, max_rows: int | None = None) -> QueryRows:
+        if not self._has_postgres_order(sql):
+            raise sqlite3.NotSupportedError("NULLs are sorted differently from Postgres")
+        if not self._has_postgres_dates(sql):
+            raise sqlite3.NotSupportedError("Dates are compared differently from Postgres")
+        if not self._has_postgres_types(sql):
+            raise sqlite3.NotSupportedError("Aggregates are typed differently from Postgres")
+        snapshot = self._get_connection()
+        deadline = time.monotonic() + settings.QUERY_STATEMENT_TIMEOUT / 1000
+        snapshot.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        try:
+            cursor = snapshot.execute(sql)
+            columns = [col[0] for col in cursor.description or []]
+            if not self._has_postgres_names(sql, columns):
+                raise sqlite3.NotSupportedError("Column names differ from Postgres")
+            if max_rows is None:
+                rows = cursor.fetchall()
+            else:
+                rows = cursor.fetchmany(max_rows + 1)
+            cursor.close()
+        except sqlite3.OperationalError:
+            if time.monotonic() > deadline:
+                raise TimeoutError("canceling statement due to statement timeout")
+            raise
+        finally:
+            snapshot.set_progress_handler(None, 0)
+
+        data = QueryRows(columns, rows)
+        if max_rows is not None and len(data) > max_rows:
+            del data[max_rows:]
+            data.truncated = True
+        return data
+
+    def execute(self, sql: str, max_rows: int | None = None) -> QueryResult:
+        return self.execute_rows(sql, max_rows).as_dicts()
+
+    def close(self) -> None:
+        # Connections of other threads are closed when they next read.
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = self._uri = None
+            self.version = None
+        if getattr(self._local, "connection", None) is not None:
+            self._local.connection.close()
+            self._local.connection = self._local.uri = None
+
+
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+stock_data_snapshot = SqliteSnapshot([TeslaStockData, *ROLLUP_MODELS])
+
+
+class SqliteSnapshotExecutor(AbstractQueryExecutor):
+    def __init__(
+        self,
+        query_executor: AbstractQueryExecutor,
+        *,
+        snapshot: SqliteSnapshot | None = None,
+    ) -> None:
+        super().__init__()
+        self.query_executor = query_executor
+        self.snapshot = stock_data_snapshot if snapshot is None else snapshot
+
+    def _execute_snapshot(self, sql: str, max_rows: int | None) -> QueryRows | None:
+        if not is_deterministic_read_query(sql):
+            return None
+        # The generated SQL targets Postgres, anything SQLite can not run goes
+        # there instead.
+        try:
+            return self.snapshot.execute_rows(sql, max_rows)
+        except sqlite3.Error as e:
+            logger.debug("Falling back to the database for %r: %s", sql, e)
+            return None
+
+    def execute(self, sql: str) -> list[dict]:
+        data = self._execute_snapshot(sql, settings.QUERY_MAX_ROWS)
+        if data is None:
+            return self.query_executor.execute(sql)
+        return data.as_dicts()
+
+    def execute_rows(self, sql: str) -> QueryRows:
+        data = self._execute_snapshot(sql, settings.QUERY_MAX_ROWS)
+        if data is None:
+            return self.query_executor.execute_rows(sql)
+        return data
+
+    def execute_iter(self, sql: str, batch_size: int) -> Iterator[list[dict]]:
+        data = self._execute_snapshot(sql, None)
+        if data is None:
+            yield from self.query_executor.execute_iter(sql, batch_size)
+            return
+        data = data.as_dicts()
+        for start in range(0, len(data), batch_size):
+            yield data[start:start + batch_size]
+
+
+def build_query_executor() -> AbstractQueryExecutor:
+    query_executor: AbstractQueryExecutor = DjangoQueryExecutor()
+    if settings.SNAPSHOT_EXECUTOR_ENABLED:
+        query_executor = SqliteSnapshotExecutor(query_executor)
+    if settings.RESULT_CACHE_ENABLED:
+        query_executor = CachedQueryExecutor(query_executor)
+    return query_executor
 
 
 class QueryResolver:
@@ -103,28 +2065,206 @@ class QueryResolver:
         *,
         model: str | None = None,
         sql_generator: AbstractSqlGenerator | None = None,
-        query_executor: AbstractQueryExecutor | None = None
+        query_executor: AbstractQueryExecutor | None = None,
+        asynchronous: bool = False,
     ) -> None:
         if model is None:
             model = settings.AVAILABLE_MODELS[0]
         assert model in settings.AVAILABLE_MODELS, f"Invalid model: {model}"
+        self.model = model
 
         if sql_generator is None:
-            self.sql_generator = OllamaSqlGenerator(model=model)
+            self.sql_generator = get_sql_generator(model, asynchronous=asynchronous)
         else:
             self.sql_generator = sql_generator
 
         if query_executor is None:
-            self.query_executor = DjangoQueryExecutor()
+            self.query_executor = build_query_executor()
         else:
             self.query_executor = query_executor
+        # Default executors are built per resolver but all run the same way.
+        self._query_executor_key = None if query_executor is None else id(query_executor)
+
+    def resolve_stream(self, query: str) -> Iterator[dict]:
+        tokens = []
+        # Time spent by the client reading the events is included. The headers
+        # are sent by now, errors can only be events.
+        try:
+            with metrics.timed("generate", self.model):
+                for token in self.sql_generator.stream_sql(query):
+                    tokens.append(token)
+                    yield {"event": "token", "data": token}
+        except Exception as e:
+            yield {"event": "error", "data": str(e)}
+            yield {"event": "end"}
+            return
+        sql = "".join(tokens)
+        self._log_sql(sql)
+        yield {"event": "sql", "data": sql}
+        try:
+            with metrics.timed("execute", self.model):
+                for rows in self.query_executor.execute_iter(
+                    sql, settings.STREAM_BATCH_SIZE
+                ):
+                    yield {"event": "rows", "data": rows}
+        except Exception as e:
+            yield {"event": "error", "data": str(e)}
+        yield {"event": "end"}
+
+    def _log_sql(self, sql: str) -> None:
+        # One statement per line, advise_indexes reads the log line by line.
+        sql_logger.info("%s", " ".join(sql.split()))
 
-    def resolve(self, query: str) -> dict:
-        sql = self.sql_generator.generate_sql(query)
+    def _get_response(
+        self, query: str, sql: str, rows: list[dict] | None, error: Exception | None
+    ) -> dict:
         response = {"query": query}
         response["attempted_query"] = sql
+        if error is not None:
+            response["error"] = str(error)
+        else:
+            if isinstance(rows, QueryRows):
+                response["columns"] = rows.columns
+                response["rows"] = rows
+            else:
+                response["response"] = rows
+            if isinstance(rows, (QueryResult, QueryRows)) and rows.truncated:
+                response["truncated"] = True
+        return response
+
+    def _get_flight_key(self, query: str, columnar: bool) -> tuple:
+        # Resolvers only share answers with resolvers of the same generator
+        # and executor, a flight keeps both alive so their ids stay unique.
+        return (
+            self.model,
+            id(self.sql_generator),
+            self._query_executor_key,
+            normalize_question(query),
+            columnar,
+        )
+
+    @contextlib.contextmanager
+    def _generation_lock(self, query: str):
+        # Identical questions of other processes wait here, the persistent
+        # SQL cache then has the SQL generated by the first one.
+        if not settings.SINGLE_FLIGHT_ADVISORY_LOCK:
+            yield
+            return
+        key = "\x1f".join(["generate_sql", self.model, normalize_question(query)])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(hashtextextended(%s, 0))", [key])
+            try:
+                yield
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(hashtextextended(%s, 0))", [key])
+
+    def resolve(self, query: str, *, columnar: bool = False) -> dict:
+        if not settings.SINGLE_FLIGHT_ENABLED:
+            return self._resolve(query, columnar)
+        response, shared = resolve_flights.do(
+            self._get_flight_key(query, columnar),
+            lambda: self._resolve(query, columnar),
+        )
+        if shared:
+            metrics.coalesced_requests.inc(model=self.model)
+        # Callers get their own response, only the rows are shared.
+        return {**response, "query": query}
+
+    async def aresolve(self, query: str, *, columnar: bool = False) -> dict:
+        if not settings.SINGLE_FLIGHT_ENABLED:
+            return await self._aresolve(query, columnar)
+        response, shared = await resolve_flights.ado(
+            self._get_flight_key(query, columnar),
+            lambda: self._aresolve(query, columnar),
+        )
+        if shared:
+            metrics.coalesced_requests.inc(model=self.model)
+        return {**response, "query": query}
+
+    def _resolve(self, query: str, columnar: bool) -> dict:
+        with metrics.timed("generate", self.model), self._generation_lock(query):
+            sql = self.sql_generator.generate_sql(query)
+        self._log_sql(sql)
+        rows, error = None, None
         try:
-            response["response"] = self.query_executor.execute(sql)
+            with metrics.timed("execute", self.model):
+                if columnar:
+                    rows = self.query_executor.execute_rows(sql)
+                else:
+                    rows = self.query_executor.execute(sql)
         except Exception as e:
-            response["error"] = str(e)
-        return response
+            error = e
+        return self._get_response(query, sql, rows, error)
+
+    async def _aresolve(self, query: str, columnar: bool) -> dict:
+        with metrics.timed("generate", self.model):
+            sql = await self.sql_generator.agenerate_sql(query)
+        self._log_sql(sql)
+        rows, error = None, None
+        try:
+            with metrics.timed("execute", self.model):
+                execute = (
+                    self.query_executor.execute_rows
+                    if columnar
+                    else self.query_executor.execute
+                )
+                rows = await run_in_database_executor(execute, sql)
+        except Exception as e:
+            error = e
+        return self._get_response(query, sql, rows, error)
+
+
+class BatchResolver:
+    def __init__(self, *, concurrency: int | None = None) -> None:
+        if concurrency is None:
+            concurrency = settings.BATCH_CONCURRENCY_PER_MODEL
+        self.concurrency = concurrency
+
+    def _resolve_model(self, model: str, queries: list[str]) -> dict[str, dict]:
+        try:
+            resolver = QueryResolver(model=model)
+        except AssertionError as e:
+            return {query: {"query": query, "error": str(e)} for query in queries}
+
+        def resolve(query: str) -> dict:
+            try:
+                with priority(PRIORITY_BATCH):
+                    return resolver.resolve(query)
+            except Exception as e:
+                return {"query": query, "error": str(e)}
+
+        resolve = _close_connections_after(resolve)
+        with ThreadPoolExecutor(
+            max_workers=min(self.concurrency, len(queries)),
+            thread_name_prefix=f"batch-{model}",
+        ) as executor:
+            return dict(zip(queries, executor.map(resolve, queries)))
+
+    def resolve(self, questions: list[tuple[str, str | None]]) -> list[dict]:
+        keys = []
+        queries_by_model: dict[str, dict[str, str]] = {}
+        for query, model in questions:
+            if model is None:
+                model = settings.AVAILABLE_MODELS[0]
+            key = normalize_question(query)
+            keys.append((model, key))
+            queries_by_model.setdefault(model, {}).setdefault(key, query)
+
+        responses: dict[tuple[str, str], dict] = {}
+        with ThreadPoolExecutor(
+            max_workers=max(len(queries_by_model), 1), thread_name_prefix="batch"
+        ) as executor:
+            futures = {
+                model: executor.submit(
+                    self._resolve_model, model, list(queries.values())
+                )
+                for model, queries in queries_by_model.items()
+            }
+            for model, future in futures.items():
+                for key, query in queries_by_model[model].items():
+                    responses[(model, key)] = future.result()[query]
+
+        return [
+            {**responses[key], "query": query}
+            for key, (query, _) in zip(keys, questions)
+        ]
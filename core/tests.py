@@ -1,22 +1,78 @@
+import asyncio
+import contextlib
+import csv
+import datetime
+import gzip
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from unittest import mock
 
+import httpx
+import numpy as np
 import pytest
+from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import OperationalError, connection, transaction
+from django.db.migrations.writer import MigrationWriter
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory
 from django.urls import reverse
+from django.utils import timezone
 from model_bakery import baker
 
-from core import services
-from core.models import TeslaStockData
+from core import indicators, jobs, metrics, services, warmup
+from core.middleware import CompressionMiddleware
+from core.models import (
+    DataVersion,
+    GeneratedSql,
+    Job,
+    TeslaStockData,
+    TeslaStockMonthly,
+    TeslaStockWeekly,
+    TeslaStockYearly,
+)
 
 
-@pytest.fixture
-def mock_csv_file():
-    csv_data = """date,open,high,low,close,volume,rsi_7,rsi_14,cci_7,cci_14,sma_50,ema_50,sma_100,ema_100,macd,bollinger,TrueRange,atr_7,atr_14,next_day_close
+@pytest.fixture(autouse=True)
+def clear_caches():
+    services.sql_cache.clear()
+    services.result_cache.clear()
+    services.sql_generators.clear()
+    services.get_ollama_client.cache_clear()
+    services.model_latencies.clear()
+    services.model_schedulers.clear()
+    services.prepared_statements.clear()
+    services.stock_data_snapshot.close()
+    services.semantic_indexes.clear()
+    for metric in metrics.registry:
+        metric.clear()
+    yield
+
+
+mock_csv_data = """date,open,high,low,close,volume,rsi_7,rsi_14,cci_7,cci_14,sma_50,ema_50,sma_100,ema_100,macd,bollinger,TrueRange,atr_7,atr_14,next_day_close
 2014-01-02,9.986667,10.165333,9.77,10.006667,92826000,55.34407089342224,54.440117846652825,-37.373644058492644,15.213422424213173,9.68210666,9.820166824312885,10.49423998,9.67428441991791,0.16947161056263305,9.74079995,0.3953330000000008,0.4026411651229593,0.4475496484415416,9.970667
 2014-01-03,10.0,10.146,9.906667,9.970667,70425000,53.74262870999453,53.82152101490924,-81.30447088739595,17.48112987448799,9.6528,9.826069020017528,10.49569332,9.68019010852561,0.1626230229475354,9.776166649999999,0.23933300000000024,0.37931142724825084,0.4326770305962963,9.8"""
-    mock_open = mock.mock_open(read_data=csv_data)
+
+
+def make_stock_data(quantity):
+    dates = baker.seq(datetime.date(2014, 1, 1), increment_by=datetime.timedelta(days=1))
+    volumes = baker.seq(1000000)
+    return baker.make(
+        "core.TeslaStockData", date=dates, volume=volumes, _quantity=quantity
+    )
+
+
+@pytest.fixture
+def mock_csv_file():
+    mock_open = mock.mock_open(read_data=mock_csv_data)
     with mock.patch("core.management.commands.load_data.open", mock_open) as m:
         yield m
 
@@ -57,6 +113,415 @@ class TestLoadData:
 
         assert old_stock_data != new_stock_data
 
+    @pytest.mark.django_db
+    @mock.patch("core.management.commands.load_data.os.path.exists")
+    def test_read_data_in_chunks(self, mock_path_exists, mock_csv_file):
+        out = StringIO()
+        call_command("load_data", "test.csv", chunk_size=1, stdout=out)
+
+        assert "1 rows loaded" in out.getvalue()
+        assert "2 rows loaded" in out.getvalue()
+        stock_data = TeslaStockData.objects.order_by("date").first()
+        assert str(stock_data.date) == "2014-01-02"
+        assert stock_data.volume == 92826000
+        assert stock_data.TrueRange == 0.3953330000000008
+
+    @pytest.mark.parametrize(
+        "csv_data, error",
+        [
+            ("date,open\n2014-01-02,9.9", "Missing columns: high, low, close"),
+            (
+                "date,open,high,low,close\n2014-01-02,1,1,1,1",
+                "Missing columns: volume, rsi_7",
+            ),
+            (
+                "date,open,high,low,close,volume\n2014-01-02,1,1,1,x,1",
+                "Invalid row in line 2: could not convert string to float: 'x'.",
+            ),
+            (
+                mock_csv_data.replace("2014-01-03", "2014-01-32"),
+                "Invalid row in line 3: day is out of range for month.",
+            ),
+            (
+                mock_csv_data.replace("92826000", "92826000.5"),
+                "Invalid row in line 2: invalid integer: '92826000.5'.",
+            ),
+            (
+                mock_csv_data.rsplit(",", 1)[0],
+                "Invalid row in line 3: list index out of range.",
+            ),
+        ],
+    )
+    @pytest.mark.django_db
+    @mock.patch("core.management.commands.load_data.os.path.exists")
+    def test_invalid_data(self, mock_path_exists, csv_data, error):
+        TeslaStockData.objects.create(**{
+            field.name: "2000-01-01" if field.name == "date" else 1
+            for field in TeslaStockData._meta.concrete_fields[1:]
+        })
+        mock_open = mock.mock_open(read_data=csv_data)
+        with mock.patch("core.management.commands.load_data.open", mock_open):
+            with pytest.raises(CommandError) as exc_info:
+                call_command("load_data", "test.csv")
+
+        assert error in str(exc_info.value)
+        assert TeslaStockData.objects.count() == 1
+
+    @pytest.mark.django_db
+    @mock.patch("core.management.commands.load_data.os.path.exists")
+    def test_computes_indicators(self, mock_path_exists):
+        csv_data = (
+            "date,open,high,low,close,volume\n"
+            "2014-01-03,10.0,10.146,9.906667,9.970667,70425000\n"
+            "2014-01-02,9.986667,10.165333,9.77,10.006667,92826000\n"
+            "2014-01-06,10.0,10.026667,9.682667,9.8,80416500\n"
+        )
+        mock_open = mock.mock_open(read_data=csv_data)
+        out = StringIO()
+        with mock.patch("core.management.commands.load_data.open", mock_open):
+            call_command("load_data", "test.csv", stdout=out)
+
+        assert "Computing indicators of 3 rows." in out.getvalue()
+        first, second, last = TeslaStockData.objects.order_by("date")
+        assert first.TrueRange == pytest.approx(10.165333 - 9.77)
+        assert second.TrueRange == pytest.approx(10.146 - 9.906667)
+        assert last.TrueRange == pytest.approx(10.026667 - 9.682667)
+        assert first.next_day_close == 9.970667
+        assert last.next_day_close is None
+        assert last.rsi_7 is None
+        assert last.sma_50 is None
+        assert last.ema_50 is None
+        assert last.atr_7 is None
+
+    @pytest.mark.django_db
+    @mock.patch("core.management.commands.load_data.os.path.exists")
+    def test_incremental_computes_indicators_from_stored_rows(self, mock_path_exists):
+        close = np.arange(1.0, 31.0)
+        lines = [
+            f"{datetime.date(2014, 1, 1) + datetime.timedelta(days=day)},"
+            f"{value},{value + 1},{value - 1},{value},1000"
+            for day, value in enumerate(close)
+        ]
+
+        def load(lines, **options):
+            csv_data = "\n".join(["date,open,high,low,close,volume", *lines])
+            mock_open = mock.mock_open(read_data=csv_data)
+            out = StringIO()
+            with mock.patch("core.management.commands.load_data.open", mock_open):
+                call_command("load_data", "test.csv", stdout=out, **options)
+            return out.getvalue()
+
+        load(lines[:20])
+        out = load(lines[20:], incremental=True)
+
+        assert "10 rows inserted, 0 rows updated, 0 rows unchanged." in out
+        assert DataVersion.get_version("core_teslastockdata") == 2
+        out = load(lines[20:], incremental=True)
+        assert "0 rows inserted, 0 rows updated, 10 rows unchanged." in out
+
+        expected = indicators.compute_indicators(close + 1, close - 1, close)
+        stored = list(TeslaStockData.objects.order_by("date"))
+        assert len(stored) == 30
+        for name in ["rsi_7", "rsi_14", "ema_50", "macd", "atr_7", "atr_14", "next_day_close"]:
+            values = np.array(
+                [getattr(stock_data, name) for stock_data in stored], dtype=float
+            )
+            np.testing.assert_allclose(values, expected[name], equal_nan=True)
+
+    @pytest.mark.django_db
+    @mock.patch("core.management.commands.load_data.os.path.exists")
+    def test_incremental(self, mock_path_exists, mock_csv_file):
+        call_command("load_data", "test.csv")
+        TeslaStockData.objects.filter(date="2014-01-02").delete()
+        TeslaStockData.objects.filter(date="2014-01-03").update(open=0)
+        untouched = baker.make("core.TeslaStockData", date="2000-01-01")
+
+        out = StringIO()
+        call_command("load_data", "test.csv", incremental=True, stdout=out)
+
+        assert "1 rows inserted, 1 rows updated, 0 rows unchanged." in out.getvalue()
+        assert dict(TeslaStockData.objects.values_list("date", "open")) == {
+            datetime.date(2000, 1, 1): untouched.open,
+            datetime.date(2014, 1, 2): 9.986667,
+            datetime.date(2014, 1, 3): 10.0,
+        }
+        assert DataVersion.get_version("core_teslastockdata") == 2
+
+        out = StringIO()
+        call_command("load_data", "test.csv", incremental=True, stdout=out)
+
+        assert "0 rows inserted, 0 rows updated, 2 rows unchanged." in out.getvalue()
+        assert DataVersion.get_version("core_teslastockdata") == 2
+
+    @pytest.mark.django_db
+    @mock.patch("core.management.commands.load_data.os.path.exists")
+    def test_refreshes_rollups(self, mock_path_exists, mock_csv_file):
+        call_command("load_data", "test.csv")
+
+        for model in [TeslaStockWeekly, TeslaStockMonthly, TeslaStockYearly]:
+            assert model.objects.count() == 1
+        monthly = TeslaStockMonthly.objects.get()
+        assert monthly.period == datetime.date(2014, 1, 1)
+        assert monthly.trading_days == 2
+        assert monthly.first_open == 9.986667
+        assert monthly.last_close == 9.970667
+        assert monthly.total_volume == 92826000 + 70425000
+        assert monthly.avg_close == pytest.approx((10.006667 + 9.970667) / 2)
+
+        TeslaStockData.objects.filter(date="2014-01-03").update(close=0)
+        call_command("load_data", "test.csv", incremental=True, stdout=StringIO())
+
+        assert TeslaStockMonthly.objects.get().last_close == 9.970667
+
+    @pytest.mark.django_db
+    @mock.patch("core.management.commands.load_data.os.path.exists")
+    def test_incremental_repeated_dates(self, mock_path_exists):
+        lines = mock_csv_data.splitlines()
+        csv_data = "\n".join([*lines, lines[2].replace("2014-01-03,10.0,", "2014-01-03,11.0,")])
+        mock_open = mock.mock_open(read_data=csv_data)
+        with mock.patch("core.management.commands.load_data.open", mock_open):
+            call_command("load_data", "test.csv", incremental=True, stdout=StringIO())
+
+        assert TeslaStockData.objects.get(date="2014-01-03").open == 11.0
+
+    @pytest.mark.django_db
+    @mock.patch("core.management.commands.load_data.os.path.exists")
+    def test_bumps_data_version(self, mock_path_exists, mock_csv_file):
+        call_command("load_data", "test.csv")
+        call_command("load_data", "test.csv")
+
+        assert DataVersion.get_version("core_teslastockdata") == 2
+
+
+class TestIndicators:
+
+    @pytest.fixture(scope="class")
+    def stock_data(self):
+        with open(settings.BASE_DIR / "tsla_2014_2023.csv", newline="") as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        return {
+            column: np.array([float(row[column]) for row in rows])
+            for column in rows[0]
+            if column != "date"
+        }
+
+    # The shipped file was computed with a year of earlier history, the
+    # exponential averages only agree once that history has faded out.
+    @pytest.mark.parametrize(
+        "column, warm_up",
+        [
+            ("rsi_7", 150),
+            ("rsi_14", 300),
+            ("cci_7", 6),
+            ("cci_14", 13),
+            ("sma_50", 49),
+            ("ema_50", 600),
+            ("sma_100", 99),
+            ("ema_100", 1200),
+            ("macd", 300),
+            ("bollinger", 19),
+            ("TrueRange", 0),
+            ("atr_7", 150),
+            ("atr_14", 300),
+            ("next_day_close", 0),
+        ],
+    )
+    def test_matches_shipped_data(self, stock_data, column, warm_up):
+        computed = indicators.compute_indicators(
+            stock_data["high"], stock_data["low"], stock_data["close"]
+        )[column]
+
+        assert not np.isnan(computed[warm_up:-1]).any()
+        np.testing.assert_allclose(
+            computed[warm_up:-1], stock_data[column][warm_up:-1], rtol=1e-8
+        )
+
+    def test_warm_up_is_nan(self):
+        close = np.arange(1.0, 61.0)
+
+        computed = indicators.compute_indicators(close + 1, close - 1, close)
+
+        assert np.isnan(computed["sma_50"][:49]).all()
+        assert not np.isnan(computed["sma_50"][49:]).any()
+        assert np.isnan(computed["sma_100"]).all()
+        assert np.isnan(computed["rsi_14"][:14]).all()
+        assert computed["rsi_14"][14:] == pytest.approx(100)
+        assert np.isnan(computed["ema_50"][:49]).all()
+        assert not np.isnan(computed["ema_50"][49:]).any()
+        assert np.isnan(computed["ema_100"]).all()
+        assert np.isnan(computed["macd"][:25]).all()
+        assert not np.isnan(computed["macd"][25:]).any()
+        assert np.isnan(computed["atr_14"][:13]).all()
+        assert computed["atr_14"][13:] == pytest.approx(2)
+        assert np.isnan(computed["next_day_close"][-1])
+
+    def test_ewm_mean(self):
+        values = np.random.default_rng(0).random(5000)
+        expected = []
+        numerator = denominator = 0.0
+        for value in values:
+            numerator = value + (1 - 1 / 7) * numerator
+            denominator = 1 + (1 - 1 / 7) * denominator
+            expected.append(numerator / denominator)
+
+        np.testing.assert_allclose(indicators.ewm_mean(values, 1 / 7), expected)
+
+
+class TestBenchmark:
+
+    @pytest.fixture(autouse=True)
+    def no_test_database(self):
+        with mock.patch(
+            "core.management.commands.benchmark.Command._test_database",
+            contextlib.nullcontext,
+        ):
+            yield
+
+    def _run(self, tmp_path, *args):
+        output = tmp_path / "benchmark.json"
+        call_command(
+            "benchmark",
+            "--sizes=10,20",
+            "--load-rows=30",
+            "--repeat=2",
+            f"--output={output}",
+            *args,
+            stdout=StringIO(),
+        )
+        return json.loads(output.read_text())
+
+    @pytest.mark.django_db
+    def test_results(self, tmp_path):
+        results = self._run(tmp_path)["results"]
+
+        assert {
+            "prompt.build",
+            "sql.clean",
+            "sql.generate_stubbed",
+            "sql.template",
+            "execute.10.aggregate",
+            "execute.10.aggregate_prepared",
+            "execute.20.rows",
+            "resolve.20.dummy",
+            "serialize.20.json",
+            "serialize.20.columnar",
+            "serialize.20.csv",
+            "load_data.csv",
+            "load_data.ohlcv",
+        } <= set(results)
+        assert results["execute.20.rows"]["rows"] == 20
+        assert results["sql.template"]["hits"] == 2
+        assert results["serialize.20.csv"]["bytes"] < results["serialize.20.json"]["bytes"]
+        assert results["load_data.ohlcv"]["rows"] == 30
+        assert results["prompt.build"]["runs"] == 2
+        assert results["prompt.build"]["min_ms"] <= results["prompt.build"]["median_ms"]
+
+    @pytest.mark.django_db
+    def test_compare(self, tmp_path):
+        baseline = tmp_path / "baseline.json"
+        baseline.write_text(
+            json.dumps(
+                {
+                    "results": {
+                        "sql.clean": {"median_ms": 1000},
+                        "prompt.build": {"median_ms": 0.000001},
+                    }
+                }
+            )
+        )
+
+        with pytest.raises(CommandError, match="1 benchmarks regressed by more than 20%: prompt.build."):
+            self._run(tmp_path, f"--compare={baseline}")
+
+        baseline.write_text(json.dumps({"results": {"sql.clean": {"median_ms": 1000}}}))
+        self._run(tmp_path, f"--compare={baseline}")
+
+
+class TestAdviseIndexes:
+
+    @pytest.fixture
+    def stock_data(self):
+        columns = [
+            field.column
+            for field in TeslaStockData._meta.concrete_fields
+            if field.column not in ("id", "date")
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO core_teslastockdata (date, {", ".join(f'"{column}"' for column in columns)})
+                SELECT DATE '2000-01-01' + n, {", ".join("n" for _ in columns)}
+                FROM generate_series(1, 20000) AS n
+                """
+            )
+            cursor.execute("ANALYZE core_teslastockdata")
+
+    @pytest.fixture
+    def sql_log(self, tmp_path):
+        log_file = tmp_path / "sql.log"
+        log_file.write_text(
+            "SELECT date, close FROM core_teslastockdata WHERE close > 19990 ORDER BY close;\n"
+            "SELECT date, close FROM core_teslastockdata WHERE close > 19990 ORDER BY close\n"
+            "SELECT broken FROM nowhere\n"
+            "DELETE FROM core_teslastockdata\n"
+        )
+        return str(log_file)
+
+    def _get_indexes(self):
+        with connection.cursor() as cursor:
+            return set(
+                connection.introspection.get_constraints(cursor, "core_teslastockdata")
+            )
+
+    @pytest.mark.django_db
+    def test_propose(self, stock_data, sql_log):
+        indexes = self._get_indexes()
+        out = StringIO()
+
+        call_command("advise_indexes", sql_log, stdout=out)
+
+        lines = out.getvalue().splitlines()
+        assert lines[0] == "3 statements read, 2 distinct, 1 could not be explained."
+        assert lines[1] == (
+            'CREATE INDEX IF NOT EXISTS "core_teslastockdata_close_btree" '
+            'ON "core_teslastockdata" USING btree ("close"); -- used by 2 statements'
+        )
+        assert lines[-1].startswith("Workload cost: ")
+        assert self._get_indexes() == indexes
+
+    @pytest.mark.django_db
+    def test_nothing_to_propose(self, tmp_path):
+        log_file = tmp_path / "sql.log"
+        log_file.write_text("SELECT * FROM core_teslastockdata WHERE date = '2020-01-01'\n")
+        out = StringIO()
+
+        call_command("advise_indexes", str(log_file), stdout=out)
+
+        assert "No indexes to propose." in out.getvalue()
+
+    @pytest.mark.django_db
+    def test_write_migration(self, stock_data, sql_log, tmp_path):
+        path = tmp_path / "0099_advised_indexes.py"
+
+        with mock.patch.object(
+            MigrationWriter, "path", new_callable=mock.PropertyMock, return_value=str(path)
+        ):
+            call_command("advise_indexes", sql_log, write_migration=True, stdout=StringIO())
+
+        content = path.read_text()
+        assert "atomic = False" in content
+        assert 'CREATE INDEX CONCURRENTLY IF NOT EXISTS "core_teslastockdata_close_btree"' in content
+        assert 'DROP INDEX CONCURRENTLY IF EXISTS "core_teslastockdata_close_btree"' in content
+
+    def test_missing_log_file(self, settings):
+        settings.SQL_LOG_FILE = ""
+
+        with pytest.raises(CommandError, match="No SQL log file"):
+            call_command("advise_indexes")
+
+        with pytest.raises(CommandError, match="does not exist"):
+            call_command("advise_indexes", "missing.log")
+
 
 class TestResolveQueryView:
 
@@ -72,15 +537,9 @@ class TestResolveQueryView:
 
     @pytest.mark.django_db
     def test_happy_path(self, client):
-        baker.make("core.TeslaStockData", _quantity=3)
+        make_stock_data(3)
         query = "Please give only the date and close price of the record with the oldest date."
-
-        oldest_data = TeslaStockData.objects.order_by("-date").first()
-        expected_response = {
-            "query": query,
-            "attempted_query": ' SELECT "date", "close" FROM core_teslastockdata ORDER BY "date" DESC LIMIT 1;',
-            "response": [{"date": str(oldest_data.date), "close": oldest_data.close}]
-        }
+        oldest_data = TeslaStockData.objects.order_by("date").first()
 
         response = client.get(
             reverse("resolve_query"),
@@ -89,8 +548,12 @@ class TestResolveQueryView:
             },
         )
 
+        # The SQL written by the model depends on the prompt, the answer must not.
         assert response.status_code == 200
-        assert response.json() == expected_response
+        assert "error" not in response.json()
+        assert response.json()["response"] == [
+            {"date": str(oldest_data.date), "close": oldest_data.close}
+        ]
 
     @mock.patch("core.services.QueryResolver")
     def test_query_resolver_is_used(self, mock_query_resolver, client):
@@ -108,167 +571,2843 @@ class TestResolveQueryView:
         mock_query_resolver.assert_called_once_with(model="random-model")
         assert response.json() == mock_query_resolver.return_value.resolve.return_value
 
+    @mock.patch("core.services.QueryResolver")
+    def test_async_query_resolver_is_used(self, mock_query_resolver, client):
+        mock_query_resolver.return_value.aresolve = mock.AsyncMock(
+            return_value={"random": "data"}
+        )
 
-class TestDjangoQueryExecutor:
+        response = client.get(
+            reverse("aresolve_query"),
+            {
+                "q": "Please give me the oldest data, include date and close fields.",
+                "model": "random-model",
+            },
+        )
 
-    @pytest.mark.django_db
-    def test_execute(self):
-        baker.make("core.TeslaStockData", _quantity=3)
-        sql = "SELECT count(*) as my_count FROM core_teslastockdata"
+        mock_query_resolver.assert_called_once_with(
+            model="random-model", asynchronous=True
+        )
+        assert response.json() == {"random": "data"}
 
-        response = services.DjangoQueryExecutor().execute(sql)
+    def test_async_params_no_provided(self, client):
+        response = client.get(reverse("aresolve_query"))
 
-        assert response == [{"my_count": 3}]
+        assert response.status_code == 400
+        assert response.json() == {"error": "No query provided."}
 
-    @pytest.mark.xfail(
-        reason="Django transactions do not work currently with raw queries."
-    )
-    @pytest.mark.django_db
-    def test_transaction(self):
-        baker.make("core.TeslaStockData", _quantity=3)
-        sql = "DELETE FROM core_teslastockdata"
+    @mock.patch("core.services.QueryResolver")
+    def test_stream(self, mock_query_resolver, client):
+        events = [
+            {"event": "token", "data": "SELECT 1"},
+            {"event": "sql", "data": "SELECT 1"},
+            {"event": "rows", "data": [{"date": datetime.date(2014, 1, 2)}]},
+            {"event": "end"},
+        ]
+        mock_query_resolver.return_value.resolve_stream.return_value = iter(events)
 
-        response = services.DjangoQueryExecutor().execute(sql)
+        response = client.get(
+            reverse("resolve_query"), {"q": "oldest date", "format": "stream"}
+        )
 
-        assert response == []
+        assert response.status_code == 200
+        assert response["Content-Type"] == "application/x-ndjson"
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        assert [json.loads(line) for line in lines] == [
+            *events[:2],
+            {"event": "rows", "data": [{"date": "2014-01-02"}]},
+            events[3],
+        ]
+        mock_query_resolver.return_value.resolve_stream.assert_called_once_with(
+            "oldest date"
+        )
 
-        assert TeslaStockData.objects.count() == 3
+    @pytest.mark.parametrize(
+        "orient, expected",
+        [
+            ("rows", {"rows": [["2014-01-02", 1.5], ["2014-01-03", None]]}),
+            ("columns", {"data": [["2014-01-02", "2014-01-03"], [1.5, None]]}),
+        ],
+    )
+    @mock.patch("core.services.QueryResolver")
+    def test_columnar(self, mock_query_resolver, orient, expected, client):
+        mock_query_resolver.return_value.resolve.return_value = {
+            "query": "closes",
+            "attempted_query": "SELECT date, close FROM core_teslastockdata",
+            "columns": ["date", "close"],
+            "rows": services.QueryRows(
+                ["date", "close"],
+                [(datetime.date(2014, 1, 2), 1.5), (datetime.date(2014, 1, 3), None)],
+            ),
+            "truncated": True,
+        }
 
+        response = client.get(
+            reverse("resolve_query"),
+            {"q": "closes", "format": "columnar", "orient": orient},
+        )
 
-class TestQueryResolver:
+        mock_query_resolver.return_value.resolve.assert_called_once_with(
+            "closes", columnar=True
+        )
+        assert response.json() == {
+            "query": "closes",
+            "attempted_query": "SELECT date, close FROM core_teslastockdata",
+            "columns": ["date", "close"],
+            **expected,
+            "truncated": True,
+        }
 
     @pytest.mark.parametrize(
-        "sql_generator, query_executor, expected_sql_generator, expected_query_executor",
+        "format, content_type, content",
         [
             (
-                None,
-                None,
-                services.OllamaSqlGenerator,
-                services.DjangoQueryExecutor,
+                "csv",
+                "text/csv; charset=utf-8",
+                "date,close\r\n2014-01-02,1.5\r\n2014-01-03,\r\n",
             ),
             (
-                mock.Mock(spec=services.AbstractSqlGenerator),
-                mock.Mock(spec=services.AbstractQueryExecutor),
-                mock.Mock,
-                mock.Mock,
+                "ndjson",
+                "application/x-ndjson",
+                '{"date":"2014-01-02","close":1.5}\n'
+                '{"date":"2014-01-03","close":null}\n',
             ),
         ],
     )
-    def test_init(
-        self,
-        sql_generator,
-        query_executor,
-        expected_sql_generator,
-        expected_query_executor,
+    @mock.patch("core.services.QueryResolver")
+    def test_csv_and_ndjson(
+        self, mock_query_resolver, format, content_type, content, client
     ):
+        mock_query_resolver.return_value.resolve.return_value = {
+            "query": "closes",
+            "attempted_query": "SELECT date, close FROM core_teslastockdata",
+            "columns": ["date", "close"],
+            "rows": [(datetime.date(2014, 1, 2), 1.5), (datetime.date(2014, 1, 3), None)],
+        }
 
-        resolver = services.QueryResolver(
-            sql_generator=sql_generator,
-            query_executor=query_executor,
-        )
+        response = client.get(reverse("resolve_query"), {"q": "closes", "format": format})
 
-        assert isinstance(resolver.sql_generator, expected_sql_generator)
-        assert isinstance(resolver.query_executor, expected_query_executor)
+        assert response["Content-Type"] == content_type
+        assert response.content.decode() == content
+        assert not response.has_header("X-Truncated")
 
-    @pytest.mark.parametrize("model_name", ["random-model", "tesla-stock-data"])
-    def test_invalid_model(self, model_name, settings):
-        settings.AVAILABLE_MODELS = ["llama2"]
+    @mock.patch("core.services.QueryResolver")
+    def test_columnar_orjson(self, mock_query_resolver, client):
+        pytest.importorskip("orjson")
+        mock_query_resolver.return_value.resolve.return_value = {
+            "query": "closes",
+            "attempted_query": "SELECT date, close FROM core_teslastockdata",
+            "columns": ["date", "close"],
+            "rows": [(datetime.date(2014, 1, 2), 1.5)],
+        }
 
-        with pytest.raises(AssertionError):
-            services.QueryResolver(model=model_name)
+        response = client.get(reverse("resolve_query"), {"q": "closes", "format": "columnar"})
+        with mock.patch("core.views.orjson", None):
+            expected = client.get(
+                reverse("resolve_query"), {"q": "closes", "format": "columnar"}
+            )
 
-    def test_resolve(self):
-        mock_query = mock.Mock()
-        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
-        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        assert response.content == expected.content
 
-        resolver = services.QueryResolver(
-            sql_generator=mock_sql_generator,
-            query_executor=mock_query_executor,
+    @pytest.mark.parametrize("format", ["columnar", "csv", "ndjson"])
+    @mock.patch("core.services.QueryResolver")
+    def test_columnar_error(self, mock_query_resolver, format, client):
+        error = {"query": "closes", "attempted_query": "SELECT", "error": "syntax error"}
+        mock_query_resolver.return_value.resolve.return_value = error
+
+        response = client.get(reverse("resolve_query"), {"q": "closes", "format": format})
+
+        assert response.json() == error
+
+    @mock.patch("core.services.QueryResolver")
+    def test_async_columnar(self, mock_query_resolver, async_client):
+        mock_query_resolver.return_value.aresolve = mock.AsyncMock(
+            return_value={
+                "query": "closes",
+                "attempted_query": "SELECT close FROM core_teslastockdata",
+                "columns": ["close"],
+                "rows": [(1.5,)],
+            }
         )
-        response = resolver.resolve(mock_query)
 
-        assert response == {
-            "query": mock_query,
-            "attempted_query": mock_sql_generator.generate_sql.return_value,
-            "response": mock_query_executor.execute.return_value
-        }
+        response = async_to_sync(async_client.get)(
+            reverse("aresolve_query"), {"q": "closes", "format": "csv"}
+        )
 
-        assert mock_sql_generator.generate_sql.call_once_with(mock_query)
-        assert mock_query_executor.execute.call_once_with(
-            mock_sql_generator.generate_sql.return_value
+        mock_query_resolver.return_value.aresolve.assert_awaited_once_with(
+            "closes", columnar=True
         )
+        assert response.content == b"close\r\n1.5\r\n"
 
-    def test_resolve_with_error(self):
-        mock_query = mock.Mock()
-        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
-        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
-        mock_query_executor.execute.side_effect = Exception("Test error")
 
-        resolver = services.QueryResolver(
-            sql_generator=mock_sql_generator,
-            query_executor=mock_query_executor,
+class TestCompressionMiddleware:
+
+    def _get_response(self, accept_encoding):
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING=accept_encoding)
+        middleware = CompressionMiddleware(
+            lambda request: HttpResponse("date,close\r\n" * 100, content_type="text/csv")
         )
-        response = resolver.resolve(mock_query)
+        return middleware(request)
 
-        assert response == {
-            "query": mock_query,
-            "error": "Test error",
-            "attempted_query": mock_sql_generator.generate_sql.return_value,
-        }
+    def test_gzip(self):
+        response = self._get_response("gzip, deflate")
 
+        assert response["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.content) == b"date,close\r\n" * 100
 
-class TestOllamaSqlGenerator:
+    @mock.patch("core.middleware.brotli", None)
+    def test_brotli_not_installed(self):
+        response = self._get_response("gzip, br")
 
-    @pytest.mark.parametrize(
-        "query, expected_response",
-        [
-            (
-                "give the maximum close price",
-                ' SELECT MAX("close") FROM core_teslastockdata;',
-            ),
-            (
-                "give the minimum close price",
-                ' SELECT MIN("close") FROM core_teslastockdata;',
-            ),
-            (
-                "I want the most recent date in the format YYYY-MM-DD",
-                ' SELECT DATE(MAX("date")) AS most_recent_date;',
-            ),
-        ],
-    )
-    def test_happy(self, query, expected_response):
+        assert response["Content-Encoding"] == "gzip"
 
-        generator = services.OllamaSqlGenerator(model="llama2")
-        sql = generator.generate_sql(query)
-        assert sql == expected_response
+    def test_brotli(self):
+        brotli = pytest.importorskip("brotli")
 
-    @mock.patch("core.services.ollama.Client")
-    def test_chat_args(self, mock_client):
+        response = self._get_response("gzip, br")
 
-        generator = services.OllamaSqlGenerator(model="test-model")
-        response = generator._chat("test")
+        assert response["Content-Encoding"] == "br"
+        assert response["Vary"] == "Accept-Encoding"
+        assert brotli.decompress(response.content) == b"date,close\r\n" * 100
+
+    def test_not_accepted(self):
+        response = self._get_response("")
+
+        assert not response.has_header("Content-Encoding")
+        assert response["Vary"] == "Accept-Encoding"
+
+    @pytest.mark.parametrize("accept_encoding", ["gzip", "gzip, br"])
+    @mock.patch("core.middleware.brotli", None)
+    def test_stream_gzip_flushes_every_chunk(self, accept_encoding):
+        events = [json.dumps({"event": "token", "data": n}).encode() + b"\n" for n in range(5)]
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING=accept_encoding)
+        middleware = CompressionMiddleware(
+            lambda request: StreamingHttpResponse(
+                iter(events), content_type="application/x-ndjson"
+            )
+        )
+
+        response = middleware(request)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = [decompressor.decompress(chunk) for chunk in response.streaming_content]
+
+        assert response["Content-Encoding"] == "gzip"
+        assert chunks == [*events, b""]
+
+    def test_stream_brotli(self):
+        brotli = pytest.importorskip("brotli")
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="br")
+        middleware = CompressionMiddleware(
+            lambda request: StreamingHttpResponse(iter([b"a" * 300, b"b"]))
+        )
+
+        response = middleware(request)
+
+        assert response["Content-Encoding"] == "br"
+        assert brotli.decompress(b"".join(response.streaming_content)) == b"a" * 300 + b"b"
+
+
+class TestDjangoQueryExecutor:
+
+    @pytest.mark.django_db
+    def test_execute(self):
+        make_stock_data(3)
+        sql = "SELECT count(*) as my_count FROM core_teslastockdata"
+
+        response = services.DjangoQueryExecutor().execute(sql)
+
+        assert response == [{"my_count": 3}]
+
+    @pytest.mark.django_db
+    @pytest.mark.parametrize("max_rows, truncated", [(2, True), (3, False), (4, False)])
+    @pytest.mark.parametrize("prepared", [True, False])
+    def test_execute_max_rows(self, max_rows, truncated, prepared, settings):
+        settings.PREPARED_STATEMENTS_ENABLED = prepared
+        settings.QUERY_MAX_ROWS = max_rows
+        settings.QUERY_FETCH_SIZE = 1
+        make_stock_data(3)
+        sql = "SELECT id FROM core_teslastockdata"
+
+        response = services.DjangoQueryExecutor().execute(sql)
+
+        assert len(response) == min(max_rows, 3)
+        assert response.truncated is truncated
+
+    @pytest.mark.django_db
+    def test_execute_statement_timeout(self, settings):
+        settings.QUERY_STATEMENT_TIMEOUT = 10
+
+        with pytest.raises(OperationalError, match="statement timeout"):
+            services.DjangoQueryExecutor().execute("SELECT pg_sleep(1)")
+
+    @pytest.mark.django_db
+    def test_execute_work_mem(self, settings):
+        settings.QUERY_WORK_MEM = "5MB"
+        sql = "SELECT current_setting('work_mem') AS work_mem"
+
+        response = services.DjangoQueryExecutor().execute(sql)
+
+        assert response == [{"work_mem": "5MB"}]
+
+    @pytest.mark.django_db
+    def test_execute_rows(self, settings):
+        settings.QUERY_MAX_ROWS = 2
+        stock_data = make_stock_data(3)
+        sql = "SELECT date, close FROM core_teslastockdata ORDER BY date"
+
+        rows = services.DjangoQueryExecutor().execute_rows(sql)
+
+        assert rows.columns == ["date", "close"]
+        assert rows == [(data.date, data.close) for data in stock_data[:2]]
+        assert rows.truncated is True
+        assert rows.as_dicts() == [
+            {"date": data.date, "close": data.close} for data in stock_data[:2]
+        ]
+        assert rows.as_dicts().truncated is True
+
+    @pytest.mark.django_db
+    def test_execute_rows_empty(self):
+        rows = services.DjangoQueryExecutor().execute_rows(
+            "SELECT date, close FROM core_teslastockdata"
+        )
+
+        assert rows == []
+        assert rows.columns == ["date", "close"]
+
+    @pytest.mark.django_db
+    def test_execute_iter(self):
+        make_stock_data(5)
+        sql = "SELECT id FROM core_teslastockdata ORDER BY id"
+
+        batches = list(services.DjangoQueryExecutor().execute_iter(sql, 2))
+
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        assert [row["id"] for batch in batches for row in batch] == list(
+            TeslaStockData.objects.order_by("id").values_list("id", flat=True)
+        )
+
+    @pytest.mark.django_db
+    def test_execute_iter_not_read_query(self):
+        make_stock_data(2)
+        sql = "UPDATE core_teslastockdata SET open = 0"
+
+        assert list(services.DjangoQueryExecutor().execute_iter(sql, 2)) == []
+
+    @pytest.mark.xfail(
+        reason="Django transactions do not work currently with raw queries."
+    )
+    @pytest.mark.django_db
+    def test_transaction(self):
+        make_stock_data(3)
+        sql = "DELETE FROM core_teslastockdata"
+
+        response = services.DjangoQueryExecutor().execute(sql)
+
+        assert response == []
+
+        assert TeslaStockData.objects.count() == 3
+
+    @pytest.mark.django_db
+    def test_execute_prepared(self, settings):
+        settings.PREPARED_STATEMENTS_ENABLED = True
+        stock_data = make_stock_data(3)
+        executor = services.DjangoQueryExecutor()
+
+        for data in stock_data:
+            rows = executor.execute_rows(
+                f"SELECT date, close, 1 + 1 AS two FROM core_teslastockdata WHERE date = '{data.date}'"
+            )
+            assert rows == [(data.date, data.close, 2)]
+
+        assert metrics.prepared_statements.get(result="miss") == 1
+        assert metrics.prepared_statements.get(result="hit") == 2
+        assert len(services.prepared_statements) == 1
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM pg_prepared_statements WHERE statement LIKE %s",
+                ["%WHERE date = $2%"],
+            )
+            assert cursor.fetchone() == (1,)
+
+    @pytest.mark.django_db
+    def test_execute_prepared_unsupported(self, settings):
+        settings.PREPARED_STATEMENTS_ENABLED = True
+        sql = "SELECT concat('a', 1) AS value"
+
+        assert services.DjangoQueryExecutor().execute(sql) == [{"value": "a1"}]
+        assert services.DjangoQueryExecutor().execute(sql) == [{"value": "a1"}]
+        assert metrics.prepared_statements.get(result="unsupported") == 2
+
+    @pytest.mark.django_db
+    def test_execute_prepared_table_changed(self, settings):
+        settings.PREPARED_STATEMENTS_ENABLED = True
+        executor = services.DjangoQueryExecutor()
+        executor.execute("SELECT * FROM core_dataversion WHERE version > 0")
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE core_dataversion ADD COLUMN extra integer")
+
+        rows = executor.execute_rows("SELECT * FROM core_dataversion WHERE version > 1")
+
+        assert rows.columns[-1] == "extra"
+        assert metrics.prepared_statements.get(result="miss") == 1
+
+    @pytest.mark.django_db
+    def test_execute_prepared_group_by_expression(self, settings):
+        settings.PREPARED_STATEMENTS_ENABLED = True
+        make_stock_data(3)
+        sql = (
+            "SELECT date_trunc('month', date) AS month, count(*) AS days "
+            "FROM core_teslastockdata GROUP BY date_trunc('month', date)"
+        )
+
+        assert services.DjangoQueryExecutor().execute(sql)[0]["days"] == 3
+        assert metrics.prepared_statements.get(result="miss") == 1
+
+    @pytest.mark.django_db
+    def test_prepared_statements_evicted(self):
+        statements = services.PreparedStatements(maxsize=1)
+        with connection.cursor() as cursor:
+            first = statements.prepare(cursor, "SELECT $1 + 1", ["integer"])
+            statements.prepare(cursor, "SELECT $1 + 2", ["integer"])
+            cursor.execute("SELECT count(*) FROM pg_prepared_statements WHERE name = %s", [first])
+
+            assert cursor.fetchone() == (0,)
+        assert len(statements) == 1
+
+
+class TestParameterizeSql:
+
+    @pytest.mark.parametrize(
+        "sql, expected",
+        [
+            (
+                "SELECT date, close FROM core_teslastockdata WHERE date = '2021-03-04';",
+                ("SELECT date, close FROM core_teslastockdata WHERE date = $1", ["'2021-03-04'"], ["unknown"]),
+            ),
+            (
+                "SELECT rsi_14 FROM core_teslastockdata WHERE close > 1.5 ORDER BY 1 LIMIT 10",
+                ("SELECT rsi_14 FROM core_teslastockdata WHERE close > $1 ORDER BY 1 LIMIT $2", ["1.5", "10"], ["numeric", "integer"]),
+            ),
+            (
+                "SELECT \"TrueRange\" FROM core_teslastockdata WHERE volume BETWEEN 1 AND 3000000000",
+                ('SELECT "TrueRange" FROM core_teslastockdata WHERE volume BETWEEN $1 AND $2', ["1", "3000000000"], ["integer", "bigint"]),
+            ),
+            (
+                "SELECT round(close::numeric(10, 2), 2) FROM core_teslastockdata WHERE date > DATE '2021-01-01'",
+                ("SELECT round(close::numeric(10, 2), 2) FROM core_teslastockdata WHERE date > DATE '2021-01-01'", [], []),
+            ),
+            (
+                "SELECT date_trunc('month', date) AS month, max(close) FROM core_teslastockdata "
+                "WHERE close > 10 GROUP BY date_trunc('month', date) HAVING max(close) > 10",
+                (
+                    "SELECT date_trunc($1, date) AS month, max(close) FROM core_teslastockdata "
+                    "WHERE close > $2 GROUP BY date_trunc($1, date) HAVING max(close) > $2",
+                    ["'month'", "10"],
+                    ["unknown", "integer"],
+                ),
+            ),
+            ("SELECT $1", None),
+            ("SELECT 1; SELECT 2", None),
+        ],
+    )
+    def test_parameterize_sql(self, sql, expected):
+        assert services.parameterize_sql(sql) == expected
+
+
+class TestQueryResolver:
+
+    @pytest.mark.parametrize(
+        "sql_generator, query_executor, expected_sql_generator, expected_query_executor",
+        [
+            (
+                None,
+                None,
+                services.TemplateSqlGenerator,
+                services.CachedQueryExecutor,
+            ),
+            (
+                mock.Mock(spec=services.AbstractSqlGenerator),
+                mock.Mock(spec=services.AbstractQueryExecutor),
+                mock.Mock,
+                mock.Mock,
+            ),
+        ],
+    )
+    def test_init(
+        self,
+        sql_generator,
+        query_executor,
+        expected_sql_generator,
+        expected_query_executor,
+    ):
+
+        resolver = services.QueryResolver(
+            sql_generator=sql_generator,
+            query_executor=query_executor,
+        )
+
+        assert isinstance(resolver.sql_generator, expected_sql_generator)
+        assert isinstance(resolver.query_executor, expected_query_executor)
+
+    def test_init_without_caches(self, settings):
+        settings.SQL_CACHE_ENABLED = False
+        settings.TEMPLATE_SQL_ENABLED = False
+        settings.RESULT_CACHE_ENABLED = False
+
+        resolver = services.QueryResolver()
+
+        assert isinstance(resolver.sql_generator, services.OllamaSqlGenerator)
+        assert isinstance(resolver.query_executor, services.DjangoQueryExecutor)
+
+    @pytest.mark.parametrize("model_name", ["random-model", "tesla-stock-data"])
+    def test_invalid_model(self, model_name, settings):
+        settings.AVAILABLE_MODELS = ["llama2"]
+
+        with pytest.raises(AssertionError):
+            services.QueryResolver(model=model_name)
+
+    def test_resolve(self):
+        mock_query = "oldest date"
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.return_value = "SELECT 1"
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock_query_executor,
+        )
+        response = resolver.resolve(mock_query)
+
+        assert response == {
+            "query": mock_query,
+            "attempted_query": mock_sql_generator.generate_sql.return_value,
+            "response": mock_query_executor.execute.return_value
+        }
+
+        assert mock_sql_generator.generate_sql.call_once_with(mock_query)
+        assert mock_query_executor.execute.call_once_with(
+            mock_sql_generator.generate_sql.return_value
+        )
+
+    @pytest.mark.parametrize("sql", ["SELECT 1", "SELECT 1\n", "SELECT\n  1"])
+    def test_resolve_logs_sql(self, sql, caplog):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.return_value = sql
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock_query_executor,
+        )
+        with caplog.at_level("INFO", logger="core.sql"):
+            resolver.resolve("query")
+
+        assert [
+            record.getMessage() for record in caplog.records if record.name == "core.sql"
+        ] == ["SELECT 1"]
+
+    def test_init_asynchronous(self):
+        resolver = services.QueryResolver(asynchronous=True)
+
+        assert isinstance(
+            resolver.sql_generator.sql_generator.sql_generator,
+            services.AsyncOllamaSqlGenerator,
+        )
+
+    def test_aresolve(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.agenerate_sql = mock.AsyncMock(return_value="SELECT 1")
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock_query_executor,
+        )
+        response = async_to_sync(resolver.aresolve)("query")
+
+        assert response == {
+            "query": "query",
+            "attempted_query": "SELECT 1",
+            "response": mock_query_executor.execute.return_value,
+        }
+        mock_sql_generator.agenerate_sql.assert_awaited_once_with("query")
+        mock_query_executor.execute.assert_called_once_with("SELECT 1")
+
+    def test_aresolve_with_error(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.agenerate_sql = mock.AsyncMock(return_value="SELECT 1")
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        mock_query_executor.execute.side_effect = Exception("Test error")
+
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock_query_executor,
+        )
+        response = async_to_sync(resolver.aresolve)("query")
+
+        assert response == {
+            "query": "query",
+            "error": "Test error",
+            "attempted_query": "SELECT 1",
+        }
+
+    def test_resolve_truncated(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.return_value = "SELECT 1"
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        rows = services.QueryResult([{"a": 1}])
+        rows.truncated = True
+        mock_query_executor.execute.return_value = rows
+
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock_query_executor,
+        )
+
+        assert resolver.resolve("query") == {
+            "query": "query",
+            "attempted_query": mock_sql_generator.generate_sql.return_value,
+            "response": [{"a": 1}],
+            "truncated": True,
+        }
+
+    def test_resolve_stream(self, settings):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.stream_sql.return_value = iter(["SELECT ", "1"])
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        mock_query_executor.execute_iter.return_value = iter([[{"a": 1}], [{"a": 2}]])
+
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock_query_executor,
+        )
+
+        assert list(resolver.resolve_stream("query")) == [
+            {"event": "token", "data": "SELECT "},
+            {"event": "token", "data": "1"},
+            {"event": "sql", "data": "SELECT 1"},
+            {"event": "rows", "data": [{"a": 1}]},
+            {"event": "rows", "data": [{"a": 2}]},
+            {"event": "end"},
+        ]
+        mock_query_executor.execute_iter.assert_called_once_with(
+            "SELECT 1", settings.STREAM_BATCH_SIZE
+        )
+
+    def test_resolve_stream_with_error(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.stream_sql.return_value = iter(["SELECT 1"])
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        mock_query_executor.execute_iter.side_effect = Exception("Test error")
+
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock_query_executor,
+        )
+
+        assert list(resolver.resolve_stream("query"))[-2:] == [
+            {"event": "error", "data": "Test error"},
+            {"event": "end"},
+        ]
+
+    def test_resolve_stream_with_generation_error(self):
+        def stream_sql(query):
+            yield "SELECT "
+            raise httpx.ConnectError("Connection refused")
+
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.stream_sql.side_effect = stream_sql
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock_query_executor,
+        )
+
+        assert list(resolver.resolve_stream("query")) == [
+            {"event": "token", "data": "SELECT "},
+            {"event": "error", "data": "Connection refused"},
+            {"event": "end"},
+        ]
+        mock_query_executor.execute_iter.assert_not_called()
+
+    def test_resolve_with_error(self):
+        mock_query = "oldest date"
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.return_value = "SELECT 1"
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        mock_query_executor.execute.side_effect = Exception("Test error")
+
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock_query_executor,
+        )
+        response = resolver.resolve(mock_query)
+
+        assert response == {
+            "query": mock_query,
+            "error": "Test error",
+            "attempted_query": mock_sql_generator.generate_sql.return_value,
+        }
+
+
+class TestOllamaSqlGenerator:
+
+    @pytest.mark.django_db
+    @pytest.mark.parametrize(
+        "query, column, aggregate",
+        [
+            ("give the maximum close price", "close", max),
+            ("give the minimum close price", "close", min),
+            ("I want the most recent date in the format YYYY-MM-DD", "date", max),
+        ],
+    )
+    def test_happy(self, query, column, aggregate):
+        stock_data = make_stock_data(3)
+        expected = aggregate(getattr(data, column) for data in stock_data)
+
+        generator = services.OllamaSqlGenerator(model="llama2")
+        sql = generator.generate_sql(query)
+
+        # The SQL written by the model depends on the prompt, the answer must not.
+        rows = services.DjangoQueryExecutor().execute_rows(sql)
+        assert [str(value) for value in rows[0]] == [str(expected)]
+
+    @mock.patch("core.services.ollama.Client")
+    def test_chat_args(self, mock_client, settings):
+
+        generator = services.OllamaSqlGenerator(model="test-model")
+        response = generator._chat("test")
 
         mock_client.return_value.chat.assert_called_with(
             model="test-model",
             options={"seed": 123, "temperature": 0},
             messages=[
                 {
-                    "role": "user",
-                    "content": "test",
+                    "role": "user",
+                    "content": "test",
+                },
+            ],
+            keep_alive=settings.OLLAMA_KEEP_ALIVE,
+        )
+
+        assert (
+            response == mock_client.return_value.chat.return_value["message"]["content"]
+        )
+
+    def test_prompt_version_is_not_logged(self, caplog):
+        client = mock.Mock()
+        client.chat.return_value = {"message": {"content": "SELECT 1"}}
+        generator = services.CachedSqlGenerator(
+            services.OllamaSqlGenerator(model="llama2", client=client),
+            model="llama2",
+            cache=services.LRUCache(maxsize=10),
+            persistent=False,
+        )
+
+        with caplog.at_level(logging.INFO, logger="core.services"):
+            generator.generate_sql("max close")
+            generator.generate_sql("max close")
+
+        assert [record.getMessage() for record in caplog.records] == [
+            "Prompt with 50 tokens and 2 of 20 columns."
+        ]
+        assert generator.sql_generator.prompt_version == (
+            services.OllamaSqlGenerator(model="mistral").prompt_version
+        )
+
+    @mock.patch("core.services.ollama.Client")
+    def test_stream_sql(self, mock_client):
+        mock_client.return_value.chat.return_value = iter(
+            [
+                {"message": {"content": "SELECT\n"}},
+                {"message": {"content": "\\\"close\\\""}},
+            ]
+        )
+
+        generator = services.OllamaSqlGenerator(model="test-model")
+
+        assert list(generator.stream_sql("test")) == ["SELECT ", '"close"']
+        assert mock_client.return_value.chat.call_args.kwargs["stream"] is True
+
+    @mock.patch("core.services.ollama.AsyncClient")
+    def test_agenerate_sql(self, mock_async_client, settings):
+        mock_async_client.return_value.chat = mock.AsyncMock(
+            return_value={"message": {"content": "SELECT\n1"}}
+        )
+
+        generator = services.AsyncOllamaSqlGenerator(model="test-model")
+        sql = async_to_sync(generator.agenerate_sql)("test")
+
+        assert sql == "SELECT 1"
+        mock_async_client.return_value.chat.assert_awaited_once_with(
+            model="test-model",
+            options={"seed": 123, "temperature": 0},
+            messages=[
+                {
+                    "role": "user",
+                    "content": generator._get_message("test"),
+                },
+            ],
+            keep_alive=settings.OLLAMA_KEEP_ALIVE,
+        )
+
+    def test_get_message(self):
+        generator = services.OllamaSqlGenerator(model="llama2")
+        message = generator._get_message("What was the latest RSI 14?")
+
+        assert (
+            "CREATE TABLE core_teslastockdata (date date, rsi_7 float, rsi_14 float);"
+            in message
+        )
+        assert "What was the latest RSI 14?" in message
+
+
+class TestPromptBuilder:
+
+    @pytest.mark.parametrize(
+        "query, expected_columns",
+        [
+            ("What was the latest RSI 14?", ["date", "rsi_7", "rsi_14"]),
+            ("max volume per year", ["date", "volume"]),
+            ("average monthly closing price", ["date", "open", "high", "low", "close"]),
+            ("true range and atr on 2020-01-02", ["date", "TrueRange", "atr_7", "atr_14"]),
+            ("next day close of the oldest date", ["date", "close", "next_day_close"]),
+        ],
+    )
+    def test_get_relevant_columns(self, query, expected_columns):
+        assert services.PromptBuilder().get_relevant_columns(query) == expected_columns
+
+    @pytest.mark.parametrize(
+        "query", ["give me all the records of 2021", "how many days are there?"]
+    )
+    def test_get_relevant_columns_without_pruning(self, query):
+        builder = services.PromptBuilder()
+
+        assert builder.get_relevant_columns(query) == [
+            field.column for field in TeslaStockData._meta.concrete_fields[1:]
+        ]
+
+    def test_schema_follows_the_model(self):
+        schema = services.PromptBuilder().get_schema(
+            [field.column for field in TeslaStockData._meta.concrete_fields[1:]]
+        )
+
+        assert schema.startswith(
+            "CREATE TABLE core_teslastockdata (date date, open float, high float,"
+        )
+        assert "volume bigint" in schema
+        assert '"TrueRange" float' in schema
+        assert schema.endswith("next_day_close float);")
+
+    def test_build(self):
+        builder = services.PromptBuilder()
+        prompt = builder.build("max volume per year")
+
+        assert prompt.columns == ["date", "volume"]
+        assert prompt.token_count == builder.count_tokens(prompt.text)
+        assert prompt.token_count < builder.build("").token_count
+        assert "CREATE TABLE core_teslastockdata (date date, volume bigint);" in prompt.text
+        assert "max volume per year" in prompt.text
+
+    def test_build_with_rollups(self):
+        prompt = services.PromptBuilder().build("average monthly close in 2020")
+
+        assert (
+            "CREATE TABLE core_teslastockdata_monthly "
+            "(period date, trading_days integer, last_close float, avg_close float);"
+        ) in prompt.text
+        assert "core_teslastockdata_weekly" not in prompt.text
+        assert "core_teslastockdata_yearly" not in prompt.text
+
+    def test_build_without_rollups(self):
+        prompt = services.PromptBuilder().build("latest close")
+
+        assert "Rollups" not in prompt.text
+        assert "core_teslastockdata_monthly" not in prompt.text
+
+
+class TestTemplateSqlGenerator:
+
+    @pytest.fixture
+    def fallback(self):
+        return mock.Mock(spec=services.AbstractSqlGenerator)
+
+    @pytest.fixture
+    def generator(self, fallback):
+        return services.TemplateSqlGenerator(fallback, model="llama2")
+
+    @pytest.mark.parametrize(
+        "question, sql",
+        [
+            (
+                "close price on 2021-03-04",
+                "SELECT date, close FROM core_teslastockdata WHERE date = '2021-03-04'",
+            ),
+            (
+                "What was the opening price on 2021/03/04?",
+                "SELECT date, open FROM core_teslastockdata WHERE date = '2021-03-04'",
+            ),
+            (
+                "true range from 2021-03-05 to 2021-03-01",
+                'SELECT date, "TrueRange" FROM core_teslastockdata '
+                "WHERE date BETWEEN '2021-03-01' AND '2021-03-05' ORDER BY date",
+            ),
+            (
+                "latest RSI 14",
+                "SELECT date, rsi_14 FROM core_teslastockdata "
+                "WHERE rsi_14 IS NOT NULL ORDER BY date DESC LIMIT 1",
+            ),
+            (
+                "oldest next day close",
+                "SELECT date, next_day_close FROM core_teslastockdata "
+                "WHERE next_day_close IS NOT NULL ORDER BY date ASC LIMIT 1",
+            ),
+            (
+                "highest volume in 2019",
+                "SELECT MAX(volume) AS max_volume FROM core_teslastockdata "
+                "WHERE date BETWEEN '2019-01-01' AND '2019-12-31'",
+            ),
+            ("average close", "SELECT AVG(close) AS avg_close FROM core_teslastockdata"),
+            (
+                "average rsi_7 per month",
+                "SELECT period AS month, avg_rsi_7 FROM core_teslastockdata_monthly ORDER BY period",
+            ),
+            (
+                "max volume per year",
+                "SELECT date_trunc('year', date)::date AS year, MAX(volume) AS max_volume "
+                "FROM core_teslastockdata GROUP BY 1 ORDER BY 1",
+            ),
+        ],
+    )
+    def test_hit(self, question, sql, generator, fallback):
+        assert generator.generate_sql(question) == sql
+        fallback.generate_sql.assert_not_called()
+        assert metrics.template_sql_questions.get(model="llama2", result="hit") == 1
+
+    @pytest.mark.parametrize(
+        "question",
+        [
+            "latest rsi",
+            "average true range in 2020",
+            "close on 2021-02-30",
+            "give me all the records of 2021",
+            "highest close and volume in 2019",
+        ],
+    )
+    def test_miss(self, question, generator, fallback):
+        fallback.generate_sql.return_value = "SELECT 1"
+
+        assert generator.generate_sql(question) == "SELECT 1"
+        fallback.generate_sql.assert_called_once_with(question)
+        assert metrics.template_sql_questions.get(model="llama2", result="miss") == 1
+
+    @pytest.mark.django_db
+    def test_sql_runs(self, generator):
+        make_stock_data(3)
+        questions = [
+            "close on 2014-01-02",
+            "volume from 2014-01-01 to 2014-01-03",
+            "latest true range",
+            "lowest low in 2014",
+            "total volume per week",
+            "max volume per month",
+        ]
+
+        for question in questions:
+            services.DjangoQueryExecutor().execute(generator.generate_sql(question))
+
+    def test_stream(self, generator, fallback):
+        fallback.stream_sql.return_value = iter(["SELECT ", "1"])
+
+        assert list(generator.stream_sql("average close")) == [
+            "SELECT AVG(close) AS avg_close FROM core_teslastockdata"
+        ]
+        assert list(generator.stream_sql("anything else")) == ["SELECT ", "1"]
+
+    def test_agenerate_sql(self, generator, fallback):
+        fallback.agenerate_sql = mock.AsyncMock(return_value="SELECT 1")
+
+        assert async_to_sync(generator.agenerate_sql)("latest close").startswith("SELECT date")
+        assert async_to_sync(generator.agenerate_sql)("anything else") == "SELECT 1"
+
+    def test_registry(self, settings):
+        settings.TEMPLATE_SQL_ENABLED = True
+
+        sql_generator = services.build_sql_generator("llama2")
+
+        assert isinstance(sql_generator, services.TemplateSqlGenerator)
+        assert isinstance(sql_generator.sql_generator, services.CachedSqlGenerator)
+
+
+class TestLRUCache:
+
+    def test_get_set(self):
+        cache = services.LRUCache(maxsize=2)
+        cache.set("a", 1)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("b", "default") == "default"
+
+    def test_evicts_least_recently_used(self):
+        cache = services.LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert len(cache) == 2
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+
+    @mock.patch("core.services.time.monotonic")
+    def test_evicts_expired(self, mock_monotonic):
+        cache = services.LRUCache(maxsize=2, ttl=10)
+        mock_monotonic.return_value = 100
+        cache.set("a", 1)
+
+        mock_monotonic.return_value = 109
+        assert cache.get("a") == 1
+
+        mock_monotonic.return_value = 110
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+
+class TestCachedSqlGenerator:
+
+    @pytest.mark.parametrize(
+        "query, other_query",
+        [
+            ("give the maximum close price", "give the maximum close price"),
+            ("give the maximum close price", "  Give the  MAXIMUM close price? "),
+        ],
+    )
+    def test_memory_hit(self, query, other_query):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        generator = services.CachedSqlGenerator(
+            mock_sql_generator,
+            model="llama2",
+            cache=services.LRUCache(maxsize=10),
+            persistent=False,
+        )
+
+        assert generator.generate_sql(query) == generator.generate_sql(other_query)
+        mock_sql_generator.generate_sql.assert_called_once_with(query)
+
+    def test_key_depends_on_model_and_prompt_version(self):
+        mock_sql_generator = mock.Mock(spec=services.OllamaSqlGenerator)
+        mock_sql_generator.prompt_version = "v1"
+        generator = services.CachedSqlGenerator(
+            mock_sql_generator, model="llama2", persistent=False
+        )
+        key = generator._get_key("give the maximum close price")
+
+        mock_sql_generator.prompt_version = "v2"
+        assert generator._get_key("give the maximum close price") != key
+
+        generator.model = "mistral"
+        mock_sql_generator.prompt_version = "v1"
+        assert generator._get_key("give the maximum close price") != key
+
+    @pytest.mark.django_db
+    def test_persistent_hit(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.return_value = "SELECT 1"
+        query = "give the maximum close price"
+
+        for _ in range(2):
+            generator = services.CachedSqlGenerator(
+                mock_sql_generator,
+                model="llama2",
+                cache=services.LRUCache(maxsize=10),
+                persistent=True,
+            )
+            assert generator.generate_sql(query) == "SELECT 1"
+
+        mock_sql_generator.generate_sql.assert_called_once_with(query)
+        assert GeneratedSql.objects.get().sql == "SELECT 1"
+
+    def test_agenerate_sql(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.agenerate_sql = mock.AsyncMock(return_value="SELECT 1")
+        generator = services.CachedSqlGenerator(
+            mock_sql_generator,
+            model="llama2",
+            cache=services.LRUCache(maxsize=10),
+            persistent=False,
+        )
+
+        assert async_to_sync(generator.agenerate_sql)("query") == "SELECT 1"
+        assert async_to_sync(generator.agenerate_sql)("Query?") == "SELECT 1"
+        assert generator.generate_sql("query") == "SELECT 1"
+        mock_sql_generator.agenerate_sql.assert_awaited_once_with("query")
+
+    def test_stream_sql(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.stream_sql.return_value = iter(["SELECT ", "1"])
+        generator = services.CachedSqlGenerator(
+            mock_sql_generator,
+            model="llama2",
+            cache=services.LRUCache(maxsize=10),
+            persistent=False,
+        )
+
+        assert list(generator.stream_sql("query")) == ["SELECT ", "1"]
+        assert list(generator.stream_sql("query")) == ["SELECT 1"]
+        assert generator.generate_sql("query") == "SELECT 1"
+        mock_sql_generator.stream_sql.assert_called_once_with("query")
+        mock_sql_generator.generate_sql.assert_not_called()
+
+
+class FakeEmbedder(services.AbstractEmbedder):
+
+    def embed(self, text):
+        vector = np.zeros(64, dtype=np.float32)
+        for word in text.split():
+            vector[zlib.crc32(word.encode()) % 64] += 1
+        return vector
+
+
+class TestVectorIndex:
+
+    def test_search(self):
+        index = services.VectorIndex(capacity=10, initial_capacity=1)
+        index.add([1, 0, 0], "x")
+        index.add([0, 1, 0], "y")
+        index.add([1, 1, 0], "xy")
+
+        results = index.search([2, 0.1, 0], k=2)
+
+        assert [value for _, value in results] == ["x", "xy"]
+        assert results[0][0] == pytest.approx(0.9988, abs=1e-3)
+
+    def test_empty(self):
+        assert services.VectorIndex(capacity=10).search([1, 0]) == []
+
+    def test_capacity(self):
+        index = services.VectorIndex(capacity=2, initial_capacity=1)
+        index.add([1, 0], "x")
+        index.add([0, 1], "y")
+        index.add([1, 1], "xy")
+
+        assert len(index) == 2
+        assert [value for _, value in index.search([1, 0], k=2)] == ["xy", "y"]
+
+
+class TestSemanticCachedSqlGenerator:
+
+    def _get_generator(self, mock_sql_generator):
+        return services.SemanticCachedSqlGenerator(
+            mock_sql_generator,
+            model="llama2",
+            embedder=FakeEmbedder(),
+            index=services.VectorIndex(capacity=10),
+            threshold=0.6,
+        )
+
+    def test_paraphrase_hit(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        generator = self._get_generator(mock_sql_generator)
+
+        sql = generator.generate_sql("latest close price")
+
+        assert generator.generate_sql("What was the latest close price?") == sql
+        mock_sql_generator.generate_sql.assert_called_once_with("latest close price")
+
+    def test_unrelated_miss(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        generator = self._get_generator(mock_sql_generator)
+
+        generator.generate_sql("latest close price")
+        generator.generate_sql("highest volume ever traded")
+
+        assert mock_sql_generator.generate_sql.call_count == 2
+
+    def test_different_literals_miss(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        generator = self._get_generator(mock_sql_generator)
+
+        generator.generate_sql("close price on 2021-03-04")
+        generator.generate_sql("close price on 2021-03-05")
+
+        assert mock_sql_generator.generate_sql.call_count == 2
+
+    def test_failing_embedder(self, caplog):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.return_value = "SELECT 1"
+        mock_sql_generator.stream_sql.return_value = iter(["SELECT 1"])
+        mock_embedder = mock.Mock(spec=services.AbstractEmbedder)
+        mock_embedder.embed.side_effect = httpx.ConnectError("Connection refused")
+        generator = services.SemanticCachedSqlGenerator(
+            mock_sql_generator,
+            model="llama2",
+            embedder=mock_embedder,
+            index=services.VectorIndex(capacity=10),
+        )
+
+        assert generator.generate_sql("latest close price") == "SELECT 1"
+        assert list(generator.stream_sql("latest close price")) == ["SELECT 1"]
+        assert mock_sql_generator.generate_sql.call_count == 1
+        assert len(generator.index) == 0
+        assert "Semantic cache lookup failed: Connection refused" in caplog.text
+
+    @mock.patch("core.services.ollama.Client")
+    def test_ollama_embedder(self, mock_client, settings):
+        mock_client.return_value.embeddings.return_value = {"embedding": [1.0, 2.0]}
+
+        vector = services.OllamaEmbedder(model="llama2").embed("test")
+
+        mock_client.return_value.embeddings.assert_called_once_with(
+            model="llama2", prompt="test", keep_alive=settings.OLLAMA_KEEP_ALIVE
+        )
+        assert vector.tolist() == [1.0, 2.0]
+
+
+class TestNormalizeSql:
+
+    @pytest.mark.parametrize(
+        "sql, expected",
+        [
+            ("  SELECT  date\n FROM core_teslastockdata ; ", "SELECT date FROM core_teslastockdata"),
+            ("SELECT 'a  b'  AS \"x  y\"", "SELECT 'a  b' AS \"x  y\""),
+            ("SELECT 'it''s  ok'", "SELECT 'it''s  ok'"),
+        ],
+    )
+    def test_normalize_sql(self, sql, expected):
+        assert services.normalize_sql(sql) == expected
+
+
+class TestResultCache:
+
+    def _get_cache(self, **kwargs):
+        return services.ResultCache(
+            **{
+                "max_bytes": 10000,
+                "max_entry_bytes": 5000,
+                "max_entry_rows": 10,
+                **kwargs,
+            }
+        )
+
+    def test_hits_and_misses(self):
+        cache = self._get_cache()
+
+        assert cache.get("a") is None
+        assert cache.set("a", [{"close": 1.0}])
+        assert cache.get("a") == [{"close": 1.0}]
+        assert cache.stats() == {
+            "entries": 1,
+            "bytes": cache.size,
+            "hits": 1,
+            "misses": 1,
+            "evictions": 0,
+            "rejections": 0,
+        }
+
+    @pytest.mark.parametrize(
+        "kwargs", [{"max_entry_rows": 1}, {"max_entry_bytes": 10}, {"max_bytes": 10}]
+    )
+    def test_rejects_large_entries(self, kwargs):
+        cache = self._get_cache(**kwargs)
+
+        assert not cache.set("a", [{"close": 1.0}, {"close": 2.0}])
+        assert cache.get("a") is None
+        assert cache.stats()["rejections"] == 1
+
+    def test_evicts_to_memory_cap(self):
+        cache = self._get_cache()
+        entry_size = cache._estimate_size([{"close": 1.0}])
+        cache.max_bytes = 2 * entry_size
+
+        for key in "abc":
+            cache.set(key, [{"close": 1.0}])
+
+        assert cache.get("a") is None
+        assert cache.get("c") is not None
+        assert cache.size == 2 * entry_size
+        assert cache.stats()["evictions"] == 1
+
+    def test_set_version_clears(self):
+        cache = self._get_cache()
+        cache.set_version(1)
+        cache.set("a", [])
+
+        cache.set_version(1)
+        assert cache.get("a") == []
+
+        cache.set_version(2)
+        assert cache.get("a") is None
+
+
+class TestCachedQueryExecutor:
+
+    def _get_executor(self, version=1):
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        mock_query_executor.execute.return_value = [{"close": 1.0}]
+        mock_data_version = mock.Mock(spec=services.DataVersionChecker)
+        mock_data_version.get_version.return_value = version
+        executor = services.CachedQueryExecutor(
+            mock_query_executor,
+            cache=services.ResultCache(
+                max_bytes=10000, max_entry_bytes=10000, max_entry_rows=10
+            ),
+            data_version=mock_data_version,
+        )
+        return executor, mock_query_executor, mock_data_version
+
+    def test_hit(self):
+        executor, mock_query_executor, _ = self._get_executor()
+
+        assert executor.execute("SELECT close FROM core_teslastockdata") == [
+            {"close": 1.0}
+        ]
+        assert executor.execute(" SELECT close\nFROM core_teslastockdata;") == [
+            {"close": 1.0}
+        ]
+        mock_query_executor.execute.assert_called_once_with(
+            "SELECT close FROM core_teslastockdata"
+        )
+
+    def test_invalidated_by_data_version(self):
+        executor, mock_query_executor, mock_data_version = self._get_executor()
+
+        executor.execute("SELECT close FROM core_teslastockdata")
+        mock_data_version.get_version.return_value = 2
+        executor.execute("SELECT close FROM core_teslastockdata")
+
+        assert mock_query_executor.execute.call_count == 2
+
+    def test_execute_rows(self):
+        executor, mock_query_executor, _ = self._get_executor()
+        mock_query_executor.execute_rows.return_value = services.QueryRows(
+            ["close"], [(1.0,)]
+        )
+        sql = "SELECT close FROM core_teslastockdata"
+
+        executor.execute(sql)
+        rows = executor.execute_rows(sql)
+
+        assert executor.execute_rows(sql) is rows
+        assert rows.columns == ["close"]
+        mock_query_executor.execute_rows.assert_called_once_with(sql)
+        mock_query_executor.execute.assert_called_once_with(sql)
+
+    def test_execute_iter(self):
+        executor, mock_query_executor, _ = self._get_executor()
+        mock_query_executor.execute_iter.return_value = iter(
+            [[{"close": 1.0}, {"close": 2.0}], [{"close": 3.0}]]
+        )
+        sql = "SELECT close FROM core_teslastockdata"
+
+        assert list(executor.execute_iter(sql, 2)) == [
+            [{"close": 1.0}, {"close": 2.0}],
+            [{"close": 3.0}],
+        ]
+        assert list(executor.execute_iter(sql, 2)) == [
+            [{"close": 1.0}, {"close": 2.0}],
+            [{"close": 3.0}],
+        ]
+        mock_query_executor.execute_iter.assert_called_once_with(sql, 2)
+
+    def test_execute_after_execute_iter(self):
+        executor, mock_query_executor, _ = self._get_executor()
+        mock_query_executor.execute_iter.return_value = iter(
+            [[{"close": 1.0}, {"close": 2.0}], [{"close": 3.0}]]
+        )
+        capped = services.QueryResult([{"close": 1.0}, {"close": 2.0}])
+        capped.truncated = True
+        mock_query_executor.execute.return_value = capped
+        sql = "SELECT close FROM core_teslastockdata"
+
+        list(executor.execute_iter(sql, 2))
+        rows = executor.execute(sql)
+
+        assert rows == [{"close": 1.0}, {"close": 2.0}]
+        assert rows.truncated
+        mock_query_executor.execute.assert_called_once_with(sql)
+
+    @pytest.mark.parametrize(
+        "sql",
+        [
+            "DELETE FROM core_teslastockdata",
+            "SELECT close FROM core_teslastockdata WHERE date > now() - interval '1 year'",
+            "SELECT random()",
+        ],
+    )
+    def test_not_cacheable(self, sql):
+        executor, mock_query_executor, mock_data_version = self._get_executor()
+
+        executor.execute(sql)
+        executor.execute(sql)
+
+        assert mock_query_executor.execute.call_count == 2
+        mock_data_version.get_version.assert_not_called()
+
+    @pytest.mark.django_db
+    def test_data_version_checker(self, settings):
+        settings.DATA_VERSION_CHECK_INTERVAL = 0
+        checker = services.DataVersionChecker("core_teslastockdata")
+
+        assert checker.get_version() == 0
+        DataVersion.bump("core_teslastockdata")
+        assert checker.get_version() == 1
+
+
+class TestSqliteSnapshotExecutor:
+
+    def _get_executor(self):
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        mock_data_version = mock.Mock(spec=services.DataVersionChecker)
+        mock_data_version.get_version.return_value = 1
+        snapshot = services.SqliteSnapshot(
+            [TeslaStockData, TeslaStockMonthly], data_version=mock_data_version
+        )
+        executor = services.SqliteSnapshotExecutor(mock_query_executor, snapshot=snapshot)
+        return executor, mock_query_executor, mock_data_version
+
+    @pytest.mark.django_db
+    def test_execute(self):
+        stock_data = make_stock_data(3)
+        executor, mock_query_executor, _ = self._get_executor()
+
+        rows = executor.execute(
+            'SELECT date, close, "TrueRange" FROM core_teslastockdata ORDER BY date'
+        )
+
+        assert rows == [
+            {"date": data.date, "close": data.close, "TrueRange": data.TrueRange}
+            for data in stock_data
+        ]
+        assert isinstance(rows[0]["date"], datetime.date)
+        assert not rows.truncated
+        mock_query_executor.execute.assert_not_called()
+
+    @pytest.mark.django_db
+    def test_execute_rows(self):
+        stock_data = make_stock_data(2)
+        executor, mock_query_executor, _ = self._get_executor()
+
+        rows = executor.execute_rows(
+            "SELECT date, close FROM core_teslastockdata ORDER BY date"
+        )
+
+        assert rows.columns == ["date", "close"]
+        assert rows == [(data.date, data.close) for data in stock_data]
+        mock_query_executor.execute_rows.assert_not_called()
+
+    @pytest.mark.django_db
+    def test_execute_rollups(self):
+        make_stock_data(3)
+        with connection.cursor() as cursor:
+            cursor.execute("REFRESH MATERIALIZED VIEW core_teslastockdata_monthly")
+        executor, mock_query_executor, _ = self._get_executor()
+
+        assert executor.execute(
+            "SELECT period, trading_days FROM core_teslastockdata_monthly"
+        ) == [{"period": datetime.date(2014, 1, 1), "trading_days": 3}]
+        mock_query_executor.execute.assert_not_called()
+
+    @pytest.mark.django_db
+    def test_execute_max_rows(self, settings):
+        settings.QUERY_MAX_ROWS = 2
+        make_stock_data(3)
+        executor, _, _ = self._get_executor()
+
+        rows = executor.execute("SELECT date FROM core_teslastockdata")
+
+        assert len(rows) == 2
+        assert rows.truncated
+
+    @pytest.mark.django_db
+    def test_rebuilt_on_data_version(self):
+        make_stock_data(3)
+        executor, _, mock_data_version = self._get_executor()
+        sql = "SELECT count(*) AS total FROM core_teslastockdata"
+
+        assert executor.execute(sql) == [{"total": 3}]
+
+        baker.make("core.TeslaStockData", date="2020-01-01")
+        assert executor.execute(sql) == [{"total": 3}]
+
+        mock_data_version.get_version.return_value = 2
+        assert executor.execute(sql) == [{"total": 4}]
+
+    @pytest.mark.django_db
+    @pytest.mark.parametrize(
+        "sql",
+        [
+            "SELECT date_trunc('year', date) AS year FROM core_teslastockdata",
+            "SELECT MAX(close) FROM core_teslastockdata",
+            "SELECT truerange FROM core_teslastockdata",
+            "SELECT date FROM core_teslastockdata WHERE date = current_date",
+            "DELETE FROM core_teslastockdata",
+            "SELECT date FROM core_teslastockdata ORDER BY sma_50 DESC LIMIT 1",
+            "SELECT date FROM core_teslastockdata ORDER BY date, rsi_14",
+            "SELECT date FROM core_teslastockdata ORDER BY 1",
+            "SELECT max(rsi_14) OVER (ORDER BY sma_50) AS a FROM core_teslastockdata",
+            "SELECT close FROM core_teslastockdata WHERE date = '2020-1-2'",
+            "SELECT close FROM core_teslastockdata WHERE date = '2020/01/02'",
+            "SELECT close FROM core_teslastockdata WHERE date > 'Jan 2 2020'",
+            "SELECT close FROM core_teslastockdata WHERE date = '2020-02-30'",
+            "SELECT date + 1 AS next_date FROM core_teslastockdata",
+            "SELECT CAST(date AS text) AS day FROM core_teslastockdata",
+            "SELECT sum(volume) AS total FROM core_teslastockdata",
+            "SELECT avg(trading_days) AS days FROM core_teslastockdata_monthly",
+        ],
+    )
+    def test_fallback(self, sql):
+        executor, mock_query_executor, _ = self._get_executor()
+
+        assert executor.execute(sql) == mock_query_executor.execute.return_value
+        mock_query_executor.execute.assert_called_once_with(sql)
+
+    @pytest.mark.django_db
+    @pytest.mark.parametrize(
+        "order_by, expected",
+        [("sma_50 DESC NULLS LAST", [2, 1, None]), ('"TrueRange" NULLS FIRST', [None, 1, 2])],
+    )
+    def test_explicit_nulls_order(self, order_by, expected):
+        for day, value in enumerate([1, None, 2], start=1):
+            baker.make(
+                "core.TeslaStockData",
+                date=datetime.date(2014, 1, day),
+                sma_50=value,
+                TrueRange=value,
+            )
+        executor, mock_query_executor, _ = self._get_executor()
+
+        rows = executor.execute(
+            f"SELECT sma_50 FROM core_teslastockdata ORDER BY {order_by}"
+        )
+
+        assert [row["sma_50"] for row in rows] == expected
+        mock_query_executor.execute.assert_not_called()
+
+    @pytest.mark.django_db
+    @pytest.mark.parametrize(
+        "sql",
+        [
+            "SELECT close FROM core_teslastockdata WHERE date = '2014-1-2'",
+            "SELECT close FROM core_teslastockdata WHERE date >= '2014-01-02' ORDER BY date",
+            "SELECT sum(volume) AS total, avg(volume) AS average FROM core_teslastockdata",
+            "SELECT sum(close) AS total, avg(close) AS average, count(*) AS days "
+            "FROM core_teslastockdata",
+        ],
+    )
+    def test_same_as_postgres(self, sql):
+        make_stock_data(3)
+        snapshot = services.SqliteSnapshot([TeslaStockData, TeslaStockMonthly])
+        executor = services.SqliteSnapshotExecutor(
+            services.DjangoQueryExecutor(), snapshot=snapshot
+        )
+
+        rows = executor.execute(sql)
+        expected = services.DjangoQueryExecutor().execute(sql)
+
+        assert rows == expected
+        assert [
+            {column: type(value) for column, value in row.items()} for row in rows
+        ] == [{column: type(value) for column, value in row.items()} for row in expected]
+
+    @pytest.mark.django_db
+    def test_warm_up_rollup_order(self):
+        baker.make("core.TeslaStockData", date=datetime.date(2014, 1, 2), sma_100=None)
+        baker.make("core.TeslaStockData", date=datetime.date(2014, 2, 3), sma_100=1.0)
+        with connection.cursor() as cursor:
+            cursor.execute("REFRESH MATERIALIZED VIEW core_teslastockdata_monthly")
+        snapshot = services.SqliteSnapshot([TeslaStockData, TeslaStockMonthly])
+        executor = services.SqliteSnapshotExecutor(
+            services.DjangoQueryExecutor(), snapshot=snapshot
+        )
+        sql = "SELECT period FROM core_teslastockdata_monthly ORDER BY avg_sma_100"
+
+        assert executor.execute(sql) == services.DjangoQueryExecutor().execute(sql) == [
+            {"period": datetime.date(2014, 2, 1)},
+            {"period": datetime.date(2014, 1, 1)},
+        ]
+
+    @pytest.mark.django_db
+    def test_connection_per_thread(self):
+        make_stock_data(3)
+        executor, mock_query_executor, _ = self._get_executor()
+        sql = "SELECT count(*) AS total FROM core_teslastockdata"
+        connections = []
+
+        def execute():
+            assert executor.execute(sql) == [{"total": 3}]
+            connections.append(executor.snapshot._get_connection())
+
+        execute()
+        thread = threading.Thread(target=execute)
+        thread.start()
+        thread.join()
+
+        assert len(connections) == 2
+        assert connections[0] is not connections[1]
+        mock_query_executor.execute.assert_not_called()
+
+    @pytest.mark.django_db
+    def test_execute_iter(self):
+        make_stock_data(3)
+        executor, mock_query_executor, _ = self._get_executor()
+
+        batches = list(executor.execute_iter("SELECT id FROM core_teslastockdata", 2))
+
+        assert [len(batch) for batch in batches] == [2, 1]
+        mock_query_executor.execute_iter.assert_not_called()
+
+    @pytest.mark.django_db
+    def test_execute_iter_fallback(self):
+        executor, mock_query_executor, _ = self._get_executor()
+        mock_query_executor.execute_iter.return_value = iter([[{"a": 1}]])
+
+        assert list(executor.execute_iter("SELECT now() AS a", 2)) == [[{"a": 1}]]
+
+    @pytest.mark.django_db
+    def test_read_only(self):
+        executor, _, _ = self._get_executor()
+
+        with pytest.raises(sqlite3.OperationalError, match="readonly"):
+            executor.snapshot.execute("CREATE TABLE test (a)")
+
+    @pytest.mark.django_db
+    def test_timeout(self, settings):
+        settings.QUERY_STATEMENT_TIMEOUT = 10
+        executor, mock_query_executor, _ = self._get_executor()
+
+        with pytest.raises(TimeoutError):
+            executor.execute(
+                "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+                "SELECT count(*) AS total FROM c"
+            )
+        mock_query_executor.execute.assert_not_called()
+
+    def test_build_query_executor(self, settings):
+        settings.SNAPSHOT_EXECUTOR_ENABLED = True
+        settings.RESULT_CACHE_ENABLED = False
+
+        query_executor = services.build_query_executor()
+
+        assert isinstance(query_executor, services.SqliteSnapshotExecutor)
+        assert isinstance(query_executor.query_executor, services.DjangoQueryExecutor)
+
+
+class TestResolveBatchView:
+
+    def test_url(self):
+        assert reverse("resolve_batch") == "/api/v1/resolve_batch/"
+
+    @pytest.mark.parametrize(
+        "body, error",
+        [
+            ("not json", "Invalid JSON body."),
+            ("{}", "No questions provided."),
+            ('{"questions": []}', "No questions provided."),
+            ('{"questions": [1]}', 'Each question must be a string or an object with "q" and an optional "model".'),
+            ('{"questions": [{"q": ""}]}', 'Each question must be a string or an object with "q" and an optional "model".'),
+            ('{"questions": ["a", "b", "c"]}', "Too many questions, the maximum is 2."),
+        ],
+    )
+    def test_bad_request(self, body, error, client, settings):
+        settings.BATCH_MAX_QUESTIONS = 2
+
+        response = client.post(
+            reverse("resolve_batch"), body, content_type="application/json"
+        )
+
+        assert response.status_code == 400
+        assert response.json() == {"error": error}
+
+    @mock.patch("core.services.BatchResolver")
+    def test_batch_resolver_is_used(self, mock_batch_resolver, client):
+        mock_batch_resolver.return_value.resolve.return_value = [{"random": "data"}]
+
+        response = client.post(
+            reverse("resolve_batch"),
+            {"questions": ["oldest date", {"q": "newest date", "model": "mistral"}]},
+            content_type="application/json",
+        )
+
+        assert response.status_code == 200
+        assert response.json() == {"results": [{"random": "data"}]}
+        mock_batch_resolver.return_value.resolve.assert_called_once_with(
+            [("oldest date", None), ("newest date", "mistral")]
+        )
+
+
+def make_job(**kwargs):
+    return baker.make(Job, **{"model": settings.AVAILABLE_MODELS[0], **kwargs})
+
+
+@pytest.mark.django_db
+class TestJob:
+
+    def test_claim(self):
+        first = make_job(question="first")
+        make_job(question="second")
+        make_job(question="done", status=Job.DONE)
+
+        job = Job.claim(timeout=60)
+
+        assert job == first
+        assert job.status == Job.RUNNING
+        assert job.started_at is not None
+        assert Job.claim(timeout=60).question == "second"
+        assert Job.claim(timeout=60) is None
+
+    def test_claim_stale(self):
+        stale = make_job(
+            status=Job.RUNNING,
+            started_at=timezone.now() - datetime.timedelta(seconds=120),
+        )
+        make_job(status=Job.RUNNING, started_at=timezone.now())
+
+        assert Job.claim(timeout=60) == stale
+
+    @pytest.mark.django_db(transaction=True)
+    def test_claim_skips_locked(self):
+        make_job(question="first")
+        make_job(question="second")
+        claimed = []
+
+        def claim():
+            claimed.append(Job.claim(timeout=60).question)
+            connection.close()
+
+        with transaction.atomic():
+            Job.objects.select_for_update().get(question="first")
+            thread = threading.Thread(target=claim)
+            thread.start()
+            thread.join(5)
+
+        assert claimed == ["second"]
+
+    def test_finish(self):
+        make_job()
+        job = Job.claim(timeout=60)
+
+        assert job.finish(result={"response": [1]}, ttl=60)
+
+        job.refresh_from_db()
+        assert job.status == Job.DONE
+        assert job.result == {"response": [1]}
+        assert job.finished
+
+    def test_finish_taken_over(self):
+        make_job()
+        job = Job.claim(timeout=60)
+        Job.objects.filter(id=job.id).update(started_at=timezone.now())
+
+        assert not job.finish(error="boom", ttl=60)
+        job.refresh_from_db()
+        assert job.status == Job.RUNNING
+
+
+@pytest.mark.django_db
+class TestJobWorker:
+
+    @mock.patch("core.services.QueryResolver")
+    def test_run_once(self, mock_query_resolver, settings):
+        settings.JOB_RESULT_TTL = 60
+        mock_query_resolver.return_value.resolve.return_value = {
+            "date": datetime.date(2020, 1, 2)
+        }
+        job = make_job(question="latest date", columnar=True)
+
+        assert jobs.JobWorker().run_once()
+
+        mock_query_resolver.assert_called_once_with(model=job.model)
+        mock_query_resolver.return_value.resolve.assert_called_once_with(
+            "latest date", columnar=True
+        )
+        job.refresh_from_db()
+        assert job.status == Job.DONE
+        assert job.result == {"date": "2020-01-02"}
+        assert job.expires_at - job.finished_at == datetime.timedelta(seconds=60)
+
+    @mock.patch("core.services.QueryResolver")
+    def test_run_once_error(self, mock_query_resolver):
+        mock_query_resolver.return_value.resolve.side_effect = ValueError("boom")
+        job = make_job()
+
+        assert jobs.JobWorker().run_once()
+
+        job.refresh_from_db()
+        assert job.status == Job.FAILED
+        assert job.error == "boom"
+
+    def test_run_once_empty(self):
+        assert not jobs.JobWorker().run_once()
+
+    def test_deletes_expired(self):
+        make_job(status=Job.DONE, expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        job = make_job(
+            status=Job.DONE, expires_at=timezone.now() + datetime.timedelta(hours=1)
+        )
+        running = make_job(status=Job.RUNNING, started_at=timezone.now())
+
+        jobs.JobWorker().run_once()
+
+        assert set(Job.objects.all()) == {job, running}
+
+    @mock.patch("core.services.QueryResolver")
+    def test_run_burst(self, mock_query_resolver):
+        mock_query_resolver.return_value.resolve.return_value = {}
+        make_job()
+        make_job()
+
+        jobs.JobWorker().run(burst=True)
+
+        assert not Job.objects.exclude(status=Job.DONE).exists()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_wait_wakes_up_on_submit(self, settings):
+        settings.JOB_POLL_INTERVAL = 5
+        waited = []
+
+        def wait():
+            started_at = time.monotonic()
+            jobs.JobWorker()._wait()
+            waited.append(time.monotonic() - started_at)
+            connection.close()
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.5)
+        jobs.submit_job("latest close", settings.AVAILABLE_MODELS[0])
+        thread.join(10)
+
+        assert waited[0] < 2
+
+
+@pytest.mark.django_db
+class TestJobViews:
+
+    def test_url(self):
+        assert reverse("jobs") == "/api/v1/jobs/"
+
+    @pytest.mark.parametrize(
+        "body, error",
+        [
+            ("not json", "Invalid JSON body."),
+            ("[]", "Invalid JSON body."),
+            ("{}", "No query provided."),
+            ('{"q": "a", "model": "unknown"}', "Invalid model: unknown"),
+            ('{"q": "a", "format": "csv"}', 'The format must be "json" or "columnar".'),
+        ],
+    )
+    def test_submit_bad_request(self, body, error, client):
+        response = client.post(reverse("jobs"), body, content_type="application/json")
+
+        assert response.status_code == 400
+        assert response.json() == {"error": error}
+
+    def test_submit(self, client):
+        response = client.post(
+            reverse("jobs"),
+            {"q": "latest close", "format": "columnar"},
+            content_type="application/json",
+        )
+
+        job = Job.objects.get()
+        assert response.status_code == 202
+        assert response.json() == {
+            "id": str(job.id),
+            "status": "pending",
+            "url": f"/api/v1/jobs/{job.id}/",
+        }
+        assert response["Location"] == f"/api/v1/jobs/{job.id}/"
+        assert job.question == "latest close"
+        assert job.model == settings.AVAILABLE_MODELS[0]
+        assert job.columnar
+
+    def test_detail(self, client):
+        job = make_job(status=Job.DONE, result={"response": [1]})
+
+        response = client.get(reverse("job", args=[job.id]))
+
+        assert response.status_code == 200
+        assert response.json()["status"] == "done"
+        assert response.json()["result"] == {"response": [1]}
+
+    def test_detail_failed(self, client):
+        job = make_job(status=Job.FAILED, error="boom")
+
+        response = client.get(reverse("job", args=[job.id]))
+
+        assert response.json()["error"] == "boom"
+        assert "result" not in response.json()
+
+    def test_detail_expired(self, client):
+        job = make_job(
+            status=Job.DONE, expires_at=timezone.now() - datetime.timedelta(seconds=1)
+        )
+
+        response = client.get(reverse("job", args=[job.id]))
+
+        assert response.status_code == 404
+        assert response.json() == {"error": "Job not found."}
+
+    def test_detail_old_pending(self, client, settings):
+        settings.JOB_RESULT_TTL = 0
+        job = jobs.submit_job("oldest date", settings.AVAILABLE_MODELS[0])
+        jobs.JobWorker()._delete_expired()
+
+        response = client.get(reverse("job", args=[job.id]))
+
+        assert response.status_code == 200
+        assert response.json()["status"] == Job.PENDING
+
+    def test_detail_stream(self, async_client, settings):
+        settings.JOB_POLL_INTERVAL = 0
+        job = make_job()
+        statuses = iter([Job.RUNNING, Job.RUNNING, Job.DONE])
+
+        async def arefresh_from_db(self):
+            self.status = next(statuses)
+
+        async def get_lines():
+            response = await async_client.get(
+                reverse("job", args=[job.id]), {"format": "stream"}
+            )
+            assert response.is_async
+            assert response["Content-Type"] == "application/x-ndjson"
+            return [json.loads(chunk) async for chunk in response.streaming_content]
+
+        with mock.patch.object(Job, "arefresh_from_db", arefresh_from_db), mock.patch(
+            "core.views.asyncio.sleep", wraps=asyncio.sleep
+        ) as sleep:
+            lines = async_to_sync(get_lines)()
+
+        assert [line["status"] for line in lines] == ["pending", "running", "done"]
+        assert sleep.await_count == 3
+
+
+class TestSingleFlight:
+
+    def test_do(self):
+        flights = services.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"rows": [1]}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.do("key", func)))
+        leader.start()
+        started.wait(5)
+        followers = [
+            threading.Thread(target=lambda: results.append(flights.do("key", func)))
+            for _ in range(3)
+        ]
+        for follower in followers:
+            follower.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+
+        assert len(calls) == 1
+        assert sorted(shared for _, shared in results) == [False, True, True, True]
+        assert all(result is results[0][0] for result, _ in results)
+        assert len(flights) == 0
+        assert flights.do("key", lambda: "again") == ("again", False)
+
+    def test_do_error(self):
+        flights = services.SingleFlight()
+        started = threading.Event()
+        errors = []
+
+        def func():
+            started.set()
+            time.sleep(0.1)
+            raise ValueError("broken")
+
+        def call():
+            try:
+                flights.do("key", func)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=call)
+        follower.start()
+        leader.join(5)
+        follower.join(5)
+
+        assert len(errors) == 2
+        assert errors[0] is errors[1]
+        assert len(flights) == 0
+
+    def test_ado(self):
+        flights = services.SingleFlight()
+        calls = []
+
+        async def func():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def run():
+            leader = asyncio.ensure_future(flights.ado("key", func))
+            await asyncio.sleep(0)
+            followers = [flights.ado("key", func) for _ in range(2)]
+            # A caller going away does not cancel the others.
+            leader.cancel()
+            return await asyncio.gather(*followers)
+
+        assert async_to_sync(run)() == [("result", True), ("result", True)]
+        assert len(calls) == 1
+        assert len(flights) == 0
+
+    def test_query_resolver(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.side_effect = lambda query: time.sleep(0.2) or "SELECT 1"
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        mock_query_executor.execute.return_value = [{"one": 1}]
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator, query_executor=mock_query_executor
+        )
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            responses = list(executor.map(resolver.resolve, ["one"] * 3))
+
+        assert responses == [
+            {"query": "one", "attempted_query": "SELECT 1", "response": [{"one": 1}]}
+        ] * 3
+        mock_sql_generator.generate_sql.assert_called_once_with("one")
+        mock_query_executor.execute.assert_called_once_with("SELECT 1")
+        assert metrics.coalesced_requests.get(model=settings.AVAILABLE_MODELS[0]) == 2
+
+    def test_query_resolver_normalizes_question(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.side_effect = lambda query: time.sleep(0.2) or "SELECT 1"
+        mock_query_executor = mock.Mock(spec=services.AbstractQueryExecutor)
+        mock_query_executor.execute.return_value = [{"one": 1}]
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator, query_executor=mock_query_executor
+        )
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            responses = list(executor.map(resolver.resolve, ["one", "One?", " one "]))
+
+        assert [response["query"] for response in responses] == ["one", "One?", " one "]
+        assert mock_sql_generator.generate_sql.call_count == 1
+
+    def test_query_resolver_other_backends(self):
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.side_effect = lambda query: time.sleep(0.2) or "SELECT 1"
+        resolvers = [
+            services.QueryResolver(
+                sql_generator=mock_sql_generator,
+                query_executor=mock.Mock(spec=services.AbstractQueryExecutor),
+            )
+            for _ in range(2)
+        ]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda resolver: resolver.resolve("one"), resolvers))
+
+        assert mock_sql_generator.generate_sql.call_count == 2
+        for resolver in resolvers:
+            resolver.query_executor.execute.assert_called_once_with("SELECT 1")
+
+    def test_query_resolver_disabled(self, settings):
+        settings.SINGLE_FLIGHT_ENABLED = False
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.side_effect = lambda query: time.sleep(0.1) or "SELECT 1"
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=mock.Mock(spec=services.AbstractQueryExecutor),
+        )
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(resolver.resolve, ["one"] * 2))
+
+        assert mock_sql_generator.generate_sql.call_count == 2
+
+    @pytest.mark.django_db
+    def test_advisory_lock(self, settings):
+        settings.SINGLE_FLIGHT_ADVISORY_LOCK = True
+
+        def count_advisory_locks():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' "
+                    "AND pid = pg_backend_pid()"
+                )
+                return cursor.fetchone()[0]
+
+        mock_sql_generator = mock.Mock(spec=services.AbstractSqlGenerator)
+        mock_sql_generator.generate_sql.side_effect = lambda query: (
+            f"SELECT {count_advisory_locks()} AS locks"
+        )
+        resolver = services.QueryResolver(
+            sql_generator=mock_sql_generator,
+            query_executor=services.DjangoQueryExecutor(),
+        )
+
+        assert resolver.resolve("locks")["response"] == [{"locks": 1}]
+        assert count_advisory_locks() == 0
+
+
+class TestModelScheduler:
+
+    def _get_scheduler(self, concurrency=1, max_queue=10, max_wait=5.0, duration=None):
+        durations = services.LatencyTracker(min_samples=1)
+        if duration is not None:
+            durations.add(duration)
+        return services.ModelScheduler(
+            "llama2",
+            concurrency=concurrency,
+            max_queue=max_queue,
+            max_wait=max_wait,
+            durations=durations,
+        )
+
+    def test_slot(self):
+        scheduler = self._get_scheduler(concurrency=2)
+
+        with scheduler.slot(), scheduler.slot():
+            assert scheduler.active == 2
+        assert scheduler.active == 0
+
+    def test_priority_order(self):
+        scheduler = self._get_scheduler(duration=0.01)
+        order = []
+
+        def acquire(value, name):
+            with services.priority(value), scheduler.slot():
+                order.append(name)
+
+        with scheduler.slot():
+            threads = []
+            for value, name in [
+                (services.PRIORITY_BATCH, "batch"),
+                (services.PRIORITY_API, "api"),
+                (services.PRIORITY_INTERACTIVE, "chat"),
+            ]:
+                thread = threading.Thread(target=acquire, args=(value, name))
+                thread.start()
+                threads.append(thread)
+                while len(scheduler._queue) < len(threads):
+                    time.sleep(0.001)
+        for thread in threads:
+            thread.join(5)
+
+        assert order == ["chat", "api", "batch"]
+        assert scheduler.active == 0
+
+    def test_reject_estimated_wait(self):
+        scheduler = self._get_scheduler(max_wait=5, duration=10)
+
+        with scheduler.slot():
+            with pytest.raises(services.ModelOverloaded) as exc_info:
+                with scheduler.slot():
+                    pass
+
+        assert exc_info.value.retry_after == 10
+        assert metrics.rejected_requests.get(model="llama2", priority="api") == 1
+        assert scheduler.active == 0
+
+    def test_reject_full_queue(self):
+        scheduler = self._get_scheduler(max_queue=0, duration=0)
+
+        with scheduler.slot():
+            with pytest.raises(services.ModelOverloaded):
+                scheduler.check(services.PRIORITY_INTERACTIVE)
+            with pytest.raises(services.ModelOverloaded):
+                with scheduler.slot():
+                    pass
+
+    def test_wait_timeout(self):
+        scheduler = self._get_scheduler(max_wait=0.05, duration=0)
+
+        with scheduler.slot():
+            with pytest.raises(services.ModelOverloaded):
+                with scheduler.slot():
+                    pass
+            assert scheduler._queue == []
+        assert scheduler.active == 0
+
+    def test_aslot(self):
+        scheduler = self._get_scheduler(duration=0.01)
+        order = []
+
+        async def acquire(name, delay):
+            async with scheduler.aslot():
+                order.append(name)
+                await asyncio.sleep(delay)
+
+        async def run():
+            first = asyncio.ensure_future(acquire("first", 0.05))
+            await asyncio.sleep(0)
+            cancelled = asyncio.ensure_future(acquire("cancelled", 0))
+            second = asyncio.ensure_future(acquire("second", 0))
+            await asyncio.sleep(0)
+            assert len(scheduler._queue) == 2
+            cancelled.cancel()
+            await asyncio.gather(first, second)
+
+        async_to_sync(run)()
+
+        assert order == ["first", "second"]
+        assert scheduler.active == 0
+        assert scheduler._queue == []
+
+    @mock.patch("core.services.ollama.Client")
+    def test_ollama_sql_generator(self, mock_client, settings):
+        settings.SCHEDULER_ENABLED = True
+        scheduler = services.get_model_scheduler("test-model")
+        active = []
+
+        def chat(**kwargs):
+            active.append(scheduler.active)
+            return {"message": {"content": "SELECT 1"}}
+
+        mock_client.return_value.chat.side_effect = chat
+
+        services.OllamaSqlGenerator(model="test-model").generate_sql("question")
+
+        assert active == [1]
+        assert scheduler.active == 0
+
+    @mock.patch("core.services.QueryResolver")
+    def test_view_overloaded(self, mock_query_resolver, client):
+        mock_query_resolver.return_value.resolve.side_effect = services.ModelOverloaded(
+            "llama2", 3
+        )
+
+        response = client.get(reverse("resolve_query"), {"q": "oldest date"})
+
+        assert response.status_code == 429
+        assert response["Retry-After"] == "3"
+        assert response.json() == {"error": "Model llama2 is overloaded, retry in 3s."}
+
+    @pytest.mark.parametrize(
+        "headers, expected",
+        [({"HX-Request": "true"}, services.PRIORITY_INTERACTIVE), ({}, services.PRIORITY_API)],
+    )
+    @mock.patch("core.services.QueryResolver")
+    def test_view_priority(self, mock_query_resolver, headers, expected, client):
+        priorities = []
+        mock_query_resolver.return_value.resolve.side_effect = lambda query, **kwargs: (
+            priorities.append(services.request_priority.get()) or {"random": "data"}
+        )
+
+        client.get(reverse("resolve_query"), {"q": "oldest date"}, headers=headers)
+
+        assert priorities == [expected]
+
+    @mock.patch("core.services.ollama.Client")
+    @mock.patch("core.services.QueryResolver")
+    def test_view_stream_holds_slot(self, mock_query_resolver, mock_client, client, settings):
+        settings.SCHEDULER_ENABLED = True
+        scheduler = services.get_model_scheduler("llama2")
+        mock_client.return_value.chat.return_value = iter(
+            [{"message": {"content": "SELECT 1"}, "done": True}]
+        )
+        generator = services.OllamaSqlGenerator(model="llama2")
+        states = []
+
+        def resolve_stream(query):
+            states.append((scheduler.active, services.request_priority.get()))
+            for token in generator.stream_sql(query):
+                states.append((scheduler.active, services.request_priority.get()))
+                yield {"event": "token", "data": token}
+            yield {"event": "end"}
+
+        mock_query_resolver.return_value.model = "llama2"
+        mock_query_resolver.return_value.resolve_stream.side_effect = resolve_stream
+
+        response = client.get(
+            reverse("resolve_query"),
+            {"q": "oldest date", "format": "stream"},
+            headers={"HX-Request": "true"},
+        )
+        assert scheduler.active == 0
+        lines = b"".join(response.streaming_content).decode().splitlines()
+
+        assert [json.loads(line) for line in lines] == [
+            {"event": "token", "data": "SELECT 1"},
+            {"event": "end"},
+        ]
+        assert states == [(1, services.PRIORITY_INTERACTIVE)] * 2
+        assert scheduler.active == 0
+
+    @mock.patch("core.services.QueryResolver")
+    def test_view_stream_overloaded(self, mock_query_resolver, client, settings):
+        settings.SCHEDULER_ENABLED = True
+        settings.SCHEDULER_MAX_QUEUE = 0
+        settings.SCHEDULER_CONCURRENCY = 1
+        mock_query_resolver.return_value.model = "llama2"
+
+        with services.get_model_scheduler("llama2").slot():
+            response = client.get(
+                reverse("resolve_query"), {"q": "oldest date", "format": "stream"}
+            )
+
+        assert response.status_code == 429
+        assert response["Retry-After"] == "5"
+
+
+class TestBatchResolver:
+
+    @mock.patch("core.services.QueryResolver")
+    def test_deduplicates_in_order(self, mock_query_resolver, settings):
+        settings.AVAILABLE_MODELS = ["llama2", "mistral"]
+        mock_query_resolver.return_value.resolve.side_effect = lambda query: {
+            "query": query,
+            "response": [],
+        }
+
+        results = services.BatchResolver().resolve(
+            [
+                ("oldest date", None),
+                ("newest date", "mistral"),
+                ("Oldest date?", "llama2"),
+                ("newest date", None),
+            ]
+        )
+
+        assert results == [
+            {"query": "oldest date", "response": []},
+            {"query": "newest date", "response": []},
+            {"query": "Oldest date?", "response": []},
+            {"query": "newest date", "response": []},
+        ]
+        assert sorted(
+            call.kwargs["model"] for call in mock_query_resolver.call_args_list
+        ) == ["llama2", "mistral"]
+        assert mock_query_resolver.return_value.resolve.call_count == 3
+
+    @mock.patch("core.services.QueryResolver")
+    def test_per_item_errors(self, mock_query_resolver):
+        def query_resolver(model):
+            if model != "llama2":
+                raise AssertionError(f"Invalid model: {model}")
+            return mock.Mock(resolve=mock.Mock(side_effect=Exception("Test error")))
+
+        mock_query_resolver.side_effect = query_resolver
+
+        results = services.BatchResolver().resolve(
+            [("oldest date", "llama2"), ("oldest date", "random-model")]
+        )
+
+        assert results == [
+            {"query": "oldest date", "error": "Test error"},
+            {"query": "oldest date", "error": "Invalid model: random-model"},
+        ]
+
+    @mock.patch("core.services.QueryResolver")
+    def test_concurrency_per_model(self, mock_query_resolver, settings):
+        settings.AVAILABLE_MODELS = ["llama2"]
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def resolve(query):
+            with lock:
+                running.append(query)
+                max_running.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(query)
+            return {"query": query}
+
+        mock_query_resolver.return_value.resolve.side_effect = resolve
+
+        services.BatchResolver(concurrency=2).resolve(
+            [(f"question {i}", None) for i in range(6)]
+        )
+
+        assert max(max_running) == 2
+
+
+class TestSqlGeneratorRegistry:
+
+    def test_get_sql_generator(self, settings):
+        settings.AVAILABLE_MODELS = ["llama2", "mistral"]
+
+        generator = services.get_sql_generator("llama2")
+
+        assert services.get_sql_generator("llama2") is generator
+        assert services.QueryResolver(model="llama2").sql_generator is generator
+        assert services.get_sql_generator("mistral") is not generator
+        assert services.get_sql_generator("llama2", asynchronous=True) is not generator
+
+    @mock.patch("core.services.ollama.Client")
+    def test_shared_ollama_client(self, mock_client, settings):
+        settings.OLLAMA_TIMEOUT = 60
+        settings.OLLAMA_CONNECT_TIMEOUT = 2
+        settings.OLLAMA_MAX_CONNECTIONS = 4
+        settings.OLLAMA_MAX_KEEPALIVE_CONNECTIONS = 3
+
+        generators = [
+            services.OllamaSqlGenerator(model="llama2"),
+            services.OllamaSqlGenerator(model="mistral"),
+        ]
+
+        assert all(generator.ollama is mock_client.return_value for generator in generators)
+        mock_client.assert_called_once_with(
+            host=settings.MODEL_SERVER_ENDPOINT,
+            timeout=httpx.Timeout(60, connect=2),
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=3),
+        )
+
+    @mock.patch("core.services.ollama.AsyncClient")
+    def test_async_ollama_client_per_event_loop(self, mock_async_client):
+        mock_async_client.side_effect = lambda **kwargs: mock.Mock()
+
+        async def get_clients():
+            return services.get_async_ollama_client(), services.get_async_ollama_client()
+
+        first, second = async_to_sync(get_clients)()
+        other, _ = asyncio.run(get_clients())
+
+        assert first is second
+        assert other is not first
+
+
+class SlowSqlGenerator(services.AbstractSqlGenerator):
+    def __init__(self, sql, delay=0.0, error=None):
+        self.sql = sql
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def generate_sql(self, query):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.sql
+
+    async def agenerate_sql(self, query):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.sql
+
+
+class TestHedgedSqlGenerator:
+
+    def _get_generator(self, primary, hedge):
+        return services.HedgedSqlGenerator(
+            primary,
+            hedge,
+            model="llama2",
+            hedge_model="mistral",
+            latencies=services.LatencyTracker(min_samples=2),
+        )
+
+    @pytest.fixture(autouse=True)
+    def valid_sql(self, settings):
+        settings.HEDGE_DELAY = 0.05
+        with mock.patch(
+            "core.services.is_valid_sql", side_effect=lambda sql: sql.startswith("SELECT")
+        ) as mock_is_valid_sql:
+            yield mock_is_valid_sql
+
+    @pytest.mark.parametrize("asynchronous", [False, True])
+    def test_primary_in_time(self, asynchronous):
+        primary, hedge = SlowSqlGenerator("SELECT 1"), SlowSqlGenerator("SELECT 2")
+        generator = self._get_generator(primary, hedge)
+
+        if asynchronous:
+            sql = async_to_sync(generator.agenerate_sql)("question")
+        else:
+            sql = generator.generate_sql("question")
+
+        assert sql == "SELECT 1"
+        assert hedge.calls == 0
+        assert len(generator.latencies._latencies) == 1
+
+    @pytest.mark.parametrize("asynchronous", [False, True])
+    def test_hedge_wins(self, asynchronous):
+        primary = SlowSqlGenerator("SELECT 1", delay=0.5)
+        hedge = SlowSqlGenerator("SELECT 2")
+        generator = self._get_generator(primary, hedge)
+
+        started_at = time.monotonic()
+        if asynchronous:
+            sql = async_to_sync(generator.agenerate_sql)("question")
+        else:
+            sql = generator.generate_sql("question")
+
+        assert sql == "SELECT 2"
+        assert time.monotonic() - started_at < 0.5
+        assert metrics.hedged_questions.get(model="llama2", winner="mistral") == 1
+
+    def test_hedge_cancels_async_primary(self):
+        primary = SlowSqlGenerator("SELECT 1", delay=10)
+        generator = self._get_generator(primary, SlowSqlGenerator("SELECT 2"))
+
+        async def generate():
+            sql = await generator.agenerate_sql("question")
+            await asyncio.sleep(0)
+            return sql
+
+        assert async_to_sync(generate)() == "SELECT 2"
+        # The cancelled primary still counts, as at least the hedge delay.
+        assert generator.latencies._latencies[0] >= 0.05
+
+    @pytest.mark.parametrize(
+        "primary, hedge, expected",
+        [
+            (SlowSqlGenerator("oops"), SlowSqlGenerator("SELECT 2"), "SELECT 2"),
+            (
+                SlowSqlGenerator("", error=httpx.ConnectError("down")),
+                SlowSqlGenerator("SELECT 2"),
+                "SELECT 2",
+            ),
+            (SlowSqlGenerator("oops"), SlowSqlGenerator("nope", delay=0.1), "oops"),
+        ],
+    )
+    def test_invalid_primary(self, primary, hedge, expected, settings):
+        settings.HEDGE_DELAY = 10
+        generator = self._get_generator(primary, hedge)
+
+        started_at = time.monotonic()
+        assert generator.generate_sql("question") == expected
+        assert time.monotonic() - started_at < 1
+        assert hedge.calls == 1
+
+    @pytest.mark.parametrize("asynchronous", [False, True])
+    def test_both_invalid_returns_primary(self, asynchronous):
+        primary = SlowSqlGenerator("oops", delay=0.2)
+        hedge = SlowSqlGenerator("nope")
+        generator = self._get_generator(primary, hedge)
+
+        if asynchronous:
+            sql = async_to_sync(generator.agenerate_sql)("question")
+        else:
+            sql = generator.generate_sql("question")
+
+        assert sql == "oops"
+        assert hedge.calls == 1
+
+    def test_both_fail(self):
+        error = httpx.ConnectError("down")
+        generator = self._get_generator(
+            SlowSqlGenerator("", error=error),
+            SlowSqlGenerator("", error=ValueError("other")),
+        )
+
+        with pytest.raises(httpx.ConnectError):
+            generator.generate_sql("question")
+
+    def test_delay(self, settings):
+        settings.HEDGE_DELAY = None
+        settings.HEDGE_PERCENTILE = 0.9
+        settings.HEDGE_INITIAL_DELAY = 3
+        generator = self._get_generator(SlowSqlGenerator(""), SlowSqlGenerator(""))
+
+        assert generator.get_delay() == 3
+        for seconds in range(1, 11):
+            generator.latencies.add(seconds)
+        assert generator.get_delay() == 10
+        generator.latencies.add(0.5)
+        assert generator.get_delay() == 9
+
+    def test_stream_sql_uses_primary(self):
+        generator = self._get_generator(
+            SlowSqlGenerator("SELECT 1"), SlowSqlGenerator("SELECT 2")
+        )
+
+        assert list(generator.stream_sql("question")) == ["SELECT 1"]
+
+    @pytest.mark.parametrize(
+        "available_models, hedge_model, model, expected",
+        [
+            (["llama2", "mistral"], "", "llama2", "mistral"),
+            (["llama2", "mistral"], "", "mistral", "llama2"),
+            (["llama2", "mistral", "phi"], "phi", "llama2", "phi"),
+            (["llama2"], "", "llama2", None),
+        ],
+    )
+    def test_build_sql_generator(self, available_models, hedge_model, model, expected, settings):
+        settings.AVAILABLE_MODELS = available_models
+        settings.HEDGE_MODEL = hedge_model
+        settings.HEDGE_ENABLED = True
+        settings.SQL_CACHE_ENABLED = True
+        settings.TEMPLATE_SQL_ENABLED = False
+
+        sql_generator = services.QueryResolver(model=model).sql_generator
+
+        assert isinstance(sql_generator, services.CachedSqlGenerator)
+        if expected is None:
+            assert isinstance(sql_generator.sql_generator, services.OllamaSqlGenerator)
+        else:
+            hedged_generator = sql_generator.sql_generator
+            assert isinstance(hedged_generator, services.HedgedSqlGenerator)
+            assert hedged_generator.hedge_model == expected
+            assert isinstance(hedged_generator.sql_generator, services.OllamaSqlGenerator)
+            assert hedged_generator.hedge_generator.model == expected
+            assert hedged_generator.prompt_version == hedged_generator.sql_generator.prompt_version
+
+    @pytest.mark.django_db
+    def test_cache_hits_are_not_hedged(self, settings):
+        settings.AVAILABLE_MODELS = ["llama2", "mistral"]
+        settings.HEDGE_ENABLED = True
+        settings.SQL_CACHE_PERSISTENT = False
+        settings.TEMPLATE_SQL_ENABLED = False
+        sql_generator = services.build_sql_generator("llama2")
+        hedged_generator = sql_generator.sql_generator
+        hedged_generator.sql_generator = SlowSqlGenerator("SELECT 1")
+        hedged_generator.hedge_generator = SlowSqlGenerator("SELECT 2")
+
+        for _ in range(3):
+            assert sql_generator.generate_sql("question") == "SELECT 1"
+
+        assert hedged_generator.sql_generator.calls == 1
+        assert hedged_generator.hedge_generator.calls == 0
+        assert len(hedged_generator.latencies._latencies) == 1
+
+
+class TestIsValidSql:
+
+    @pytest.mark.django_db
+    @pytest.mark.parametrize(
+        "sql, valid",
+        [
+            ("SELECT close FROM core_teslastockdata;", True),
+            ("DELETE FROM core_teslastockdata", True),
+            ("SELECT nothing FROM core_teslastockdata", False),
+            ("SELEC 1", False),
+            ("SELECT 1; DELETE FROM core_teslastockdata", False),
+            ("  ", False),
+        ],
+    )
+    def test_is_valid_sql(self, sql, valid):
+        make_stock_data(1)
+
+        assert services.is_valid_sql(sql) is valid
+        assert TeslaStockData.objects.count() == 1
+
+
+class TestModelWarmer:
+
+    @pytest.fixture
+    def mock_client(self):
+        with mock.patch("core.services.get_ollama_client") as mock_get_ollama_client:
+            yield mock_get_ollama_client.return_value
+
+    def test_run(self, mock_client, settings):
+        settings.AVAILABLE_MODELS = ["llama2", "mistral"]
+        settings.DOWNLOAD_MODELS_ON_FLY = ["mistral"]
+        warmer = warmup.ModelWarmer()
+
+        warmer.run()
+
+        assert warmer.is_ready()
+        assert warmer.get_states() == {"llama2": "ready", "mistral": "ready"}
+        mock_client.pull.assert_called_once_with("mistral")
+        mock_client.generate.assert_has_calls(
+            [
+                mock.call(
+                    model=model,
+                    prompt="SELECT 1",
+                    options={"num_predict": 1},
+                    keep_alive=settings.OLLAMA_KEEP_ALIVE,
+                )
+                for model in ["llama2", "mistral"]
+            ]
+        )
+
+    def test_run_with_error(self, mock_client, settings):
+        settings.AVAILABLE_MODELS = ["llama2", "mistral"]
+        settings.DOWNLOAD_MODELS_ON_FLY = [""]
+        mock_client.generate.side_effect = [Exception("Test error"), None]
+        warmer = warmup.ModelWarmer()
+        warmer.stopped.set()
+
+        warmer.run()
+
+        assert not warmer.is_ready()
+        assert warmer.get_states() == {"llama2": "failed", "mistral": "ready"}
+
+    def test_start_disabled(self, mock_client, settings):
+        settings.WARMUP_MODELS = False
+        warmer = warmup.ModelWarmer()
+
+        warmer.start()
+
+        assert warmer.is_ready()
+        mock_client.generate.assert_not_called()
+
+    @mock.patch("core.warmup.threading.Thread")
+    def test_start_once(self, mock_thread, settings):
+        settings.WARMUP_MODELS = True
+        warmer = warmup.ModelWarmer()
+
+        warmer.start()
+        warmer.start()
+
+        mock_thread.assert_called_once_with(
+            target=warmer.run, name="model-warmer", daemon=True
+        )
+        mock_thread.return_value.start.assert_called_once_with()
+
+
+class TestReadinessView:
+
+    def test_url(self):
+        assert reverse("readiness") == "/healthz/ready"
+
+    @pytest.mark.parametrize("ready, status_code", [(True, 200), (False, 503)])
+    @mock.patch("core.views.model_warmer")
+    def test_readiness(self, mock_model_warmer, ready, status_code, client):
+        mock_model_warmer.is_ready.return_value = ready
+        mock_model_warmer.get_states.return_value = {"llama2": "warming"}
+
+        response = client.get(reverse("readiness"))
+
+        assert response.status_code == status_code
+        assert response.json() == {"ready": ready, "models": {"llama2": "warming"}}
+
+
+class TestMetrics:
+
+    def test_histogram_render(self):
+        histogram = metrics.Histogram(
+            "test_seconds", "Test durations.", ("model",), buckets=(0.1, 1.0)
+        )
+        histogram.observe(0.05, model="llama2")
+        histogram.observe(0.5, model="llama2")
+        histogram.observe(2, model='say "hi"')
+
+        assert histogram.render().splitlines() == [
+            "# HELP test_seconds Test durations.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{model="llama2",le="0.1"} 1',
+            'test_seconds_bucket{model="llama2",le="1"} 2',
+            'test_seconds_bucket{model="llama2",le="+Inf"} 2',
+            'test_seconds_sum{model="llama2"} 0.55',
+            'test_seconds_count{model="llama2"} 2',
+            'test_seconds_bucket{model="say \\"hi\\"",le="0.1"} 0',
+            'test_seconds_bucket{model="say \\"hi\\"",le="1"} 0',
+            'test_seconds_bucket{model="say \\"hi\\"",le="+Inf"} 1',
+            'test_seconds_sum{model="say \\"hi\\""} 2',
+            'test_seconds_count{model="say \\"hi\\""} 1',
+        ]
+
+    def test_timed(self):
+        with metrics.collect_timings() as timings:
+            with metrics.timed("execute", "llama2"):
+                pass
+            with metrics.timed("execute", "llama2"):
+                pass
+
+        assert list(timings) == ["execute"]
+        assert metrics.stage_duration.get(model="llama2", stage="execute")[1] == 2
+
+    def test_timed_outside_request(self):
+        with metrics.timed("execute", "llama2"):
+            pass
+
+        assert metrics.request_timings.get() is None
+        assert metrics.stage_duration.get(model="llama2", stage="execute")[1] == 1
+
+    def test_record_ollama(self):
+        with metrics.collect_timings() as timings:
+            metrics.record_ollama(
+                "llama2",
+                {
+                    "done": True,
+                    "load_duration": 1_000_000,
+                    "prompt_eval_count": 300,
+                    "prompt_eval_duration": 150_000_000,
+                    "eval_count": 40,
+                    "eval_duration": 2_000_000_000,
                 },
-            ],
+            )
+
+        assert timings == pytest.approx(
+            {"ollama_load": 0.001, "ollama_prompt_eval": 0.15, "ollama_eval": 2.0}
         )
+        assert metrics.ollama_tokens.get(model="llama2", kind="prompt") == 300
+        assert metrics.ollama_tokens.get(model="llama2", kind="completion") == 40
+        assert metrics.ollama_tokens_per_second.get(model="llama2") == (20.0, 1)
+
+    def test_record_ollama_without_counts(self):
+        metrics.record_ollama("llama2", {"message": {"content": "SELECT 1"}})
 
+        assert metrics.ollama_tokens_per_second.get(model="llama2") == (0.0, 0)
+
+    def test_format_server_timing(self):
         assert (
-            response == mock_client.return_value.chat.return_value["message"]["content"]
+            metrics.format_server_timing({"generate": 1.23456, "execute": 0.002}, 1.5)
+            == "generate;dur=1234.6, execute;dur=2.0, total;dur=1500.0"
         )
 
-    @mock.patch("core.services.TABLE_SCHEMA")
-    def test_get_message(self, mock_table_schema):
-        mock_query = mock.Mock()
-        generator = services.OllamaSqlGenerator(model="llama2")
-        message = generator._get_message(mock_query)
+    @pytest.mark.django_db
+    @mock.patch("core.services.ollama.Client")
+    def test_resolve_records_stages(self, mock_client):
+        mock_client.return_value.chat.return_value = {
+            "message": {"content": "SELECT 1 AS one"},
+            "done": True,
+            "prompt_eval_count": 100,
+            "eval_count": 10,
+            "eval_duration": 500_000_000,
+        }
+
+        with metrics.collect_timings() as timings:
+            services.QueryResolver(model="llama2").resolve("one")
+
+        assert set(timings) == {"generate", "ollama_eval", "execute"}
+        assert metrics.ollama_tokens_per_second.get(model="llama2") == (20.0, 1)
 
-        assert str(mock_table_schema) in message
-        assert str(mock_query) in message
+    @mock.patch("core.services.QueryResolver")
+    def test_server_timing_header(self, mock_query_resolver, client):
+        def resolve(query, **kwargs):
+            metrics.record("generate", 0.25, "llama2")
+            return {"random": "data"}
+
+        mock_query_resolver.return_value.resolve.side_effect = resolve
+
+        response = client.get(reverse("resolve_query"), {"q": "oldest date"})
+
+        entries = response["Server-Timing"].split(", ")
+        assert entries[0] == "generate;dur=250.0"
+        assert entries[1].startswith("render;dur=")
+        assert entries[2].startswith("total;dur=")
+
+    @mock.patch("core.services.QueryResolver")
+    def test_server_timing_header_async(self, mock_query_resolver, async_client):
+        async def aresolve(query, **kwargs):
+            metrics.record("generate", 0.25, "llama2")
+            return {"random": "data"}
+
+        mock_query_resolver.return_value.aresolve = aresolve
+
+        response = async_to_sync(async_client.get)(
+            reverse("aresolve_query"), {"q": "oldest date"}
+        )
+
+        assert response["Server-Timing"].startswith("generate;dur=250.0, render;dur=")
+
+    def test_metrics_view(self, client):
+        metrics.record("generate", 0.25, "llama2")
+
+        response = client.get(reverse("metrics"))
+
+        assert reverse("metrics") == "/metrics"
+        assert response.status_code == 200
+        assert response["Content-Type"].startswith("text/plain; version=0.0.4")
+        content = response.content.decode()
+        assert "# TYPE nl2sql_stage_duration_seconds histogram" in content
+        assert (
+            'nl2sql_stage_duration_seconds_count{model="llama2",stage="generate"} 1'
+            in content
+        )
@@ -1,9 +1,114 @@
+import asyncio
+import csv
+import json
+import time
+from io import StringIO
+
 from django.conf import settings
-from django.http import JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.template.response import TemplateResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
-from core import services
+from core import jobs, metrics, services
+from core.models import Job
+from core.warmup import model_warmer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COLUMNAR_FORMATS = ("columnar", "csv", "ndjson")
+
+
+def _format_event(event) -> str:
+    return json.dumps(event, cls=DjangoJSONEncoder) + "\n"
+
+
+def _stream_events(events):
+    for event in events:
+        yield _format_event(event)
+
+
+def _encode_json(data) -> bytes:
+    if orjson is None:
+        return json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":")).encode()
+    return orjson.dumps(data, default=DjangoJSONEncoder().default)
+
+
+def _render_columnar(response: dict, format: str, orient: str):
+    if "error" in response:
+        return JsonResponse(response)
+
+    columns, rows = response["columns"], response["rows"]
+    if format == "csv":
+        content = StringIO()
+        writer = csv.writer(content)
+        writer.writerow(columns)
+        writer.writerows(rows)
+        http_response = HttpResponse(
+            content.getvalue(), content_type="text/csv; charset=utf-8"
+        )
+    elif format == "ndjson":
+        http_response = HttpResponse(
+            b"".join(_encode_json(dict(zip(columns, row))) + b"\n" for row in rows),
+            content_type="application/x-ndjson",
+        )
+    else:
+        payload = {
+            "query": response["query"],
+            "attempted_query": response["attempted_query"],
+            "columns": columns,
+        }
+        if orient == "columns":
+            payload["data"] = [list(values) for values in zip(*rows)] or [[] for _ in columns]
+        else:
+            payload["rows"] = rows
+        if response.get("truncated"):
+            payload["truncated"] = True
+        return HttpResponse(_encode_json(payload), content_type="application/json")
+
+    if response.get("truncated"):
+        http_response["X-Truncated"] = "true"
+    return http_response
+
+
+def _get_priority(request) -> int:
+    # The chat page sends its questions with htmx.
+    if request.headers.get("HX-Request") == "true":
+        return services.PRIORITY_INTERACTIVE
+    return services.PRIORITY_API
+
+
+def _overloaded_response(error: services.ModelOverloaded) -> JsonResponse:
+    response = JsonResponse({"error": str(error)}, status=429)
+    response["Retry-After"] = str(int(error.retry_after))
+    return response
+
+
+def _stream_in_slot(events, scheduler: services.ModelScheduler, priority: int):
+    with services.priority(priority):
+        try:
+            with scheduler.hold():
+                yield from events
+        except services.ModelOverloaded as e:
+            yield {"event": "error", "data": str(e)}
+            yield {"event": "end"}
+
+
+def _render_response(request, response: dict, format: str, model: str | None):
+    with metrics.timed("render", model or settings.AVAILABLE_MODELS[0]):
+        if format in COLUMNAR_FORMATS:
+            return _render_columnar(
+                response, format, request.GET.get("orient", "rows")
+            )
+        if format == "json":
+            return JsonResponse(response)
+        return TemplateResponse(request, "response.html", response).render()
 
 
 @require_http_methods("GET")
@@ -14,11 +119,185 @@ def resolve_query(request):
     if not query:
         return JsonResponse({"error": "No query provided."}, status=400)
 
-    response = services.QueryResolver(model=model).resolve(query)
-    if format == "json":
-        return JsonResponse(response)
+    if format == "stream":
+        resolver = services.QueryResolver(model=model)
+        events = resolver.resolve_stream(query)
+        if settings.SCHEDULER_ENABLED:
+            # Once streaming, the response can not become a 429 anymore. The
+            # slot is held until the stream ends.
+            scheduler = services.get_model_scheduler(resolver.model)
+            try:
+                scheduler.check(_get_priority(request))
+            except services.ModelOverloaded as e:
+                return _overloaded_response(e)
+            events = _stream_in_slot(events, scheduler, _get_priority(request))
+        response = StreamingHttpResponse(
+            _stream_events(events), content_type="application/x-ndjson"
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
 
-    return TemplateResponse(request, "response.html", response)
+    try:
+        with services.priority(_get_priority(request)):
+            response = services.QueryResolver(model=model).resolve(
+                query, columnar=format in COLUMNAR_FORMATS
+            )
+    except services.ModelOverloaded as e:
+        return _overloaded_response(e)
+    return _render_response(request, response, format, model)
+
+
+@require_http_methods("GET")
+async def aresolve_query(request):
+    query: str = request.GET.get("q")
+    model: str = request.GET.get("model")
+    format: str = request.GET.get("format", "json")
+    if not query:
+        return JsonResponse({"error": "No query provided."}, status=400)
+
+    resolver = services.QueryResolver(model=model, asynchronous=True)
+    try:
+        with services.priority(_get_priority(request)):
+            response = await resolver.aresolve(query, columnar=format in COLUMNAR_FORMATS)
+    except services.ModelOverloaded as e:
+        return _overloaded_response(e)
+    return _render_response(request, response, format, model)
+
+
+def _parse_batch_questions(body: bytes) -> list[tuple[str, str | None]]:
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise ValueError("Invalid JSON body.")
+
+    questions = payload.get("questions") if isinstance(payload, dict) else None
+    if not isinstance(questions, list) or not questions:
+        raise ValueError("No questions provided.")
+    if len(questions) > settings.BATCH_MAX_QUESTIONS:
+        raise ValueError(
+            f"Too many questions, the maximum is {settings.BATCH_MAX_QUESTIONS}."
+        )
+
+    parsed = []
+    for question in questions:
+        if isinstance(question, str):
+            question = {"q": question}
+        if (
+            not isinstance(question, dict)
+            or not isinstance(question.get("q"), str)
+            or not question["q"]
+            or not isinstance(question.get("model"), (str, type(None)))
+        ):
+            raise ValueError(
+                'Each question must be a string or an object with "q" and an optional "model".'
+            )
+        parsed.append((question["q"], question.get("model")))
+    return parsed
+
+
+@csrf_exempt
+@require_http_methods("POST")
+def resolve_batch(request):
+    try:
+        questions = _parse_batch_questions(request.body)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    results = services.BatchResolver().resolve(questions)
+    return JsonResponse({"results": results})
+
+
+def _parse_job(body: bytes) -> tuple[str, str, bool]:
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise ValueError("Invalid JSON body.")
+    if not isinstance(payload, dict):
+        raise ValueError("Invalid JSON body.")
+
+    query = payload.get("q")
+    if not isinstance(query, str) or not query:
+        raise ValueError("No query provided.")
+    model = payload.get("model") or settings.AVAILABLE_MODELS[0]
+    if model not in settings.AVAILABLE_MODELS:
+        raise ValueError(f"Invalid model: {model}")
+    format = payload.get("format", "json")
+    if format not in ("json", "columnar"):
+        raise ValueError('The format must be "json" or "columnar".')
+    return query, model, format == "columnar"
+
+
+def _serialize_job(job: Job) -> dict:
+    data = {
+        "id": str(job.id),
+        "status": job.status,
+        "query": job.question,
+        "model": job.model,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+    if job.status == Job.DONE:
+        data["result"] = job.result
+    elif job.status == Job.FAILED:
+        data["error"] = job.error
+    return data
+
+
+async def _stream_job(job: Job):
+    # Every status change is a line, the stream ends with the finished job or
+    # after JOB_TIMEOUT, clients then poll again. Waiting clients hold no
+    # thread nor database connection.
+    yield _format_event(_serialize_job(job))
+    deadline = time.monotonic() + settings.JOB_TIMEOUT
+    status = job.status
+    while not job.finished and time.monotonic() < deadline:
+        await asyncio.sleep(settings.JOB_POLL_INTERVAL)
+        try:
+            await job.arefresh_from_db()
+        except Job.DoesNotExist:
+            return
+        if job.status != status:
+            status = job.status
+            yield _format_event(_serialize_job(job))
+
+
+@csrf_exempt
+@require_http_methods("POST")
+def submit_job(request):
+    try:
+        query, model, columnar = _parse_job(request.body)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    job = jobs.submit_job(query, model, columnar)
+    url = reverse("job", args=[job.id])
+    response = JsonResponse(
+        {"id": str(job.id), "status": job.status, "url": url}, status=202
+    )
+    response["Location"] = url
+    return response
+
+
+@require_http_methods("GET")
+async def job_detail(request, job_id):
+    job = await (
+        Job.objects.filter(id=job_id)
+        .exclude(expires_at__lte=timezone.now())
+        .afirst()
+    )
+    if job is None:
+        return JsonResponse({"error": "Job not found."}, status=404)
+
+    if request.GET.get("format") == "stream":
+        response = StreamingHttpResponse(
+            _stream_job(job), content_type="application/x-ndjson"
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+    return JsonResponse(_serialize_job(job))
 
 
 @require_http_methods("GET")
@@ -26,3 +305,19 @@ def chat(request):
     return TemplateResponse(
         request, "chat.html", {"available_models": settings.AVAILABLE_MODELS}
     )
+
+
+@require_http_methods("GET")
+def readiness(request):
+    ready = model_warmer.is_ready()
+    return JsonResponse(
+        {"ready": ready, "models": model_warmer.get_states()},
+        status=200 if ready else 503,
+    )
+
+
+@require_http_methods("GET")
+def metrics_view(request):
+    return HttpResponse(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,78 @@
+import logging
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+PULLING = "pulling"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+
+class ModelWarmer:
+    def __init__(self) -> None:
+        self.states: dict[str, str] = {}
+        self.stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        if not settings.WARMUP_MODELS:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.states = {model: PENDING for model in settings.AVAILABLE_MODELS}
+            self._thread = threading.Thread(
+                target=self.run, name="model-warmer", daemon=True
+            )
+            self._thread.start()
+
+    def _warm_up(self, client, model: str) -> None:
+        if model in settings.DOWNLOAD_MODELS_ON_FLY:
+            self.states[model] = PULLING
+            client.pull(model)
+        self.states[model] = WARMING
+        # A one token generation loads the model into memory.
+        client.generate(
+            model=model,
+            prompt="SELECT 1",
+            options={"num_predict": 1},
+            keep_alive=settings.OLLAMA_KEEP_ALIVE,
+        )
+        self.states[model] = READY
+
+    def run(self) -> None:
+        # Imported here so processes that never warm up do not load ollama.
+        from core.services import get_ollama_client
+
+        client = get_ollama_client()
+        while True:
+            for model in settings.AVAILABLE_MODELS:
+                if self.states.get(model) == READY:
+                    continue
+                try:
+                    self._warm_up(client, model)
+                except Exception:
+                    self.states[model] = FAILED
+                    logger.exception("Could not warm up the %s model.", model)
+            if self.is_ready() or self.stopped.wait(settings.WARMUP_RETRY_INTERVAL):
+                return
+
+    def is_ready(self) -> bool:
+        if not settings.WARMUP_MODELS:
+            return True
+        return all(
+            self.states.get(model) == READY for model in settings.AVAILABLE_MODELS
+        )
+
+    def get_states(self) -> dict[str, str]:
+        return {
+            model: self.states.get(model, PENDING) for model in settings.AVAILABLE_MODELS
+        }
+
+
+model_warmer = ModelWarmer()
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
 application = get_asgi_application()
+
+# Pull and load the models in the background, see /healthz/ready.
+from core.warmup import model_warmer  # noqa: E402
+
+model_warmer.start()
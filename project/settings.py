@@ -46,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "core.middleware.ServerTimingMiddleware",
+    "core.middleware.CompressionMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -87,6 +89,8 @@ DATABASES = {
         "PASSWORD": os.getenv("DATABASE_PASSWORD"),
         "HOST": os.getenv("DATABASE_HOST"),
         "PORT": os.getenv("DATABASE_PORT", 5432),
+        "CONN_MAX_AGE": int(os.getenv("DATABASE_CONN_MAX_AGE", 0)),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
@@ -136,4 +140,167 @@ MODEL_SERVER_ENDPOINT = os.environ["MODEL_SERVER_ENDPOINT"]
 
 AVAILABLE_MODELS = os.environ.get("AVAILABLE_MODELS", "llama2").split(",")
 
-DOWNLOAD_MODELS_ON_FLY = os.environ.get("DOWNLOAD_MODELS_ON_FLY", "").split(",")
\ No newline at end of file
+DOWNLOAD_MODELS_ON_FLY = os.environ.get("DOWNLOAD_MODELS_ON_FLY", "").split(",")
+
+SQL_CACHE_ENABLED = os.environ.get("SQL_CACHE_ENABLED", "true").lower() == "true"
+
+SQL_CACHE_PERSISTENT = os.environ.get("SQL_CACHE_PERSISTENT", "true").lower() == "true"
+
+SQL_CACHE_SIZE = int(os.environ.get("SQL_CACHE_SIZE", 1024))
+
+SQL_CACHE_TTL = float(os.environ.get("SQL_CACHE_TTL", 3600))
+
+# Questions such as "close on 2021-03-04" or "highest volume in 2019" are
+# answered with SQL templates, the model only gets the other ones.
+TEMPLATE_SQL_ENABLED = os.environ.get("TEMPLATE_SQL_ENABLED", "true").lower() == "true"
+
+SEMANTIC_CACHE_ENABLED = (
+    os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+)
+
+SEMANTIC_CACHE_EMBEDDING_MODEL = os.environ.get("SEMANTIC_CACHE_EMBEDDING_MODEL", "")
+
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", 4096))
+
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "true").lower() == "true"
+
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+RESULT_CACHE_MAX_ENTRY_BYTES = int(
+    os.environ.get("RESULT_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)
+)
+
+RESULT_CACHE_MAX_ENTRY_ROWS = int(os.environ.get("RESULT_CACHE_MAX_ENTRY_ROWS", 10000))
+
+DATA_VERSION_CHECK_INTERVAL = float(os.environ.get("DATA_VERSION_CHECK_INTERVAL", 1))
+
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 500))
+
+QUERY_MAX_ROWS = int(os.environ.get("QUERY_MAX_ROWS", 10000))
+
+QUERY_FETCH_SIZE = int(os.environ.get("QUERY_FETCH_SIZE", 1000))
+
+# Read queries are prepared once per connection and shape, their literals
+# become parameters. Statements only pay off when connections are reused, set
+# DATABASE_CONN_MAX_AGE too. Not behind a PgBouncer in transaction pooling mode.
+PREPARED_STATEMENTS_ENABLED = (
+    os.environ.get("PREPARED_STATEMENTS_ENABLED", "false").lower() == "true"
+)
+
+PREPARED_STATEMENTS_SIZE = int(os.environ.get("PREPARED_STATEMENTS_SIZE", 100))
+
+QUERY_STATEMENT_TIMEOUT = int(os.environ.get("QUERY_STATEMENT_TIMEOUT", 30000))
+
+QUERY_WORK_MEM = os.environ.get("QUERY_WORK_MEM", "16MB")
+
+# Answer read queries from an in-memory SQLite copy of the stock data, rebuilt
+# whenever load_data changes it. Queries SQLite can not run go to Postgres.
+SNAPSHOT_EXECUTOR_ENABLED = (
+    os.environ.get("SNAPSHOT_EXECUTOR_ENABLED", "false").lower() == "true"
+)
+
+ASYNC_DATABASE_THREADS = int(os.environ.get("ASYNC_DATABASE_THREADS", 8))
+
+BATCH_MAX_QUESTIONS = int(os.environ.get("BATCH_MAX_QUESTIONS", 100))
+
+BATCH_CONCURRENCY_PER_MODEL = int(os.environ.get("BATCH_CONCURRENCY_PER_MODEL", 2))
+
+# At most SCHEDULER_CONCURRENCY generations per model run at once, the others
+# wait by priority, chat first and batches last. Requests that would wait more
+# than SCHEDULER_MAX_WAIT seconds are answered with 429 right away. The limits
+# are per process, N workers send up to N times SCHEDULER_CONCURRENCY
+# generations to Ollama at once.
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "false").lower() == "true"
+
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", 2))
+
+SCHEDULER_MAX_QUEUE = int(os.environ.get("SCHEDULER_MAX_QUEUE", 50))
+
+SCHEDULER_MAX_WAIT = float(os.environ.get("SCHEDULER_MAX_WAIT", 30))
+
+SCHEDULER_INITIAL_DURATION = float(os.environ.get("SCHEDULER_INITIAL_DURATION", 5))
+
+# Identical questions resolved at the same time share one answer. With the
+# advisory lock, other processes wait for the SQL generated by the first one,
+# it needs SQL_CACHE_PERSISTENT.
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+SINGLE_FLIGHT_ADVISORY_LOCK = (
+    os.environ.get("SINGLE_FLIGHT_ADVISORY_LOCK", "false").lower() == "true"
+)
+
+# Ask a second model when the first one is slow and use the first valid SQL.
+# Without HEDGE_DELAY the second model is asked once the question takes longer
+# than HEDGE_PERCENTILE of the latest answers of the first model.
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "false").lower() == "true"
+
+HEDGE_MODEL = os.environ.get("HEDGE_MODEL", "")
+
+HEDGE_DELAY = (
+    float(os.environ["HEDGE_DELAY"]) if os.environ.get("HEDGE_DELAY") else None
+)
+
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 0.9))
+
+HEDGE_INITIAL_DELAY = float(os.environ.get("HEDGE_INITIAL_DELAY", 5))
+
+# Questions submitted as jobs are resolved by the run_workers processes, their
+# answers are kept for JOB_RESULT_TTL seconds. Jobs running for longer than
+# JOB_TIMEOUT seconds are picked up again by another worker.
+JOB_RESULT_TTL = float(os.environ.get("JOB_RESULT_TTL", 3600))
+
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", 600))
+
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1))
+
+JOB_CLEANUP_INTERVAL = float(os.environ.get("JOB_CLEANUP_INTERVAL", 60))
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", 300))
+
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", 5))
+
+OLLAMA_MAX_CONNECTIONS = int(os.environ.get("OLLAMA_MAX_CONNECTIONS", 20))
+
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", 20)
+)
+
+# Ollama takes durations such as "30m" or a number of seconds, negative
+# numbers keep the models loaded forever.
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+if OLLAMA_KEEP_ALIVE.lstrip("-").isdigit():
+    OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE)
+
+WARMUP_MODELS = os.environ.get("WARMUP_MODELS", "true").lower() == "true"
+
+WARMUP_RETRY_INTERVAL = float(os.environ.get("WARMUP_RETRY_INTERVAL", 30))
+
+# One generated SQL statement per line, read by the advise_indexes command.
+SQL_LOG_FILE = os.environ.get("SQL_LOG_FILE", "")
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "core": {
+            "handlers": ["console"],
+            "level": os.environ.get("CORE_LOG_LEVEL", "INFO"),
+        },
+    },
+}
+
+if SQL_LOG_FILE:
+    LOGGING["formatters"] = {"sql": {"format": "%(message)s"}}
+    LOGGING["handlers"]["sql_file"] = {
+        "class": "logging.handlers.WatchedFileHandler",
+        "filename": SQL_LOG_FILE,
+        "formatter": "sql",
+    }
+    LOGGING["loggers"]["core.sql"] = {"handlers": ["sql_file"], "level": "INFO"}
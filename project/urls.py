@@ -17,10 +17,25 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
-from core.views import resolve_query, chat
+from core.views import (
+    aresolve_query,
+    chat,
+    job_detail,
+    metrics_view,
+    readiness,
+    resolve_batch,
+    resolve_query,
+    submit_job,
+)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/v1/resolve_query/', resolve_query, name="resolve_query"),
+    path('api/v1/async/resolve_query/', aresolve_query, name="aresolve_query"),
+    path('api/v1/resolve_batch/', resolve_batch, name="resolve_batch"),
+    path('api/v1/jobs/', submit_job, name="jobs"),
+    path('api/v1/jobs/<uuid:job_id>/', job_detail, name="job"),
     path('chat/', chat, name="chat"),
+    path('healthz/ready', readiness, name="readiness"),
+    path('metrics', metrics_view, name="metrics"),
 ]